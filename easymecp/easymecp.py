@@ -91,6 +91,18 @@ have higher precedence over config files, and this one over command-line argumen
 
     -f > --conf > anything else
 
+Subcommands
+...........
+
+    easymecp analyze RUN [RUN ...]      Compare finished or running calculations
+    easymecp serve                      Run a local service that queues MECP jobs
+    easymecp submit system.gjf          Submit a job to that service
+    easymecp scan system.gjf ...        Relaxed scan along the crossing seam
+    easymecp status [DIR ...]           Progress and ETA of calculations (--watch)
+    easymecp index [DIR ...]            Index runs in SQLite and query them
+
+Run them with -h for their own options.
+
 """
 
 from __future__ import print_function, absolute_import
@@ -100,18 +112,28 @@ if sys.version_info[0:2] < (3, 4) and sys.version_info[0:2] != (2, 7):
 
 from contextlib import contextmanager
 from datetime import datetime
-from distutils.spawn import find_executable
+from itertools import combinations, islice
 from runpy import run_path
 try:
-    from subprocess import call, SubprocessError
+    from subprocess import call, Popen, SubprocessError
 except ImportError:  # Py27
-    from subprocess import call, CalledProcessError as SubprocessError
+    from subprocess import call, Popen, CalledProcessError as SubprocessError
 from tempfile import mkdtemp
 import argparse
+import errno
+import gzip
+import hashlib
+import json
+import math
+import mmap
 import os
 import re
 import shlex
 import shutil
+import signal
+import threading
+import time
+from array import array
 
 
 __version__ = '0.3.2'
@@ -133,6 +155,12 @@ class MECPCalculation(object):
 
     Once instantiated, ``run()`` will take care of everything.
 
+    All the files of a calculation are read and written in its ``workdir``
+    (the current working directory by default), where Gaussian and MECP.x
+    run too, so several calculations can run in the same process as long as
+    their ``workdir`` differ. ``from_strings`` and ``from_gaussian_input``
+    take the inputs from memory instead of files.
+
     Parameters
     ----------
 
@@ -153,11 +181,21 @@ class MECPCalculation(object):
     >>> mecp = MECPCalculation(a_header='singlet.header', b_header='triplet.header',
                                geom='initial_geometry.xyz', footer=None, max_steps=100)
     >>> mecp.run()
+
+    From memory, in its own directory:
+
+    >>> mecp = MECPCalculation.from_strings([singlet_header, triplet_header], geometry,
+                                            workdir='runs/0001')
+    >>> mecp.run()
     """
 
     OK = 'OK'
     ERROR = 'ERROR'
     MAX_ITERATIONS_REACHED = 'MAX_ITERATIONS_REACHED'
+    JOURNAL = 'easymecp.journal'
+    WATCHDOG_INTERVAL = 1.0  # seconds between checks of running Gaussian jobs
+    LARGE_SYSTEM = 2000  # atoms; larger systems use L-BFGS instead of a dense Hessian
+    LBFGS_MEMORY = 20  # L-BFGS updates kept by default in large systems
 
     ####################################################################################
     #
@@ -170,14 +208,53 @@ class MECPCalculation(object):
                  TDXMax='4.d-3', TDXRMS='2.5d-3', TGMax='7.d-4', TGRMS='5.d-4',
                  energy_parser='dft', FC=os.environ.get('FC', 'gfortran'),
                  FFLAGS=os.environ.get('FFLAGS', '-O -ffixed-line-length-none'),
-                 gaussian_exe=('g16' if find_executable('g16') else 'g09'), **kwargs):
-        self.a_header = extant_file(a_header, name='a_header')
-        self.b_header = extant_file(b_header, name='b_header')
-        self.geom = extant_file(geom, name='geom')
-        self.footer = extant_file(footer, name='footer', allow_errors=True)
+                 gaussian_exe='', trust_radius=0.0,
+                 gdiis_threshold=0.0, gdiis_history=4, algorithm='harvey', freeze='',
+                 constraints='', coordinates='cartesian', serial_freq=False, numerical_gradients='', numerical_step=0.005,
+                 numerical_jobs=4, resume=False, job_timeout=0.0, stall_timeout=0.0,
+                 retry_ladder='', scratch_dir='', archive='', keep_logs=0, compile_cache='',
+                 warm_start='', states='', pair='lowest', serial_states=False, results_from='log',
+                 symmetry='', symmetry_tolerance=0.01, surrogate='', surrogate_tolerance=1e-3,
+                 lbfgs_memory=0, workdir='', index=os.environ.get('EASYMECP_INDEX', ''),
+                 **kwargs):
+        self.workdir = os.path.abspath(workdir or os.curdir)
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        # In-memory contents of input files, by name (see ``from_strings``)
+        self._inputs = dict(kwargs.get('inputs') or {})
+        self.a_header = self._input_file(a_header, name='a_header')
+        self.b_header = self._input_file(b_header, name='b_header')
+        self.states = ([self._input_file(h, name='states') for h in states.split(',') if h] or
+                       [self.a_header, self.b_header])
+        self.labels = [chr(ord('A') + i) for i in range(len(self.states))]
+        self.pair = pair
+        self.serial_states = serial_states
+        self.geom = self._input_file(geom, name='geom')
+        self.footer = self._input_file(footer, name='footer', allow_errors=True)
         self.max_steps = int(max_steps)
         self.with_freq = with_freq
+        self.serial_freq = serial_freq
+        self.numerical_gradients = numerical_gradients
+        self.results_from = results_from
+        self.symmetry = symmetry
+        self.symmetry_tolerance = float(symmetry_tolerance)
+        self.surrogate = surrogate
+        self.surrogate_tolerance = float(surrogate_tolerance)
+        self.lbfgs_memory = int(lbfgs_memory)
+        self.index = index
+        self.numerical_step = float(numerical_step)
+        self.numerical_jobs = int(numerical_jobs)
+        self.job_timeout = float(job_timeout)
+        self.stall_timeout = float(stall_timeout)
+        self.retry_ladder = [r for r in retry_ladder.replace(' ', '').split(';') if r]
+        self.scratch_dir = scratch_dir
+        self._scratch = None
+        self.archive = archive
+        self.keep_logs = int(keep_logs)
+        self._archiver = None
         self.gaussian_exe = gaussian_exe
+        self.compile_cache = compile_cache
+        self.warm_start = warm_start
         self.TDE = fortran_double(TDE)
         self.TDXMax = fortran_double(TDXMax)
         self.TDXRMS = fortran_double(TDXRMS)
@@ -186,8 +263,42 @@ class MECPCalculation(object):
         self.FC = FC
         self.FFLAGS = FFLAGS
         self.natom = natom
+        self.trust_radius = float(trust_radius)
+        self.gdiis_threshold = float(gdiis_threshold)
+        self.gdiis_history = int(gdiis_history)
+        self.algorithm = algorithm
+        self.freeze = freeze
+        self.constraints = parse_constraints(constraints)
+        self.coordinates = coordinates
         self.converged_at = None
 
+        if algorithm not in OPTIMIZERS:
+            raise ValueError('algorithm `{}` must be one of <{}>'.format(
+                             algorithm, ', '.join(sorted(OPTIMIZERS))))
+        if len(self.states) < 2:
+            raise ValueError('states needs at least two header files')
+        if pair != 'lowest' and (len(set(pair.split(','))) != 2 or
+                                 not set(pair.split(',')) <= set(self.labels)):
+            raise ValueError('pair must be lowest or two of <{}>, like A,C'.format(
+                             ', '.join(self.labels)))
+        self.set_pair(('A', 'B') if pair == 'lowest' else tuple(sorted(pair.split(','))))
+        if archive not in ('', 'gzip'):
+            raise ValueError('archive must be gzip')
+        if numerical_gradients not in ('', 'central', 'forward'):
+            raise ValueError('numerical_gradients must be central or forward')
+        if symmetry not in ('', 'keep', 'unique'):
+            raise ValueError('symmetry must be keep or unique')
+        if results_from not in ('log', 'fchk'):
+            raise ValueError('results_from must be log or fchk')
+        if results_from == 'fchk' and numerical_gradients:
+            raise ValueError('results_from=fchk cannot be used with numerical_gradients')
+        if surrogate not in ('', 'gek'):
+            raise ValueError('surrogate must be gek')
+        if surrogate and (algorithm != 'harvey' or coordinates != 'cartesian'):
+            raise ValueError('surrogate steps need algorithm=harvey and coordinates=cartesian')
+        if surrogate:
+            _numpy('Surrogate models')
+
         if energy_parser.endswith('.py') and os.path.isfile(energy_parser):
             try:
                 self._parse_energy = run_path(energy_parser)['parse_energy']
@@ -201,22 +312,134 @@ class MECPCalculation(object):
             except KeyError:
                 raise ValueError('energy_parser `{}` must be one of <{}>'.format(
                                 energy_parser, ', '.join(AVAILABLE_ENERGY_PARSERS)))
+        geom_lines = self.read_input(geom).splitlines(True)
         if not natom:
-            with open(geom) as f:
-                for line in f:
-                    if line.startswith('!'):
-                        continue
-                    elif len(line.split()) >= 4:
-                        self.natom +=1
-
-        i = 0
-        self.jobsdir = 'JOBS'
-        while os.path.exists(self.jobsdir):
-            i += 1
-            self.jobsdir = 'JOBS{}'.format(i)
-        os.makedirs(self.jobsdir)
-
-        self.mecp_exe = self.compile_fortran()
+            for line in geom_lines:
+                if line.startswith('!'):
+                    continue
+                elif len(line.split()) >= 4:
+                    self.natom +=1
+        if self.natom > self.LARGE_SYSTEM and not self.lbfgs_memory:
+            # A dense inverse Hessian would take (3 natom)^2 doubles, in MECP.x too
+            print('{} atoms: using L-BFGS with {} updates (lbfgs_memory)'.format(
+                  self.natom, self.LBFGS_MEMORY))
+            self.lbfgs_memory = self.LBFGS_MEMORY
+
+        self.oniom_atoms = parse_oniom_atoms(geom_lines)
+        self.frozen = sorted(set(parse_frozen_atoms(geom_lines) + parse_atom_list(freeze)))
+        if any(not 0 <= i < self.natom for i in self.frozen):
+            raise ValueError('Frozen atoms must be between 1 and {}'.format(self.natom))
+        for _, atoms, _ in self.constraints:
+            if any(not 0 <= i < self.natom for i in atoms):
+                raise ValueError('Constrained atoms must be between 1 and {}'.format(self.natom))
+        self.point_group = None
+        if symmetry:
+            self.point_group = PointGroup.detect(*parse_geometry(geom_lines), frozen=self.frozen,
+                                                 tolerance=self.symmetry_tolerance)
+
+        self._journal = None
+        self._resumed_step = None
+        self._timings = {}
+        if resume:
+            try:
+                with open(self.path(self.JOURNAL)) as f:
+                    self._journal = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                print('! Cannot resume from {}: {}. Starting from scratch.'.format(self.JOURNAL, e))
+        if self._journal is not None:
+            self.jobsdir = self._journal['jobsdir']
+        else:
+            i = 0
+            self.jobsdir = 'JOBS'
+            while os.path.exists(self.path(self.jobsdir)):
+                i += 1
+                self.jobsdir = 'JOBS{}'.format(i)
+            os.makedirs(self.path(self.jobsdir))
+
+        if (self.algorithm != 'harvey' or self.trust_radius or self.gdiis_threshold or
+                self.frozen or self.constraints or self.coordinates != 'cartesian' or
+                self.symmetry == 'unique' or self.surrogate or self.lbfgs_memory):
+            # These features are not available in MECP.x; use the Python optimizers instead
+            self.optimizer = self._new_optimizer()
+            self.mecp_exe = None
+        else:
+            self.optimizer = None
+            self.mecp_exe = None  # compiled by ``run``, while the first Gaussian jobs run
+        self._setup = None
+        self._setup_error = None
+        self._workspace_ready = threading.Event()
+
+    def _new_optimizer(self):
+        return OPTIMIZERS[self.algorithm](self.natom, TDE=self.TDE, TDXMax=self.TDXMax,
+                                          TDXRMS=self.TDXRMS, TGMax=self.TGMax,
+                                          TGRMS=self.TGRMS, trust_radius=self.trust_radius,
+                                          gdiis_threshold=self.gdiis_threshold,
+                                          gdiis_history=self.gdiis_history,
+                                          frozen=self.frozen, constraints=self.constraints,
+                                          coordinates=self.coordinates,
+                                          basis=self.symmetry_basis(),
+                                          surrogate=self.surrogate,
+                                          surrogate_tolerance=self.surrogate_tolerance,
+                                          lbfgs_memory=self.lbfgs_memory)
+
+    def symmetry_basis(self):
+        """
+        Symmetry-unique displacements for the optimizer with ``symmetry='unique'``.
+        """
+        if (self.symmetry != 'unique' or self.point_group is None or
+                len(self.point_group.operations) == 1):
+            return None
+        return self.point_group.basis(self.frozen)
+
+    @property
+    def gaussian_exe(self):
+        """
+        Gaussian executable. If not given, ``g16`` if available in ``$PATH``
+        and ``g09`` otherwise, looked up the first time it is needed.
+        """
+        if not self._gaussian_exe:
+            self._gaussian_exe = 'g16' if which('g16') else 'g09'
+        return self._gaussian_exe
+
+    @gaussian_exe.setter
+    def gaussian_exe(self, value):
+        self._gaussian_exe = value
+
+    @property
+    def formchk_exe(self):
+        """
+        ``formchk`` next to ``gaussian_exe``, or the one in ``$PATH``.
+        """
+        gaussian = which(self.gaussian_exe) or self.gaussian_exe
+        path = os.path.join(os.path.dirname(gaussian), 'formchk')
+        return path if os.path.isfile(path) else 'formchk'
+
+    def path(self, name):
+        """
+        Path of file ``name`` (relative to ``workdir``, unless it is absolute).
+        """
+        return os.path.join(self.workdir, name)
+
+    def read_input(self, name):
+        """
+        Contents of file ``name``, from memory if it was given to ``from_strings``.
+        """
+        if name in self._inputs:
+            return self._inputs[name]
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def read_geometry(self, name):
+        """
+        Like the ``read_geometry`` function, for file ``name`` (see ``read_input``).
+        """
+        return parse_geometry(self.read_input(name).splitlines(True))
+
+    def _input_file(self, path, **kwargs):
+        if path in self._inputs:
+            return path
+        extant_file(self.path(path), **kwargs)
+        return path
 
     @classmethod
     def from_conf(cls, path, **kw):
@@ -235,7 +458,7 @@ class MECPCalculation(object):
         mecp : MECPCalculation
             Fully initialized instance
         """
-        d = _get_defaults()
+        d, given = _get_defaults(), set()
         with open(path) as f:
             for i, line in enumerate(f, 1):
                 line = line.strip()
@@ -246,19 +469,17 @@ class MECPCalculation(object):
                     print('Malformed line #{}: {}'.format(i, line))
                     sys.exit()
                 key, value = fields[0], fields[1].strip()
-                if key not in DEFAULTS:
+                if key not in d:
                     print('! Skipping key `{}` (not recognized)'.format(key))
                     continue
-                if key in ('natom', 'max_steps'):
-                    value = int(value)
-                elif key in ('TDE', 'TDXMax', 'TDXRMS', 'TGMax', 'TGRMS'):
-                    value = fortran_double(value, key)
-                elif key in ('a_header', 'b_header', 'footer', 'geom'):
-                    if not os.path.isfile(value):
-                        print('! `{}` file with path `{}` not available!'.format(key, value))
-                        sys.exit()
-                d[key] = value
+                d[key] = coerce_option(key, value)
+                given.add(key)
         d.update(kw)
+        # Input files are relative to the working directory of the calculation
+        for key in ('a_header', 'b_header', 'footer', 'geom'):
+            if key in given and not os.path.isfile(os.path.join(d['workdir'], d[key])):
+                print('! `{}` file with path `{}` not available!'.format(key, d[key]))
+                sys.exit()
         return cls(**d)
 
     @classmethod
@@ -309,80 +530,88 @@ class MECPCalculation(object):
         Note how the first line is a special comment that specifies the maximum number of steps.
         Values that would differ between both spin states are specified with curly braces. Namely,
         the name of the ``.chk`` file, the first word in the title card, and the multiplicity itself.
+        With more than two values per group (``1 {1,3,5}``), one header is written for each
+        state and ``states`` lists them all. ONIOM inputs use the ``oniom`` energy parser
+        unless another one is given. The fragments (``_header_a``, ``_initial_geom``...)
+        and a ``.conf`` file with the options are written in ``workdir``.
         """
-        def _process_header_line(line):
-            match = re.search(r'{(.*),(.*)}', line)
-            if match:
-                return (line.replace(match.group(0), match.group(1)),
-                        line.replace(match.group(0), match.group(2)))
-            return line, line
-
-        d = _get_defaults()
-        section = 0
-        header_a, header_b, geom, footer = [], [], None, []
-        # Parse Gaussian input files into header(s), geometry and footer
         with open(path) as f:
-            for line in f:
-                # Detect sections
-                if not line.strip():
-                    section += 1
-
-                # Assign lines to sections
-                # <HEADER>
-                if section <= 1:
-                    line_a, line_b = _process_header_line(line)
-                    header_a.append(line_a)
-                    header_b.append(line_b)
-                elif section == 2:
-                    if not line.strip():
-                        header_a.append(line)
-                        header_b.append(line)
-                    elif geom is None:
-                        line_a, line_b = _process_header_line(line)
-                        header_a.append(line_a)
-                        header_b.append(line_b)
-                        geom = []
-                # </HEADER>
-                # <GEOM>
-                    else:
-                        # Everything above is part of the header
-                        geom.append(line)
-                # </GEOM>
-                # <FOOTER>
-                elif section >= 3:
-                    footer.append(line)
-                #</FOOTER>
-
-                # Detect special comments
-                if line.startswith('!'):
-                    match = re.search(r'^! easymecp:?\s+(\S+)\s*=(\S+)', line)
-                    if match:
-                        key = match.group(1)
-                        value = match.group(2)
-                        if key == 'max_steps':
-                            d[key] = int(value)
-                        elif key == 'with_freq':
-                            d[key] = value.lower() in ('true', 'yes', 'y')
-                        elif key in ('TDE', 'TDXMax', 'TDXRMS', 'TGMax', 'TGRMS'):
-                            d[key] = fortran_double(value, key)
-
-        # Write temporary files
-        d['a_header'] = '_header_a'
-        d['b_header'] = '_header_b'
+            d, headers, geom, footer = _split_gaussian_input(f)
+
+        # Write temporary files, in the working directory of the calculation
+        workdir = kw.get('workdir', d['workdir'])
+        if workdir and not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        header_files = ['_header_' + chr(ord('a') + i) for i in range(len(headers))]
+        d['a_header'], d['b_header'] = header_files[:2]
+        if len(headers) > 2:
+            d['states'] = ','.join(header_files)
         d['geom'] = '_initial_geom'
         d['footer'] = '_footer'
-        for filepath, lines in (('_header_a', header_a), ('_header_b', header_b),
-                                ('_initial_geom', geom), ('_footer', footer)):
+        for filepath, lines in (list(zip(header_files, headers)) +
+                                [('_initial_geom', geom), ('_footer', footer)]):
             if lines:
-                with open(filepath, 'w') as f:
+                with open(os.path.join(workdir, filepath), 'w') as f:
                     f.writelines(lines)
-        with open(os.path.splitext(os.path.basename(path))[0] + '.conf', 'w') as f:
+        with open(os.path.join(workdir, os.path.splitext(os.path.basename(path))[0] + '.conf'),
+                  'w') as f:
             f.write('\n'.join('{}: {}'.format(k, v) for (k,v) in d.items()))
 
         # If additional keywords are passed to this classmethod, override infile ones.
         d.update(**kw)
         return cls(**d)
 
+    @classmethod
+    def from_gaussian_input(cls, text, **kw):
+        """
+        Like ``from_gaussian_input_file``, for the contents of a single Gaussian
+        input file. Nothing is written until the calculation runs (see
+        ``from_strings``).
+        """
+        d, headers, geom, footer = _split_gaussian_input(text.splitlines(True))
+        if not geom:
+            raise ValueError('No geometry found in the Gaussian input')
+        for key in ('a_header', 'b_header', 'states', 'geom', 'footer'):
+            del d[key]
+        d.update(**kw)
+        return cls.from_strings([''.join(lines) for lines in headers], ''.join(geom),
+                                ''.join(footer), **d)
+
+    @classmethod
+    def from_strings(cls, headers, geom, footer='', **kw):
+        """
+        Initialize a calculation from the contents of its input files, which are
+        kept in memory: no intermediate files are written. Together with a
+        different ``workdir`` for each one, this allows running many calculations
+        concurrently in one process (in threads, for example).
+
+        Additional keyword arguments are passed to the class.
+
+        Parameters
+        ----------
+        headers : list of str
+            Header lines (% lines, route, title, charge and multiplicity) of each
+            state, like the contents of ``a_header`` and ``b_header``. With more
+            than two, ``states`` lists them all.
+        geom : str
+            Gaussian-formatted geometry
+        footer : str, optional
+            Lines placed after the geometry
+
+        Returns
+        -------
+        mecp : MECPCalculation
+            Fully initialized instance
+        """
+        names = ['<header_{}>'.format(chr(ord('a') + i)) for i in range(len(headers))]
+        inputs = dict(zip(names, headers))
+        inputs.update({'<geom>': geom, '<footer>': footer or ''})
+        kw.update(a_header=names[0], b_header=names[1], geom='<geom>', footer='<footer>',
+                  inputs=inputs)
+        if len(headers) > 2:
+            kw['states'] = ','.join(names)
+        return cls(**kw)
+
     ####################################################################################
     #
     # Program flow
@@ -403,14 +632,112 @@ class MECPCalculation(object):
         'MAX_ITERATIONS_REACHED' : str
             Calculation did not converge in the allowed number of iterations.
         """
-        # Recompile Fortran code
         print('Running easyMECP v{}...'.format(__version__))
-        print('Preparing workspace...')
-        self.prepare_workspace()
-        print('Compiling MECP for {} atoms...'.format(self.natom))
+        if self._journal is not None:
+            start, geom = self._journal['step'], self._journal['geom']
+            print('Resuming from step #{}...'.format(start))
+            self._resumed_step = start
+            if self.optimizer is not None and self._journal['optimizer']:
+                self.restore_optimizer(self._journal['optimizer'], self.workdir)
+            if self._journal.get('pair'):
+                self.set_pair(tuple(self._journal['pair']))
+        else:
+            if self.warm_start:
+                print('Starting from {}...'.format(self.warm_start))
+                self.geom = self.load_warm_start(self.warm_start)
+            if self.point_group is not None:
+                self.geom = self.write_geometry(
+                    self.point_group.symmetrize_geometry(self.read_geometry(self.geom)[1]),
+                    '_symmetric_geom')
+            start, geom = 0, self.geom
+        if self.point_group is not None:
+            print('Point group: {}'.format(self.point_group.name))
+        # Neither MECP.x nor the workspace are needed until the first Gaussian jobs finish
+        self.start_setup(fresh=self._journal is None)
+
+        # Run-level data for `easymecp status`
+        store = StepStore(self.path(os.path.join(self.jobsdir, 'steps')), natom=self.natom)
+        store.set_attributes(started=time.time(), pid=os.getpid(), result=None,
+                             host=os.uname()[1] if hasattr(os, 'uname') else '',
+                             max_steps=self.max_steps, thresholds=self.thresholds)
+        self.update_index()
+        result = None
+        try:
+            result = self._run_steps(start, geom)
+            return result
+        finally:
+            if self._setup is not None:
+                self._setup.join()
+            if result is not None:
+                StepStore(store.path).set_attributes(result=result)
+                self.update_index()
+            self.cleanup_scratch()
+            if self._archiver is not None:
+                self._archiver.join()
+
+    def start_setup(self, fresh=True):
+        """
+        Prepare the workspace (``ProgFile``, ``ReportFile`` and the first frame of
+        the trajectory; only if ``fresh``) and compile MECP.x in a background
+        thread, so they overlap with the Gaussian jobs of the first step. Errors
+        are raised by ``wait_for_setup`` (and end the run with ERROR).
+        """
+        def setup():
+            try:
+                try:
+                    if fresh:
+                        print('Preparing workspace...')
+                        self.prepare_workspace()
+                    if fresh and self.point_group is not None:
+                        self.report('Point group: {} ({} operations, tolerance {} A)'.format(
+                                    self.point_group.name, len(self.point_group.operations),
+                                    self.symmetry_tolerance))
+                finally:
+                    self._workspace_ready.set()
+                if self.optimizer is None:
+                    print('Compiling MECP for {} atoms...'.format(self.natom))
+                    self.mecp_exe = self.compile_fortran()
+            except Exception as e:
+                print('! Could not prepare the calculation:', e.__class__.__name__, '->', e,
+                      file=sys.stderr)
+                self._setup_error = e
+
+        self._workspace_ready.clear()
+        self._setup_error = None
+        self._setup = threading.Thread(target=setup)
+        self._setup.daemon = True
+        self._setup.start()
+
+    def wait_for_workspace(self):
+        """
+        Wait until ``start_setup`` has written ``ProgFile`` and ``ReportFile``.
+        """
+        if self._setup is not None and self._setup is not threading.current_thread():
+            self._workspace_ready.wait()
 
-        geom = self.geom
-        for i in range(self.max_steps):
+    def wait_for_setup(self):
+        """
+        Wait for ``start_setup`` to finish and raise its error, if any.
+        """
+        if self._setup is not None:
+            self._setup.join()
+        if self._setup_error is not None:
+            raise self._setup_error
+
+    @property
+    def thresholds(self):
+        """
+        Convergence thresholds by the name of the criterion in ``StepStore``.
+        """
+        return {'max_gradient': _to_float(self.TGMax), 'rms_gradient': _to_float(self.TGRMS),
+                'max_displacement': _to_float(self.TDXMax),
+                'rms_displacement': _to_float(self.TDXRMS), 'delta_e': _to_float(self.TDE)}
+
+    def _run_steps(self, start, geom):
+        """
+        Iterations of ``run``, from step ``start`` and geometry ``geom``.
+        """
+        for i in range(start, self.max_steps):
             result = self.do_iteration(geom, i)
             if result is self.ERROR:
                 return self.ERROR
@@ -456,33 +783,107 @@ class MECPCalculation(object):
         """
         # First, run Gaussian jobs
         print('Running step #{}...'.format(step))
-        print('  Launching Gaussian job for file A...')
-        try:
-            input_a = self.prepare_gaussian(self.a_header, geom, self.footer, label='A', step=step)
-        except ValueError as e:
-            print('  ! Error during input file preparation:', e)
-            return self.ERROR
-        logfile_a = self.run_gaussian(input_a)
-        energy_a, gradients_a = self.parse_energy_and_gradients(logfile_a)
-        print('  Launching Gaussian job for file B...')
+        self._timings = {'step': time.time()}
+        phases = self.journal_phases(step)
+        if 'optimizer' in phases:
+            print('  Step already finished.')
+            return self.OK
+        if 'inputs' not in phases:
+            self.journal(step, geom, 'inputs')
+        results, outcomes, todo = {}, {}, []
+        for label, header in zip(self.labels, self.states):
+            if label in phases:
+                print('  Reusing Gaussian job for file {}...'.format(label))
+                results[label] = self.parse_energy_and_gradients(phases[label])
+            else:
+                todo.append((label, header))
+
+        def run_state(label, header, share=1):
+            start = time.time()
+            try:
+                outcomes[label] = self.run_state(header, geom, label=label, step=step,
+                                                 share=share)
+            except ValueError as e:
+                outcomes[label] = e
+            self._timings[label] = time.time() - start
+
+        # With more than two states, all their jobs run at the same time
+        if (len(self.states) > 2 and len(todo) > 1 and not self.serial_states and
+                self._independent_checkpoints(self.states)):
+            print('  Launching Gaussian jobs for files {}...'.format(
+                  ', '.join(label for (label, _) in todo)))
+            for label, _ in todo:
+                self.job_directory(label)  # create scratch folders before the threads
+            threads = [threading.Thread(target=run_state, args=(label, header, len(todo)))
+                       for (label, header) in todo]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            for label, header in todo:
+                print('  Launching Gaussian job for file {}...'.format(label))
+                run_state(label, header)
+                if isinstance(outcomes[label], ValueError):
+                    break
+        for label, _ in todo:
+            if isinstance(outcomes[label], ValueError):
+                print('  ! Error during input file preparation:', outcomes[label])
+                return self.ERROR
+            logfile, energy, gradients = outcomes[label]
+            results[label] = energy, gradients
+            if energy is not None and gradients:
+                self.journal(step, geom, label, logfile)
+
+        if self.point_group is not None:
+            for label, (energy, gradients) in list(results.items()):
+                if gradients:
+                    results[label] = energy, self.symmetrize_forces(gradients)
+
+        # Second, run MECP on the pair of states being optimized
         try:
-            input_b = self.prepare_gaussian(self.b_header, geom, self.footer, label='B', step=step)
-        except ValueError as e:
-            print('  ! Error during input file preparation:', e)
+            self.wait_for_setup()
+        except Exception:  # printed by the setup thread
+            self.report('ERROR')
             return self.ERROR
-        logfile_b = self.run_gaussian(input_b)
-        energy_b, gradients_b = self.parse_energy_and_gradients(logfile_b)
-
-        # Second, run MECP
+        self.restore_optimizer_files(step)
+        previous = self.pair_labels
+        if len(self.states) > 2 and all(results[label][0] is not None for label in self.labels):
+            self.set_pair(self.select_pair(dict((label, results[label][0])
+                                                for label in self.labels)))
+            self.report('Energies of all states: {} (optimizing {})'.format(
+                        ', '.join('{} = {}'.format(label, results[label][0])
+                                  for label in self.labels), ','.join(self.pair_labels)))
+        label_a, label_b = self.pair_labels
+        energy_a, gradients_a = results[label_a]
+        energy_b, gradients_b = results[label_b]
         if not self.prepare_ab_initio(energy_a, energy_b, gradients_a, gradients_b):
             return self.ERROR
+        if self.pair_labels != previous:
+            print('  Switching to the crossing between states {} and {}...'.format(
+                  label_a, label_b))
+            self.reset_optimizer(geom)
+        coordinates = self.read_geometry(geom)[1]
+        report_offset = os.path.getsize(self.path('ReportFile'))
+        if self.optimizer is not None:
+            result = self.run_python_optimizer(geom, step, energy_a, energy_b,
+                                               gradients_a, gradients_b)
+            if result is self.OK:
+                self.record_step(step, coordinates, energy_a, energy_b, gradients_a,
+                                 gradients_b, report_offset)
+                self.journal(step, geom, 'optimizer')
+                if self.archive:
+                    self.archive_step(step)
+            return result
         print('  Launching MECP...')
         try:
-            retcode = call([self.mecp_exe], stdout=sys.stdout, stderr=sys.stderr)
-            if os.path.isfile('AddtoReportFile'):  # this file is generated by MECP.x
-                with open('AddtoReportFile') as f:
+            retcode = call([self.mecp_exe], cwd=self.workdir, stdout=sys.stdout,
+                           stderr=sys.stderr)
+            addto = self.path('AddtoReportFile')  # this file is generated by MECP.x
+            if os.path.isfile(addto):
+                with open(addto) as f:
                     self.report(f.read())
-                os.remove('AddtoReportFile')
+                os.remove(addto)
             if retcode:
                 raise SubprocessError('MECP returned code {}'.format(retcode))
         except Exception as e:
@@ -490,16 +891,92 @@ class MECPCalculation(object):
             self.report('ERROR')
             return self.ERROR
         else:
+            if self.point_group is not None:
+                self.symmetrize_next_geometry()
             self.add_trajectory_step(geom, step=step)
+            self.record_step(step, coordinates, energy_a, energy_b, gradients_a,
+                             gradients_b, report_offset)
+            self.journal(step, geom, 'optimizer')
+            if self.archive:
+                self.archive_step(step)
 
         return self.OK
 
+    def symmetrize_forces(self, gradients):
+        """
+        Project the forces of a state (as returned by ``parse_energy_and_gradients``)
+        onto the point group of the starting geometry, removing the numerical noise
+        that would break the symmetry.
+        """
+        forces = self.point_group.symmetrize([float(v) for fields in gradients
+                                              for v in fields[1:4]])
+        return [[fields[0]] + [repr(v) for v in forces[3*i:3*i+3]]
+                for (i, fields) in enumerate(gradients)]
+
+    def symmetrize_next_geometry(self):
+        """
+        Symmetrize the next geometry written by MECP.x, both in ``geom`` and in
+        ``ProgFile``, so its BFGS steps do not accumulate symmetry-breaking noise.
+        """
+        with open(self.path('ProgFile')) as f:
+            lines = f.read().splitlines()
+        starts = [i for (i, line) in enumerate(lines) if 'Next Geometry to Compute' in line]
+        if not starts:  # converged in the first step: nothing new to compute
+            return
+        start = starts[0] + 1
+        numbers, x = parse_geometry(line + '\n' for line in lines[start:start + self.natom])
+        x = self.point_group.symmetrize_geometry(x)
+        lines[start:start + self.natom] = _format_atoms(numbers, x, '{:3d}' + '{:20.12f}' * 3)
+        with open(self.path('ProgFile'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        if os.path.isfile(self.path('geom')):
+            with open(self.path('geom'), 'w') as f:
+                f.write('\n'.join(_format_atoms(numbers, x, '{:4d}' + '{:14.8f}' * 3)))
+                f.write('\n\n')
+
+    def set_pair(self, labels):
+        """
+        Optimize the crossing between the states with ``labels`` (like ``('A', 'C')``),
+        which become ``a_header`` and ``b_header``.
+        """
+        self.pair_labels = tuple(labels)
+        self.a_header, self.b_header = [self.states[self.labels.index(label)]
+                                        for label in labels]
+
+    def select_pair(self, energies):
+        """
+        Pair of states to optimize, given the energies of all of them (dict by label)
+        at the current geometry. With ``pair='lowest'``, the two lowest states. The
+        current pair is kept until another state lies more than ``TDE`` below its upper
+        state, so near-degeneracies do not switch back and forth.
+        """
+        if self.pair != 'lowest':
+            return self.pair_labels
+        upper = max(energies[label] for label in self.pair_labels)
+        if all(energies[label] > upper - _to_float(self.TDE) for label in self.labels
+               if label not in self.pair_labels):
+            return self.pair_labels
+        return tuple(sorted(sorted(self.labels, key=energies.get)[:2]))
+
+    def reset_optimizer(self, geom):
+        """
+        Start the optimization again from ``geom``, discarding the Hessian update
+        history; used when the optimized pair of states changes.
+        """
+        if self.optimizer is not None:
+            self.optimizer = self._new_optimizer()
+        else:
+            self.write_progfile(geom)
+
     def do_freq(self, geom):
         """
         When the MECP is found, it is common to perform a frequency analysis and
         find the average vibrations. This method does it for you. You can enable
         it automatically by setting ``with_freq=True`` at initialization.
 
+        Both jobs run concurrently, each one with half of the ``%nproc`` and ``%mem``
+        resources, unless they share a chk file or ``serial_freq=True``.
+
         Parameters
         ----------
         geom : str
@@ -513,13 +990,21 @@ class MECPCalculation(object):
             Frequencies could not be obtained
         """
         print('Running frequency analysis...')
-        print('  Launching Gaussian job for file A...')
-        input_a = self.prepare_gaussian(self.a_header, geom, self.footer, label='A', step='_freq')
-        logfile_a = self.run_gaussian(input_a)
+        parallel = not self.serial_freq and self._independent_checkpoints()
+        share = 2 if parallel else 1
+        input_a = self.prepare_gaussian(self.a_header, geom, self.footer, label='A',
+                                        step='_freq', share=share)
+        input_b = self.prepare_gaussian(self.b_header, geom, self.footer, label='B',
+                                        step='_freq', share=share)
+        if parallel:
+            print('  Launching Gaussian jobs for files A and B...')
+            logfile_a, logfile_b = self.run_gaussian_jobs([input_a, input_b])
+        else:
+            print('  Launching Gaussian job for file A...')
+            logfile_a = self.run_gaussian(input_a)
+            print('  Launching Gaussian job for file B...')
+            logfile_b = self.run_gaussian(input_b)
         energy_a, freq_a = self.parse_free_energy_and_frequencies(logfile_a)
-        print('  Launching Gaussian job for file B...')
-        input_b = self.prepare_gaussian(self.b_header, geom, self.footer, label='B', step='_freq')
-        logfile_b = self.run_gaussian(input_b)
         energy_b, freq_b = self.parse_free_energy_and_frequencies(logfile_b)
         if not all((energy_a, energy_b, freq_a, freq_b)):
             return self.ERROR
@@ -531,6 +1016,180 @@ class MECPCalculation(object):
         self.report('Avg sum of electronic and thermal Free Energies for both states', (energy_a + energy_b) / 2, 'Ha')
         return self.OK
 
+    ####################################################################################
+    #
+    # Journal helpers
+    #
+    ####################################################################################
+
+    def journal(self, step, geom, phase, value=True):
+        """
+        Record that ``phase`` of ``step`` is done, so an interrupted calculation can
+        be resumed with ``resume=True`` without repeating finished Gaussian jobs.
+        Phases are ``inputs``, ``A`` and ``B`` (paths to their logfiles) and
+        ``optimizer``. The journal is replaced atomically.
+
+        When the inputs are prepared, ``ProgFile``, ``geom`` and the sizes of
+        ``ReportFile``, the trajectory and the per-step store are saved too, so a
+        crash in the middle of MECP.x or the Python optimizer, or before its phase
+        is recorded, can be rolled back by ``restore_optimizer_files``. After the ``optimizer`` phase,
+        the state of the Python optimizer is stored (``get_state``; its inverse
+        Hessian in a binary ``easymecp.journal.<step>.hessian`` file, replaced at
+        every step) and the journal moves on to the next step.
+        """
+        if self._journal is None or self._journal['step'] != step:
+            self._journal = {'jobsdir': self.jobsdir, 'step': step, 'geom': geom,
+                             'phases': {}, 'optimizer': None, 'report_size': None}
+        previous = None
+        if phase == 'inputs':
+            self.wait_for_workspace()
+            shutil.copyfile(self.path('ProgFile'), self.path(self.JOURNAL + '.ProgFile'))
+            self._journal['report_size'] = os.path.getsize(self.path('ReportFile'))
+            # The optimizer overwrites geom and appends to the trajectory and the store
+            self._journal['saved_geom'] = os.path.isfile(self.path('geom'))
+            if self._journal['saved_geom']:
+                shutil.copyfile(self.path('geom'), self.path(self.JOURNAL + '.geom'))
+            trajectory = self.path(os.path.join(self.jobsdir, 'trajectory.xyz'))
+            self._journal['trajectory_size'] = (os.path.getsize(trajectory)
+                                                if os.path.isfile(trajectory) else 0)
+            self._journal['stored_steps'] = len(StepStore(
+                self.path(os.path.join(self.jobsdir, 'steps')), natom=self.natom))
+        self._journal['phases'][phase] = value
+        if phase == 'optimizer':
+            if self.optimizer is not None:
+                previous = (self._journal['optimizer'] or {}).get('inverse_hessian')
+                state = self.optimizer.get_state()
+                if self.optimizer.inverse_hessian is not None:
+                    name = '{}.{}.hessian'.format(self.JOURNAL, step)
+                    state['inverse_hessian'] = write_inverse_hessian(
+                        self.optimizer.inverse_hessian, self.path(name))
+                    state['inverse_hessian']['file'] = name
+                self._journal['optimizer'] = state
+            self._journal['pair'] = self.pair_labels
+            self._journal.update(step=step + 1, geom='geom', phases={}, report_size=None)
+        tmp = self.path(self.JOURNAL + '.tmp')
+        with open(tmp, 'w') as f:
+            # json.dumps uses the C encoder, unlike json.dump; this matters for the
+            # optimizer state of large systems
+            f.write(json.dumps(self._journal))
+            f.flush()
+            os.fsync(f.fileno())
+        getattr(os, 'replace', os.rename)(tmp, self.path(self.JOURNAL))
+        current = (self._journal['optimizer'] or {}).get('inverse_hessian')
+        if (isinstance(previous, dict) and 'file' in previous and
+                not (isinstance(current, dict) and current.get('file') == previous['file'])):
+            try:
+                os.remove(self.path(previous['file']))
+            except OSError:
+                pass
+
+    def journal_phases(self, step):
+        """
+        Phases of ``step`` already recorded in the journal.
+        """
+        if self._journal is None or self._journal['step'] != step:
+            return {}
+        return self._journal['phases']
+
+    def restore_optimizer_files(self, step):
+        """
+        If the optimizer of the resumed ``step`` was interrupted, restore
+        ``ProgFile``, ``geom``, ``ReportFile``, the trajectory and the per-step
+        store to their state before it started.
+        """
+        if step != self._resumed_step or self._journal['report_size'] is None:
+            return
+        if os.path.isfile(self.path(self.JOURNAL + '.ProgFile')):
+            shutil.copyfile(self.path(self.JOURNAL + '.ProgFile'), self.path('ProgFile'))
+        if self._journal.get('saved_geom'):
+            shutil.copyfile(self.path(self.JOURNAL + '.geom'), self.path('geom'))
+        with open(self.path('ReportFile'), 'a') as f:
+            f.truncate(self._journal['report_size'])
+        trajectory = self.path(os.path.join(self.jobsdir, 'trajectory.xyz'))
+        if 'trajectory_size' in self._journal and os.path.isfile(trajectory):
+            with open(trajectory, 'a') as f:
+                f.truncate(self._journal['trajectory_size'])
+        if 'stored_steps' in self._journal:
+            StepStore(self.path(os.path.join(self.jobsdir, 'steps')),
+                      natom=self.natom).truncate(self._journal['stored_steps'])
+
+    ####################################################################################
+    #
+    # Archive helpers
+    #
+    ####################################################################################
+
+    def record_step(self, step, coordinates, energy_a, energy_b, gradients_a, gradients_b,
+                    report_offset=None):
+        """
+        Append the data of a finished step to the per-step store (``JOBS/steps``),
+        next to ``trajectory.xyz``: geometry, energies, forces, the effective,
+        parallel and perpendicular gradients (Hartree/Angstrom, as in MECP.x)
+        and the convergence criteria reported from ``report_offset`` on, plus
+        the wall times of the step and of the Gaussian jobs of each state.
+        """
+        forces_a = [float(v) for fields in gradients_a for v in fields[1:4]]
+        forces_b = [float(v) for fields in gradients_b for v in fields[1:4]]
+        par, perp, g = effective_gradient_components(
+            energy_a, energy_b, [-f / BOHR for f in forces_a], [-f / BOHR for f in forces_b])
+        criteria = {}
+        if report_offset is not None:
+            with open(self.path('ReportFile')) as f:
+                f.seek(report_offset)
+                criteria = parse_criteria(f.read())
+        now = time.time()
+        timings = self._timings
+        store = StepStore(self.path(os.path.join(self.jobsdir, 'steps')), natom=self.natom)
+        store.append(step=step, coordinates=coordinates, energy_a=energy_a, energy_b=energy_b,
+                     forces_a=forces_a, forces_b=forces_b, gradient=g, parallel_gradient=par,
+                     perpendicular_gradient=perp, time=now,
+                     step_seconds=now - timings.get('step', now),
+                     gaussian_seconds_a=timings.get(self.pair_labels[0]),
+                     gaussian_seconds_b=timings.get(self.pair_labels[1]), **criteria)
+        self.update_index()
+
+    def update_index(self):
+        """
+        Replace the rows of this run in the SQLite run index (``index`` option),
+        if any. Errors are reported but do not stop the calculation.
+        """
+        if not self.index:
+            return
+        try:
+            RunIndex(self.path(self.index)).add_run(
+                self.workdir, store=self.path(os.path.join(self.jobsdir, 'steps')))
+        except Exception as e:
+            print('  ! Could not update the run index {}: {}'.format(self.index, e))
+
+    def archive_step(self, step):
+        """
+        Compress the Gaussian outputs of a finished step in a background thread.
+        If ``keep_logs`` is set, only the outputs of the last ``keep_logs`` steps
+        are kept. Parsers read the compressed outputs transparently.
+        """
+        # Each thread waits for the previous one, so files are handled in order
+        self._archiver = threading.Thread(target=self._archive_logs,
+                                          args=(self._archiver, step))
+        self._archiver.daemon = True
+        self._archiver.start()
+
+    def _archive_logs(self, previous, step):
+        if previous is not None:
+            previous.join()
+        pattern = re.compile(r'^Job(\d+)_.*\.(log|out|fchk)(\.gz)?$')
+        for name in sorted(os.listdir(self.path(self.jobsdir))):
+            match = pattern.match(name)
+            if not match or int(match.group(1)) > step:
+                continue
+            path = self.path(os.path.join(self.jobsdir, name))
+            try:
+                if self.keep_logs and int(match.group(1)) <= step - self.keep_logs:
+                    os.remove(path)
+                elif not match.group(3):
+                    compress_file(path)
+            except (IOError, OSError) as e:
+                print('  ! Could not archive', path, '->', e)
+
     ####################################################################################
     #
     # Fortran MECP helpers
@@ -547,18 +1206,29 @@ class MECPCalculation(object):
         and ``FFLAGS``, respectively. Number of atoms at threshold values for convergence
         too.
 
+        If ``compile_cache`` is set, binaries are kept there, keyed by source code and
+        compiler settings, and reused instead of compiling again.
+
         Returns
         -------
         path : str
-            Path to the freshly compiled Fortran program (``./MECP.x``)
+            Path to the freshly compiled Fortran program (``./MECP.x``, in ``workdir``)
         """
+        # Patch source code
+        code = MECP_FORTRAN.format(NUMATOM=self.natom, TDE=self.TDE, TDXMax=self.TDXMax,
+                                   TDXRMS=self.TDXRMS, TGMax=self.TGMax, TGRMS=self.TGRMS)
+        cached = None
+        if self.compile_cache:
+            key = hashlib.sha1('\0'.join([code, self.FC, self.FFLAGS]).encode()).hexdigest()
+            cached = os.path.join(self.compile_cache, 'MECP-{}.x'.format(key[:16]))
+            if os.path.isfile(cached):
+                shutil.copyfile(cached, self.path('MECP.x'))
+                os.chmod(self.path('MECP.x'), os.stat(self.path('MECP.x')).st_mode | 0o111)
+                return './MECP.x'
         with temporary_directory(enter=False) as tmp:
-            # Patch source code
-            code = MECP_FORTRAN.format(NUMATOM=self.natom, TDE=self.TDE, TDXMax=self.TDXMax,
-                                       TDXRMS=self.TDXRMS, TGMax=self.TGMax, TGRMS=self.TGRMS)
             with open(os.path.join(tmp, 'MECP.f'), 'w') as f:
                 f.write(code)
-            with open('_fortran_compilation', 'w') as out:
+            with open(self.path('_fortran_compilation'), 'w') as out:
                 try:
                     call([self.FC] +
                          shlex.split(self.FFLAGS) +
@@ -571,23 +1241,120 @@ class MECPCalculation(object):
                 except SubprocessError:
                     print('! Fortran compilation did not succeed. Check logs and '
                           '`FFLAGS={}` value.'.format(self.FFLAGS), file=sys.stderr)
-            shutil.copyfile(os.path.join(tmp, 'MECP.x'), 'MECP.x')
-        os.chmod('MECP.x', os.stat('MECP.x').st_mode | 0o111)  # make executable
+            shutil.copyfile(os.path.join(tmp, 'MECP.x'), self.path('MECP.x'))
+        # make executable
+        os.chmod(self.path('MECP.x'), os.stat(self.path('MECP.x')).st_mode | 0o111)
+        if cached:
+            if not os.path.isdir(self.compile_cache):
+                os.makedirs(self.compile_cache)
+            tmp = '{}.{}.tmp'.format(cached, os.getpid())
+            shutil.copyfile(self.path('MECP.x'), tmp)
+            os.rename(tmp, cached)  # atomic: other jobs may be reading it
         return './MECP.x'
 
+    def run_python_optimizer(self, geom, step, energy_a, energy_b, gradients_a, gradients_b):
+        """
+        Python counterpart of the MECP.x call in ``do_iteration``. The optimizer
+        writes ``geom``, ``ProgFile`` and the ``ReportFile`` block just like MECP.x.
+
+        Returns
+        -------
+        'OK' : str
+            Step performed correctly
+        'ERROR' : str
+            The optimizer could not compute the next geometry
+        """
+        print('  Launching Python optimizer...')
+        try:
+            numbers, x = self.read_geometry(geom)
+            forces_a = [float(v) for fields in gradients_a for v in fields[1:4]]
+            forces_b = [float(v) for fields in gradients_b for v in fields[1:4]]
+            new_x, converged, report = self.optimizer.step(numbers, x, energy_a, energy_b,
+                                                           forces_a, forces_b)
+            self.report(report)
+            if self.point_group is not None:
+                new_x = self.point_group.symmetrize_geometry(new_x)
+            if not converged:
+                self.optimizer.write_geom(self.path('geom'), numbers, new_x)
+                self.optimizer.write_progfile(self.path('ProgFile'), numbers, new_x)
+        except Exception as e:
+            print('  ! Error during MECP optimization:', e.__class__.__name__, '->', e)
+            self.report('ERROR')
+            return self.ERROR
+        else:
+            self.add_trajectory_step(geom, step=step)
+        return self.OK
+
+    def load_warm_start(self, directory):
+        """
+        Take the last geometry computed by the calculation in ``directory`` (same
+        system), its chk files (if ours do not exist yet) and, with the Python
+        optimizers, its inverse Hessian, as a starting point.
+
+        Returns
+        -------
+        geom : str
+            Path to the new starting geometry (``_warm_start_geom``)
+        """
+        store = latest_step_store(self.path(directory))
+        if store is None or not len(store):
+            raise ValueError('{} has no computed steps to start from'.format(directory))
+        if store.natom != self.natom:
+            raise ValueError('{} has {} atoms, not {}'.format(directory, store.natom, self.natom))
+        geom = self.write_geometry(store.read('coordinates')[-1], '_warm_start_geom')
+        for header in (self.a_header, self.b_header):
+            chk = re.search(r'^%chk=(.*)$', self.read_input(header),
+                            flags=re.IGNORECASE|re.MULTILINE)
+            if chk and not os.path.isabs(chk.group(1).strip()):
+                source = os.path.join(self.path(directory), chk.group(1).strip())
+                if os.path.isfile(source) and not os.path.exists(self.path(chk.group(1).strip())):
+                    shutil.copyfile(source, self.path(chk.group(1).strip()))
+        if self.optimizer is not None:
+            try:
+                with open(os.path.join(self.path(directory), self.JOURNAL)) as f:
+                    state = json.load(f)['optimizer'] or {}
+            except (IOError, OSError, ValueError, KeyError):
+                state = {}
+            if state.get('inverse_hessian') and state.get('internal') == self.optimizer.internal:
+                self.restore_optimizer({'inverse_hessian': state['inverse_hessian'],
+                                        'internals': state.get('internals')},
+                                       self.path(directory))
+        return geom
+
+    def restore_optimizer(self, state, directory):
+        """
+        Restore the state of the Python optimizer journaled in ``directory``
+        (see ``journal``), inverse Hessian included.
+        """
+        self.optimizer.set_state(state)
+        ihessian = state.get('inverse_hessian')
+        if isinstance(ihessian, dict) and 'file' in ihessian:
+            ihessian = read_inverse_hessian(os.path.join(directory, ihessian['file']), ihessian)
+        if ihessian:  # journals of older versions keep it inline
+            self.optimizer.inverse_hessian = ihessian
+
+    def write_geometry(self, coordinates, path):
+        """
+        Write flattened ``coordinates`` to ``path`` as a geometry file, keeping the
+        symbols, freeze flags and ONIOM specifications of ``geom``.
+        """
+        atoms = [line.split() for line in self.read_input(self.geom).splitlines()
+                 if len(line.split()) >= 4 and not line.startswith('!')]
+        with open(self.path(path), 'w') as f:
+            for i, fields in enumerate(atoms):
+                k = _coordinates_index(fields)
+                print(_format_atom_line(fields[:k], coordinates[3*i:3*i+3], fields[k + 3:]),
+                      file=f)
+        return path
+
     def prepare_workspace(self):
         """
         Prepare some of the files expected by MECP.x in its first run,
         ProgFile and ReportFile.
 
         """
-        with open(self.geom) as f:
-            geometry = element_symbol_to_number(f)
-        with open('ProgFile', 'w') as f:
-            f.seek(0)
-            f.write(PROGFILE.format(natom=self.natom, geometry=geometry))
-            f.truncate()
-        with open('ReportFile', 'w') as f:
+        self.write_progfile(self.geom)
+        with open(self.path('ReportFile'), 'w') as f:
             f.seek(0)
             f.write('{}\n'.format(datetime.now()))
             f.truncate()
@@ -595,6 +1362,14 @@ class MECPCalculation(object):
         self.add_trajectory_step(self.geom, step=0)
 
 
+    def write_progfile(self, geom):
+        """
+        Write a ProgFile for the first MECP.x step, at geometry ``geom``.
+        """
+        geometry = element_symbol_to_number(self.read_input(geom).splitlines(True))
+        with open(self.path('ProgFile'), 'w') as f:
+            f.write(PROGFILE.format(natom=self.natom, geometry=geometry))
+
     def prepare_ab_initio(self, energy_a, energy_b, gradients_a, gradients_b):
         """
         MECP.x expects a file named 'ab_initio' containing the energy and gradients
@@ -615,15 +1390,14 @@ class MECPCalculation(object):
         if not all(x is not None for x in (energy_a, energy_b, gradients_a, gradients_b)):
             print('  ! Some energies or gradients could not be obtained!')
             return False
-        with open('ab_initio', 'w') as f:
-            print('Energy of the First State', file=f)
-            print(energy_a, file=f)
-            print('Gradient of the First State' , file=f)
-            print('\n'.join(['{}  {}   {}   {}'.format(*l) for l in gradients_a]), file=f)
-            print('Energy of the Second State' , file=f)
-            print(energy_b, file=f)
-            print('Gradient of the Second State' , file=f)
-            print('\n'.join(['{}  {}   {}   {}'.format(*l) for l in gradients_b]), file=f)
+        def _block(gradients):
+            return '\n'.join(['  '.join(map(str, l)) for l in gradients])
+
+        with open(self.path('ab_initio'), 'w') as f:
+            f.write('\n'.join(['Energy of the First State', str(energy_a),
+                               'Gradient of the First State', _block(gradients_a),
+                               'Energy of the Second State', str(energy_b),
+                               'Gradient of the Second State', _block(gradients_b), '']))
         return True
 
     def check_current_iteration(self):
@@ -642,7 +1416,7 @@ class MECPCalculation(object):
             Still not converged. Calculation must continue.
         """
          # Check results in this iteration
-        with open('ReportFile') as f:
+        with open(self.path('ReportFile')) as f:
             for line in f:
                 if 'CONVERGED' in line:
                     return self.OK
@@ -655,7 +1429,45 @@ class MECPCalculation(object):
     #
     ####################################################################################
 
-    def run_gaussian(self, inputfile):
+    def run_state(self, header, geom, label='A', step=0, share=1):
+        """
+        Run the Gaussian job of one state and parse its energy and gradients.
+        If it fails (SCF convergence failure, watchdog timeout, missing results),
+        it is retried following ``retry_ladder``: attempt number ``n`` applies the
+        first ``n`` strategies of the ladder to the header. ``share`` is passed to
+        ``prepare_gaussian``.
+
+        Returns
+        -------
+        logfile : str or None
+            Path to the output of the last attempt
+        energy : float or None
+        gradients : list or None
+        """
+        attempts = [self.retry_ladder[:n] for n in range(len(self.retry_ladder) + 1)]
+        for n, retry in enumerate(attempts):
+            last = n == len(attempts) - 1
+            if retry:
+                print('  Retrying Gaussian job for file {} with: {}'.format(label, ' '.join(retry)))
+            sublabel = '{}_retry{}'.format(label, n) if n else label
+            inputfile = self.prepare_gaussian(header, geom, self.footer, label=sublabel, step=step,
+                                              retry=retry, share=share)
+            logfile = self.run_gaussian(inputfile, report_errors=last)
+            if logfile is None:
+                energy, gradients = None, None
+                continue
+            if self.numerical_gradients:
+                logfile = self.run_numerical_gradients(logfile, header, geom,
+                                                       label=sublabel, step=step)
+            elif self.results_from == 'fchk' and os.path.dirname(logfile) == self.jobsdir:
+                # only successful jobs are moved to jobsdir; failed ones left a stale chk
+                self.run_formchk(logfile, label=sublabel)
+            energy, gradients = self.parse_energy_and_gradients(logfile, report_errors=last)
+            if energy is not None and gradients:
+                break
+        return logfile, energy, gradients
+
+    def run_gaussian(self, inputfile, report_errors=True):
         """
         Runs a Gaussian calculation. Define Gaussian executable with ``gaussian_exe``
         at initialization.
@@ -664,33 +1476,144 @@ class MECPCalculation(object):
         ---------
         inputfile : str
             Path to a valid Gaussian input file
+        report_errors : bool
+            Write ERROR to ReportFile if the job fails, which ends the calculation
 
         Returns
         -------
         logfile : str
             Path to the resulting Gaussian output
         """
+        return self.run_gaussian_jobs([inputfile], report_errors=report_errors)[0]
+
+    def run_gaussian_jobs(self, inputfiles, report_errors=True):
+        """
+        Runs several Gaussian calculations concurrently and waits for all of them.
+        Jobs that exceed ``job_timeout`` or whose output does not grow for
+        ``stall_timeout`` seconds are killed.
+
+        Parameters
+        ---------
+        inputfiles : list of str
+            Paths to valid Gaussian input files
+        report_errors : bool
+            Write ERROR to ReportFile if any job fails
+
+        Returns
+        -------
+        logfiles : list of str
+            Paths to the resulting Gaussian outputs, in the same order
+        """
+        watchdog = self.job_timeout or self.stall_timeout
+        kwargs = {}
+        if watchdog and os.name == 'posix':
+            # Own session, so the watchdog can kill the Gaussian links with their driver.
+            # They no longer get Ctrl-C from the terminal: whatever is still running
+            # when we leave (KeyboardInterrupt, SIGTERM -> SystemExit) is killed below.
+            if sys.version_info[0] >= 3:
+                kwargs['start_new_session'] = True
+            else:
+                kwargs['preexec_fn'] = os.setsid
+        processes = []
+        for inputfile in inputfiles:
+            workdir = self.job_directory(inputfile)
+            try:
+                if workdir != self.workdir:
+                    shutil.copyfile(self.path(inputfile),
+                                    os.path.join(workdir, os.path.basename(inputfile)))
+                    kwargs['env'] = dict(os.environ, GAUSS_SCRDIR=os.path.abspath(workdir))
+                processes.append(Popen([self.gaussian_exe, os.path.basename(inputfile)],
+                                       cwd=workdir, stdout=sys.stdout, stderr=sys.stderr,
+                                       **kwargs))
+            except Exception as e:
+                processes.append(e)
+        try:
+            if watchdog:
+                self._watch_gaussian(inputfiles, processes)
+            return [self._finish_gaussian(inputfile, process, report_errors=report_errors)
+                    for (inputfile, process) in zip(inputfiles, processes)]
+        finally:
+            if watchdog:
+                for process in processes:
+                    if not isinstance(process, Exception) and process.poll() is None:
+                        self._kill_gaussian(process)
+
+    def _watch_gaussian(self, inputfiles, processes):
+        """
+        Poll running Gaussian processes and kill those that exceed ``job_timeout``
+        or whose logfile has not grown in ``stall_timeout`` seconds.
+        """
+        start = time.time()
+        sizes = dict((i, (-1, start)) for i in range(len(processes)))
+        while True:
+            running = [i for (i, p) in enumerate(processes)
+                       if not isinstance(p, Exception) and p.poll() is None]
+            if not running:
+                return
+            now = time.time()
+            for i in running:
+                base = os.path.join(self.job_directory(inputfiles[i]),
+                                    os.path.splitext(os.path.basename(inputfiles[i]))[0])
+                size = max(os.path.getsize(base + ext) if os.path.isfile(base + ext) else 0
+                           for ext in ('.log', '.out'))
+                if size != sizes[i][0]:
+                    sizes[i] = size, now
+                reason = None
+                if self.job_timeout and now - start > self.job_timeout:
+                    reason = 'running for more than {} s'.format(self.job_timeout)
+                elif self.stall_timeout and now - sizes[i][1] > self.stall_timeout:
+                    reason = 'no output for more than {} s'.format(self.stall_timeout)
+                if reason:
+                    print('  ! Killing Gaussian job', inputfiles[i], '->', reason)
+                    self._kill_gaussian(processes[i])
+            time.sleep(self.WATCHDOG_INTERVAL)
+
+    @staticmethod
+    def _kill_gaussian(process):
+        """
+        Kill a Gaussian ``process`` started by ``run_gaussian_jobs`` with a watchdog,
+        and on POSIX the links in its process group.
+        """
+        try:
+            if os.name == 'posix':
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            pass
+
+    def _finish_gaussian(self, inputfile, process, report_errors=True):
+        """
+        Wait for a Gaussian ``process`` (or the exception raised when launching it)
+        and move its input and output files to the JOBS directory.
+        """
         LOGFILE_EXTENSIONS = '.log', '.out'
         logfile = None
         try:
-            retcode = call([self.gaussian_exe, inputfile], stdout=sys.stdout, stderr=sys.stderr)
+            if isinstance(process, Exception):
+                raise process
+            retcode = process.wait()
             if retcode:
                 raise SubprocessError('Gaussian returned code {}'.format(retcode))
         except Exception as e:
+            self._fetch_logfile(inputfile, LOGFILE_EXTENSIONS)
             print('  ! Could not run Gaussian job', inputfile)
             print('  !', e.__class__.__name__, '->', e)
-            self.report('ERROR')
+            if report_errors:
+                self.report('ERROR')
             for EXT in LOGFILE_EXTENSIONS:
                 logfile = os.path.splitext(inputfile)[0] + EXT
-                if os.path.isfile(logfile):
+                if os.path.isfile(self.path(logfile)):
                     return logfile
+            logfile = None
         else:
+            self._fetch_logfile(inputfile, LOGFILE_EXTENSIONS)
             inputfilebase = os.path.basename(inputfile)
-            os.rename(inputfile, os.path.join(self.jobsdir, inputfilebase))
+            os.rename(self.path(inputfile), self.path(os.path.join(self.jobsdir, inputfilebase)))
             for EXT in LOGFILE_EXTENSIONS:
                 try:
                     logfile = os.path.join(self.jobsdir, os.path.splitext(inputfilebase)[0] + EXT)
-                    os.rename(os.path.splitext(inputfile)[0] + EXT, logfile)
+                    os.rename(self.path(os.path.splitext(inputfile)[0] + EXT), self.path(logfile))
                 except Exception as e:
                     continue
                 else:
@@ -700,16 +1623,190 @@ class MECPCalculation(object):
 
         return logfile
 
-    def prepare_gaussian(self, header, geom, footer, label='A', step=0):
+    def _fetch_logfile(self, inputfile, extensions):
+        """
+        Move the output of a job that ran in scratch next to its input file.
+        """
+        workdir = self.job_directory(inputfile)
+        if workdir == self.workdir:
+            return
+        base = os.path.splitext(os.path.basename(inputfile))[0]
+        for ext in extensions:
+            path = os.path.join(workdir, base + ext)
+            if os.path.isfile(path):
+                shutil.move(path, self.path(os.path.splitext(inputfile)[0] + ext))
+        try:
+            os.remove(os.path.join(workdir, os.path.basename(inputfile)))
+        except OSError:
+            pass
+
+    def run_formchk(self, logfile, label='A'):
+        """
+        Convert the chk file of a finished job to a formatted checkpoint next to
+        its output (``Job{step}_{label}.fchk``), where ``parse_energy_and_gradients``
+        reads the results from with ``results_from='fchk'``.
+
+        Returns
+        -------
+        fchk : str or None
+            Path to the formatted checkpoint. None if it could not be created.
+        """
+        base = os.path.splitext(logfile)[0]
+        with open(self.path(base + '.gjf')) as f:
+            chk = re.search(r'^%chk=(.*)$', f.read(), flags=re.IGNORECASE|re.MULTILINE)
+        if not (chk and chk.group(1).strip()):
+            print('  ! No %chk in', base + '.gjf', '-> reading results from the output')
+            return None
+        chk = os.path.join(self.job_directory(label), chk.group(1).strip())
+        try:
+            with open(os.devnull, 'w') as devnull:
+                retcode = call([self.formchk_exe, chk, self.path(base + '.fchk')],
+                               stdout=devnull, stderr=sys.stderr)
+            if retcode:
+                raise SubprocessError('formchk returned code {}'.format(retcode))
+        except Exception as e:
+            print('  ! Could not run formchk on', chk, '->', e.__class__.__name__, '->', e)
+            return None
+        return base + '.fchk'
+
+    def job_directory(self, name):
+        """
+        Directory where the Gaussian jobs of a state run, given the state label
+        or the input filename (``Job{step}_{label}.gjf``). Without ``scratch_dir``,
+        it is ``workdir``. Otherwise, each state gets its own
+        directory under a temporary folder in ``scratch_dir``, which is also its
+        ``GAUSS_SCRDIR`` and keeps its chk file between steps.
+        """
+        if not self.scratch_dir:
+            return self.workdir
+        match = re.match(r'^Job(?:\d+|_freq)_(.*)\.\w+$', os.path.basename(name))
+        state = (match.group(1) if match else name).split('_')[0]
+        if self._scratch is None:
+            self._scratch = mkdtemp(prefix='easymecp_', dir=self.scratch_dir)
+        path = os.path.join(self._scratch, state)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def cleanup_scratch(self):
+        """
+        Remove the scratch directories, including the chk and ``Gau-*`` files
+        left there by Gaussian.
+        """
+        if self._scratch is not None:
+            shutil.rmtree(self._scratch, ignore_errors=True)
+            self._scratch = None
+
+    def run_numerical_gradients(self, logfile, header, geom, label='A', step=0):
+        """
+        Obtain the gradients of a state by finite differences of the energy, for
+        methods without analytic forces. Displaced single points (6N with
+        ``numerical_gradients='central'``, 3N with ``'forward'``; frozen atoms are
+        not displaced) run in batches of ``numerical_jobs`` concurrent jobs, each
+        one with its own copy of the chk file of the reference job.
+
+        Parameters
+        ----------
+        logfile : str
+            Path to the Gaussian output of the reference single point
+        header : str
+            Path to the header lines of this state
+        geom : str
+            Path to the reference geometry
+        label : str
+            State identifier
+        step : int
+            Number of iterations so far
+
+        Returns
+        -------
+        logfile : str
+            Path to the reference output, with a ``Center Atomic Forces`` block
+            appended so it can be parsed like an analytic gradient job. If the
+            reference energy could not be parsed, it is returned untouched.
+        """
+        energy = self.parse_energy_and_gradients(logfile)[0]
+        if energy is None:
+            return logfile
+        numbers, x = self.read_geometry(geom)
+        signs = (1, -1) if self.numerical_gradients == 'central' else (1,)
+        jobs = []
+        for i in range(3 * self.natom):
+            if i // 3 in self.frozen:
+                continue
+            for sign in signs:
+                sublabel = '{}_d{}{}'.format(label, i + 1, 'p' if sign > 0 else 'm')
+                displaced = list(x)
+                displaced[i] += sign * self.numerical_step
+                geomfile = 'Job{}_{}.geom'.format(step, sublabel)
+                with open(self.path(geomfile), 'w') as f:
+                    f.write('\n'.join(_format_atoms(numbers, displaced,
+                                                    '{:4d}' + '{:20.12f}' * 3)))
+                    f.write('\n')
+                jobs.append((i, sign, sublabel, geomfile))
+        print('    Running {} displaced single points for state {}...'.format(len(jobs), label))
+        energies = {}
+        batch = max(1, self.numerical_jobs)
+        for start in range(0, len(jobs), batch):
+            chunk = jobs[start:start+batch]
+            inputs, chks = [], []
+            for (i, sign, sublabel, geomfile) in chunk:
+                chk = 'Job{}_{}.chk'.format(step, sublabel)
+                inputs.append(self.prepare_gaussian(header, geomfile, self.footer, label=sublabel,
+                                                    step=step, share=len(chunk), chk=chk))
+                chks.append(chk)
+            logfiles = self.run_gaussian_jobs(inputs)
+            for (i, sign, _, geomfile), chk, log in zip(chunk, chks, logfiles):
+                energies[i, sign] = self.parse_energy_and_gradients(log)[0] if log else None
+                for path in (os.path.join(self.job_directory(label), chk), self.path(geomfile)):
+                    if os.path.isfile(path):
+                        os.remove(path)
+        if any(e is None for e in energies.values()):
+            print('  ! Some displaced single points did not finish correctly!')
+            return logfile
+        forces = [0.0] * (3 * self.natom)
+        for i in range(3 * self.natom):
+            if (i, 1) not in energies:
+                continue
+            if self.numerical_gradients == 'central':
+                gradient = (energies[i, 1] - energies[i, -1]) / (2 * self.numerical_step)
+            else:
+                gradient = (energies[i, 1] - energy) / self.numerical_step
+            forces[i] = -gradient * BOHR  # Hartree/Angstrom -> Hartree/Bohr
+        with open(self.path(logfile), 'a') as f:
+            f.write(' Numerical gradients ({}, step {} Angstrom)\n'.format(
+                    self.numerical_gradients, self.numerical_step))
+            f.write(' ' + '-' * 67 + '\n')
+            f.write(' Center     Atomic                   Forces (Hartrees/Bohr)\n')
+            f.write(' Number     Number              X              Y              Z\n')
+            f.write(' ' + '-' * 67 + '\n')
+            for n, line in enumerate(_format_atoms(numbers, forces, '{:9d}' + '{:15.9f}' * 3)):
+                f.write(' {:6d}{}\n'.format(n + 1, line))
+            f.write(' ' + '-' * 67 + '\n')
+        return logfile
+
+    def prepare_gaussian(self, header, geom, footer, label='A', step=0, share=1, chk=None,
+                         retry=()):
         """
         Prepares a Gaussian input file from its fragments: header, geometry
         and footer. This method patches the header lines depending on
         the context:
 
-        -   If it's the first iteration, a ``%chk`` line is defined, but
-            the chkfile does not exist yet and ``guess=read`` is set,
-            remove the guess=read keyword to prevent errors.
-        -   If it's the last step (freq), replace ``force`` with ``freq``.
+        -   If a ``%chk`` line is defined, but the chkfile does not exist
+            (yet; e.g. first iteration) and ``guess=read`` is set, remove
+            the guess=read keyword to prevent errors.
+        -   If it's the last step (freq), replace ``force`` with ``freq``. If the
+            chkfile of the last step is available, the wavefunction and geometry
+            are read from there (``guess=read geom=check``).
+        -   If ``share`` is greater than 1, ``%nproc`` and ``%mem`` are divided
+            so that many jobs can run at the same time.
+        -   If ``chk`` is given, the job uses that chkfile instead, starting
+            from a copy of the original one.
+        -   Retry strategies in ``retry`` are applied to the route in order.
+        -   With ``results_from='fchk'``, ``nosymm`` is added so the gradients in
+            the chk file are in the input orientation.
+        -   With ONIOM geometries, the atom types, charges, layers and link atoms
+            of the initial geometry are written next to the new coordinates.
 
         Parameters
         ----------
@@ -726,23 +1823,45 @@ class MECPCalculation(object):
         step : int or str
             Number of iterations so far or, if already converged and with_freq = True,
             '_freq'.
+        share : int
+            Number of jobs that will share the resources in the header.
+        chk : str, optional
+            Private chkfile for this job.
+        retry : list of str
+            Route modifications: ``keyword[=options]`` adds (or replaces) a keyword
+            and ``-keyword`` removes it.
 
         """
         name = 'Job{}_{}.gjf'.format(step, label)
-        with open(name, 'w') as f:
-            with open(header) as a:
-                contents = self._check_force(a.read(), freq=step == '_freq')
-                if not step:
-                    contents = self._check_guess_read(contents)
-                f.write(contents.rstrip())
+        geom_from_chk = False
+        workdir = self.job_directory(label)
+        with open(self.path(name), 'w') as f:
+            contents = self._check_force(self.read_input(header), freq=step == '_freq')
+            if chk is not None:
+                contents = self._private_checkpoint(contents, chk, workdir=workdir)
+            for strategy in retry:
+                contents = self._apply_retry_strategy(contents, strategy)
+            if self.results_from == 'fchk' and step != '_freq':
+                contents = self._check_nosymm(contents)
+            if step == '_freq':
+                contents, geom_from_chk = self._check_checkpoint(contents, workdir=workdir)
+            else:
+                contents = self._check_guess_read(contents, workdir=workdir)
+            contents = self._split_resources(contents, share)
+            f.write(contents.rstrip())
             f.write('\n')
-            with open(geom) as b:
-                contents = element_symbol_to_number(b, drop_blank=True)
+            if not geom_from_chk and self.oniom_atoms:
+                # Layers, atom types and charges are taken from the initial geometry
+                x = self.read_geometry(geom)[1]
+                f.write('\n'.join(_format_atom_line(prefix, x[3*i:3*i+3], suffix)
+                                  for (i, (prefix, suffix)) in enumerate(self.oniom_atoms)))
+            elif not geom_from_chk:
+                contents = element_symbol_to_number(self.read_input(geom).splitlines(True),
+                                                    drop_blank=True)
                 f.write(contents.rstrip())
             f.write('\n\n')
             try:
-                with open(footer) as c:
-                    f.write(c.read().lstrip())
+                f.write(self.read_input(footer).lstrip())
             except IOError:
                pass
             f.write('\n\n')  # Gaussian is picky about file endings...
@@ -756,7 +1875,8 @@ class MECPCalculation(object):
 
     def _check_force(self, contents, freq=False):
         """
-        Checks if the header lines contain the force keyword.
+        Checks if the header lines contain the force keyword. With numerical
+        gradients, ``force`` is not needed and it is removed if present.
 
         Parameters
         ----------
@@ -771,13 +1891,29 @@ class MECPCalculation(object):
             Patched lines if freq=True, original lines otherwise.
         """
         force = re.search(r'^#.*(force).*', contents, flags=re.IGNORECASE|re.MULTILINE)
+        if self.numerical_gradients:
+            if force and force.group(1):
+                contents = contents.replace(force.group(1), ' freq=projected ' if freq else ' ')
+            elif freq:
+                route = re.search(r'^#.*$', contents, flags=re.MULTILINE).group(0)
+                contents = contents.replace(route, route + ' freq=projected', 1)
+            return contents
         if not force or not force.group(1):
             raise ValueError('Header lines must include `force` keyword.')
         elif freq:
             contents = contents.replace(force.group(1), ' freq=projected ')
         return contents
 
-    def _check_guess_read(self, contents):
+    def _check_nosymm(self, contents):
+        """
+        Add ``nosymm`` to the route unless symmetry is already turned off.
+        """
+        route = re.search(r'^#.*$', contents, flags=re.MULTILINE).group(0)
+        if re.search(r'nosym|symm\w*=\(?\s*(none|off)', route, flags=re.IGNORECASE):
+            return contents
+        return contents.replace(route, route + ' nosymm', 1)
+
+    def _check_guess_read(self, contents, workdir=os.curdir):
         """
         Some jobs might include guess=read options to use the chk files, but
         the first job might not have any chk available yet. We have to get rid
@@ -787,6 +1923,8 @@ class MECPCalculation(object):
         ----------
         contents : str
             Contents of the input file header
+        workdir : str
+            Directory where the job will run
 
         Returns
         -------
@@ -794,7 +1932,8 @@ class MECPCalculation(object):
             Patched contents with 'read' keyword removed, if necessary.
         """
         chk = re.search(r'^%chk=(.*)$', contents, flags=re.IGNORECASE|re.MULTILINE)
-        chk_exists = chk and chk.group(1) and os.path.isfile(chk.group(1).strip())
+        chk_exists = (chk and chk.group(1) and
+                      os.path.isfile(os.path.join(workdir, chk.group(1).strip())))
         if not chk_exists:
             guess = re.search(r'^#.*(guess[=(]{1,2}([^\s)]*)\)?)', contents,
                                 flags=re.IGNORECASE|re.MULTILINE)
@@ -806,39 +1945,164 @@ class MECPCalculation(object):
                     contents = contents.replace(guess.group(1), '')
         return contents
 
-    ####################################################################################
-    #
-    # Output data helpers
-    #
-    ####################################################################################
-
-    def parse_energy_and_gradients(self, logfile):
+    def _apply_retry_strategy(self, contents, strategy):
         """
-        Extract potential energy and gradients from a Gaussian output file
+        Modify the route of a header after a failed job. ``keyword[=options]``
+        replaces any previous ``keyword`` (or adds it) and ``-keyword`` removes it.
+        For example, ``scf=xqc`` or ``-guess``.
 
         Parameters
         ----------
-        logfile : str
-            Path to the Gaussian output file
+        contents : str
+            Contents of the input file header
+        strategy : str
+            Retry strategy
 
         Returns
         -------
-        energy : float or None
-            Potential energy as parsed with self._parse_energy, which
-            is set dynamically at initialization. None if it could not be
-            found.
-        gradients : list of float, or None
-            Force gradient for each atom in geometry. None if they could
-            not be found.
+        contents : str
+            Patched contents
+        """
+        route = re.search(r'^#.*$', contents, flags=re.MULTILINE).group(0)
+        keyword = re.split(r'[=(]', strategy.lstrip('-'))[0]
+        existing = re.search(r'(?<![\w/-])' + re.escape(keyword) +
+                             r'(=\([^)]*\)|=\S*|\([^)]*\))?(?![\w])', route, flags=re.IGNORECASE)
+        if strategy.startswith('-'):
+            patched = route.replace(existing.group(0), '') if existing else route
+        elif existing:
+            patched = route.replace(existing.group(0), strategy)
+        else:
+            patched = route + ' ' + strategy
+        return contents.replace(route, patched, 1)
+
+    def _private_checkpoint(self, contents, path, workdir=os.curdir):
+        """
+        Replace the ``%chk`` file in the header with ``path``, copying the original
+        chkfile there if it exists, so concurrent jobs do not overwrite each other.
+        """
+        chk = re.search(r'^%chk=(.*)$', contents, flags=re.IGNORECASE|re.MULTILINE)
+        if not chk:
+            return contents
+        original = os.path.join(workdir, chk.group(1).strip())
+        if chk.group(1) and os.path.isfile(original):
+            shutil.copyfile(original, os.path.join(workdir, path))
+        return contents.replace(chk.group(0), '%chk=' + path, 1)
+
+    def _check_checkpoint(self, contents, workdir=os.curdir):
+        """
+        Frequency jobs can start from the converged wavefunction and geometry
+        stored in the chk file of the last step, if available.
+
+        Parameters
+        ----------
+        contents : str
+            Contents of the input file header
+        workdir : str
+            Directory where the job will run
+
+        Returns
+        -------
+        contents : str
+            Patched contents with ``guess=read`` and ``geom=check``, if possible.
+        geom_from_chk : bool
+            Whether the geometry will be read from the chk file, so it must not
+            be written in the input file.
+        """
+        chk = re.search(r'^%chk=(.*)$', contents, flags=re.IGNORECASE|re.MULTILINE)
+        if not (chk and chk.group(1) and
+                os.path.isfile(os.path.join(workdir, chk.group(1).strip()))):
+            return contents, False
+        route = re.search(r'^#.*$', contents, flags=re.IGNORECASE|re.MULTILINE).group(0)
+        patched = route
+        if not re.search(r'guess[=(]', route, flags=re.IGNORECASE):
+            patched += ' guess=read'
+        geom_from_chk = not re.search(r'geom[=(]', route, flags=re.IGNORECASE)
+        if geom_from_chk:
+            patched += ' geom=check'
+        return contents.replace(route, patched, 1), geom_from_chk
+
+    def _split_resources(self, contents, share):
+        """
+        Divide ``%nproc(shared)`` and ``%mem`` values by ``share``, so several
+        jobs can run concurrently with the resources meant for one.
+        """
+        if share <= 1:
+            return contents
+
+        def nproc(match):
+            return '{}{}'.format(match.group(1), max(1, int(match.group(2)) // share))
+
+        def mem(match):
+            value, unit = int(match.group(2)), match.group(3)
+            units = ['kb', 'mb', 'gb', 'tb'] if unit.lower().endswith('b') else ['kw', 'mw', 'gw', 'tw']
+            if unit.lower() in units:
+                index = units.index(unit.lower())
+                while index and value % share:
+                    value, index = value * 1024, index - 1
+                unit = units[index].upper()
+            return '{}{}{}'.format(match.group(1), max(1, value // share), unit)
+
+        contents = re.sub(r'^(%nproc(?:shared)?=\s*)(\d+)', nproc, contents,
+                          flags=re.IGNORECASE|re.MULTILINE)
+        contents = re.sub(r'^(%mem=\s*)(\d+)(\w*)', mem, contents,
+                          flags=re.IGNORECASE|re.MULTILINE)
+        return contents
+
+    def _independent_checkpoints(self, headers=None):
+        """
+        Whether the jobs for both states (or those of ``headers``) can run at the
+        same time: they must not write to the same chk file.
+        """
+        chks = []
+        for header in headers or (self.a_header, self.b_header):
+            chk = re.search(r'^%chk=(.*)$', self.read_input(header),
+                            flags=re.IGNORECASE|re.MULTILINE)
+            if chk:
+                chks.append(chk.group(1).strip())
+        return len(chks) == len(set(chks))
+
+    ####################################################################################
+    #
+    # Output data helpers
+    #
+    ####################################################################################
+
+    def parse_energy_and_gradients(self, logfile, report_errors=True):
+        """
+        Extract potential energy and gradients from a Gaussian output file or,
+        with ``results_from='fchk'``, from the formatted checkpoint next to it,
+        if available.
+
+        Parameters
+        ----------
+        logfile : str
+            Path to the Gaussian output file
+        report_errors : bool
+            Write ERROR to ReportFile on convergence failures
+
+        Returns
+        -------
+        energy : float or None
+            Potential energy as parsed with self._parse_energy, which
+            is set dynamically at initialization. None if it could not be
+            found.
+        gradients : list of float, or None
+            Force gradient for each atom in geometry. None if they could
+            not be found.
         """
+        if self.results_from == 'fchk':
+            fchk = os.path.splitext(logfile)[0] + '.fchk'
+            if os.path.isfile(self.path(fchk)) or os.path.isfile(self.path(fchk + '.gz')):
+                return self.parse_fchk_energy_and_gradients(fchk)
         energy = None
         gradients = []
-        with open(logfile) as f:
+        with open_log(self.path(logfile)) as f:
             for line in f:
                 fields = line.split()
                 if 'Convergence failure' in line:
                     print('  ! There has been a convergence problem in', logfile)
-                    self.report('ERROR')
+                    if report_errors:
+                        self.report('ERROR')
                     return None, None
                 # gradients
                 gradients = self._parse_gradients(f, line, fields, default=gradients)
@@ -846,72 +2110,3134 @@ class MECPCalculation(object):
                 energy = self._parse_energy(f, line, fields, default=energy)
         return energy, gradients
 
-    def _parse_gradients(self, f, line, fields, default=None):
-        if len(fields) > 2 and fields[0] == 'Center' and fields[1] == 'Atomic' and fields[2] == 'Forces':
-            gradients = []
-            next(f), next(f)  # skip two lines
-            for _ in range(self.natom):
-                line = next(f)
-                gradients.append(line.split()[1:5])
-            return gradients
-        return default
+    def parse_fchk_energy_and_gradients(self, fchk):
+        """
+        Extract the total energy and gradients (with full precision) from a
+        formatted checkpoint file. Gradients are returned as forces, like in
+        Gaussian outputs.
+        """
+        fields = read_fchk(self.path(fchk),
+                           ('Atomic numbers', 'Total Energy', 'Cartesian Gradient'))
+        if 'Total Energy' not in fields or 'Cartesian Gradient' not in fields:
+            print('  ! Could not find energy and gradients in', fchk)
+            return None, None
+        gradient = fields['Cartesian Gradient']
+        gradients = [[str(z)] + [repr(-g) for g in gradient[3 * i:3 * i + 3]]
+                     for (i, z) in enumerate(fields['Atomic numbers'])]
+        return fields['Total Energy'], gradients
+
+    def _parse_gradients(self, f, line, fields, default=None):
+        if len(fields) > 2 and fields[0] == 'Center' and fields[1] == 'Atomic' and fields[2] == 'Forces':
+            next(f), next(f)  # skip two lines
+            # Read the whole block at once; it has thousands of lines in ONIOM systems
+            return [line.split()[1:5] for line in islice(f, self.natom)]
+        return default
+
+    def parse_free_energy_and_frequencies(self, logfile):
+        """
+        Extract vibrational frequencies from a Gaussian output file
+
+        Parameters
+        ----------
+        logfile : str
+            Path to the Gaussian output file
+
+        Returns
+        -------
+        frequencies : list of float, or None
+            Vibration frequencies of system. None if they could
+            not be found.
+
+        Notes
+        -----
+
+        Partially inspired by ``cclib.parser.gaussianparser``.
+        """
+        energy, frequencies = None, None
+        with open_log(self.path(logfile)) as f:
+            for line in f:
+                if line[1:14] == "Harmonic freq":  # enter the frequency block
+                    frequencies = []
+                    while line.strip():
+                        if line[1:15] == "Frequencies --":
+                            frequencies.extend([float(x) for x in line[15:].split()])
+                        line = next(f)
+                elif line[1:44] == "Sum of electronic and thermal Free Energies":
+                    energy = float(line.split()[-1])
+        return energy, frequencies
+
+    def report(self, *msg):
+        """
+        Print wrapper to write into `ReportFile`.
+        """
+        self.wait_for_workspace()
+        with open(self.path('ReportFile'), 'a') as r:
+            print(*msg, file=r)
+
+    def add_trajectory_step(self, geometry='geom', step=0):
+        """
+        Add a new step to the current trajectory file, in xyz format.
+
+        Parameters
+        ----------
+        geometry : str
+            Path to XYZ file containing new geometry
+        step : int
+            Optimization step
+        """
+        with open(self.path(os.path.join(self.jobsdir, 'trajectory.xyz')), 'a') as f:
+            print(self.natom, file=f)
+            print('Step', step, file=f)
+            print(element_number_to_symbol(self.read_input(geometry).splitlines(True),
+                                           drop_blank=True), file=f)
+
+
+########################################################################################
+# Python optimizers
+########################################################################################
+class MECPOptimizer(object):
+
+    """
+    Pure-Python port of Harvey's MECP.x (``Effective_Gradient``, ``UpdateX`` and
+    ``TestConvergence``). It is used instead of the Fortran program when a feature
+    that MECP.x does not provide is requested, like the adaptive trust radius.
+
+    The files it produces (``geom``, ``ProgFile`` and the ``ReportFile`` blocks)
+    follow the same format as those written by MECP.x, so both paths can be
+    combined in restarts.
+
+    This class also serves as the base for alternative algorithms. Subclasses
+    define a ``name`` (used by the ``algorithm`` option) and override ``gradient``
+    (the objective the BFGS steps follow), ``search_direction`` and the trust
+    radius model (``actual_change``, ``predicted_change``) as needed. Convergence
+    is always tested with the same five criteria on Harvey's effective gradient.
+
+    Parameters
+    ----------
+    natom : int
+        Number of atoms in the system
+    TDE, TDXMax, TDXRMS, TGMax, TGRMS : float or str
+        Convergence thresholds. Fortran doubles (``5.d-5``) are accepted too.
+    trust_radius : float, optional
+        Initial trust radius, in Angstrom. If zero, steps are capped like
+        MECP.x does (fixed ``STPMX``). Otherwise, the maximum step length is
+        adapted with the ratio between the actual and the predicted change of
+        the effective objective (energy difference + parallel energy), and
+        steps that make it worse are rejected and retried from the previous
+        geometry with a smaller radius.
+    gdiis_threshold : float, optional
+        If the maximum element of the effective gradient falls below this value,
+        steps are extrapolated with GDIIS over the last ``gdiis_history``
+        geometries and effective gradients. Zero disables it.
+    gdiis_history : int, optional
+        Number of previous geometries used in the GDIIS extrapolation.
+    frozen : list of int, optional
+        0-based indices of atoms that must not move. Their coordinates are left
+        out of the optimization entirely (BFGS update and inverse Hessian).
+    constraints : list of (str, tuple of int, float or None), optional
+        Geometric constraints, as returned by ``parse_constraints``. Gradients and
+        steps are projected onto the constraint surface and each new geometry is
+        corrected iteratively to match the targets. If a target is None, the
+        value at the first geometry is kept.
+    coordinates : {'cartesian', 'internal'}, optional
+        Coordinates used for the steps. With ``internal``, a redundant set of
+        bonds, angles and dihedrals is generated from the first geometry;
+        gradients are transformed with the Wilson B matrix and steps are
+        back-transformed iteratively. Geometries and convergence criteria
+        remain cartesian.
+    basis : list of list of float, optional
+        Orthonormal cartesian vectors (like ``PointGroup.basis``) spanning the only
+        displacements allowed. Coordinates along them replace the cartesians in
+        the optimization (and frozen atoms must be left out of them already).
+    surrogate : {'', 'gek'}, optional
+        With ``gek``, the energies and gradients of the last ``SURROGATE_HISTORY``
+        geometries are fitted with a ``GEKSurrogate`` per state, and the step
+        goes to the MECP of the models (``surrogate_step``) instead of following
+        the quasi-Newton direction, as far as the models can be trusted.
+    surrogate_tolerance : float, optional
+        Energy error (Hartree) accepted from the models: both in the prediction of
+        the geometry just computed (otherwise this step falls back to the usual
+        one) and as the standard deviation of the predictions along the step.
+    lbfgs_memory : int, optional
+        If not zero, the inverse Hessian is not stored as a dense matrix, but as
+        the initial diagonal and the last ``lbfgs_memory`` BFGS updates (L-BFGS),
+        so memory and time per step grow linearly with the number of atoms.
+
+    Notes
+    -----
+    Energies are expected in Hartree, forces in Hartree/Bohr (as printed by
+    Gaussian) and geometries in Angstrom. Like MECP.x, gradients are handled
+    internally in Hartree/Angstrom.
+    """
+
+    name = 'harvey'
+    facPP = 140.0
+    facP = 1.0
+    STPMX = 0.1
+    TRUST_MIN = 0.005
+    TRUST_MAX = 1.0
+    SURROGATE_HISTORY = 10
+    SURROGATE_ITERATIONS = 100
+    SURROGATE_MAX_STEP = 0.5  # Angstrom, norm of the whole step
+    # Attributes that change along the optimization (see ``get_state``)
+    STATE = ('nstep', 'ratio', 'rejected', 'trust_radius', 'gdiis_vectors', 'history',
+             'samples', 'surrogate_prediction', 'surrogate_scale', 'surrogate_status', 'x',
+             'reference', 'energies', 'gradients', 'parallel_gradient', 'effective_gradient',
+             'predicted', 'internals')
+
+    def __init__(self, natom, TDE=5e-5, TDXMax=4e-3, TDXRMS=2.5e-3, TGMax=7e-4,
+                 TGRMS=5e-4, trust_radius=0.0, gdiis_threshold=0.0, gdiis_history=4,
+                 frozen=(), constraints=(), coordinates='cartesian', basis=None,
+                 surrogate='', surrogate_tolerance=1e-3, lbfgs_memory=0):
+        if coordinates not in ('cartesian', 'internal'):
+            raise ValueError('coordinates must be cartesian or internal')
+        if surrogate not in ('', 'gek'):
+            raise ValueError('surrogate must be gek')
+        if surrogate and coordinates != 'cartesian':
+            raise ValueError('surrogate steps need cartesian coordinates')
+        self.internal = coordinates == 'internal'
+        self.internals = None
+        self.natom = natom
+        self.frozen = sorted(set(frozen))
+        self.active = [3 * i + k for i in range(natom) if i not in self.frozen for k in range(3)]
+        self.basis = basis
+        self.nx = len(basis) if basis else len(self.active)
+        self.constraints = [[kind, tuple(atoms), target] for (kind, atoms, target) in constraints]
+        self.TDE = _to_float(TDE)
+        self.TDXMax = _to_float(TDXMax)
+        self.TDXRMS = _to_float(TDXRMS)
+        self.TGMax = _to_float(TGMax)
+        self.TGRMS = _to_float(TGRMS)
+        self.trust_radius = float(trust_radius)
+        self.gdiis_threshold = float(gdiis_threshold)
+        self.gdiis_history = int(gdiis_history)
+        self.surrogate = surrogate
+        self.surrogate_tolerance = float(surrogate_tolerance)
+        self.lbfgs_memory = int(lbfgs_memory)
+        self.nstep = 0
+        self.ratio = None
+        self.rejected = False
+        self.gdiis_vectors = 0
+        self.history = []
+        # Energies and gradients of the last geometries computed, for the surrogates,
+        # what they predicted for the next geometry, to validate them, and the factor
+        # their standard deviations are scaled by to cover the last errors
+        self.samples = []
+        self.surrogate_prediction = None
+        self.surrogate_scale = 1.0
+        self.surrogate_status = None
+        # Data at the last accepted geometry
+        self.x = None
+        self.energies = None
+        self.gradients = None
+        self.parallel_gradient = None
+        self.effective_gradient = None
+        self.inverse_hessian = None
+        self.predicted = None
+        self.reference = None
+        self._rows = None
+
+    def get_state(self):
+        """
+        Data of the optimization so far (``STATE``), JSON-serializable, to be
+        restored with ``set_state``. The inverse Hessian is kept apart (see
+        ``write_inverse_hessian``), and the options are not included.
+        """
+        state = dict((name, getattr(self, name)) for name in self.STATE)
+        state['internal'] = self.internal  # coordinates of the inverse Hessian
+        return state
+
+    def set_state(self, state):
+        """
+        Restore a ``get_state`` result. The current trust radius is only taken
+        if a trust radius is used now.
+        """
+        for name in self.STATE:
+            if name not in state or (name == 'trust_radius' and not self.trust_radius):
+                continue
+            setattr(self, name, state[name])
+
+    def effective_gradient_components(self, energy_a, energy_b, gradient_a, gradient_b):
+        """
+        Same as ``Effective_Gradient`` in MECP.x.
+
+        Returns
+        -------
+        parallel, perpendicular, effective : list of float
+        """
+        return effective_gradient_components(energy_a, energy_b, gradient_a, gradient_b,
+                                             facPP=self.facPP, facP=self.facP)
+
+    def reduce(self, values):
+        """
+        Keep only the coordinates being optimized (all but frozen atoms), or
+        the components along ``basis``.
+        """
+        if self.basis:
+            return [_dot(u, values) for u in self.basis]
+        if not self.frozen:
+            return list(values)
+        return [values[i] for i in self.active]
+
+    def expand(self, values, fill=None):
+        """
+        Inverse of ``reduce``: frozen coordinates (or the components outside
+        ``basis``) are taken from ``fill`` (zero if not given).
+        """
+        if self.basis:
+            full = list(fill) if fill is not None else [0.0] * (3 * self.natom)
+            for u, v in zip(self.basis, values):
+                shift = v - _dot(u, full)
+                full = [f + shift * c for (f, c) in zip(full, u)]
+            return full
+        if not self.frozen:
+            return list(values)
+        full = list(fill) if fill is not None else [0.0] * (3 * self.natom)
+        for i, v in zip(self.active, values):
+            full[i] = v
+        return full
+
+    def constraint_rows(self, x):
+        """
+        Derivatives of each constraint with respect to the optimized
+        coordinates, at full geometry ``x``. Targets left as None are
+        initialized here.
+        """
+        rows = []
+        for constraint in self.constraints:
+            kind, atoms, target = constraint
+            value, derivatives = INTERNAL_COORDINATES[kind](x, *atoms)
+            if target is None:
+                constraint[2] = value
+            row = [0.0] * (3 * self.natom)
+            for atom, d in derivatives.items():
+                row[3*atom:3*atom+3] = d
+            rows.append(self.reduce(row))
+        return rows
+
+    def apply_constraints(self, x, maxiter=50, tolerance=1e-8):
+        """
+        Iteratively correct geometry ``x`` so all constraints meet their targets.
+        """
+        for _ in range(maxiter):
+            residuals = []
+            for kind, atoms, target in self.constraints:
+                value = INTERNAL_COORDINATES[kind](x, *atoms)[0]
+                residual = value - target
+                residuals.append(_wrap_angle(residual) if kind == 'dihedral' else residual)
+            if max(abs(r) for r in residuals) < tolerance:
+                break
+            rows = self.constraint_rows(x)
+            metric = [[_dot(ri, rj) for rj in rows] for ri in rows]
+            coefficients = _solve(metric, residuals)
+            xr = self.reduce(x)
+            for c, row in zip(coefficients, rows):
+                xr = [v - c * r for (v, r) in zip(xr, row)]
+            x = self.expand(xr, x)
+        return x
+
+    def initial_inverse_hessian(self):
+        """
+        Diagonal of the starting inverse Hessian. Like MECP.x, 0.7 Ang^2/Hartree
+        for cartesians and bonds; angles and dihedrals are softer.
+        """
+        if not self.internal:
+            return [0.7] * self.nx
+        return [0.7 if kind == 'distance' else 2.0 for (kind, _) in self.internals]
+
+    def wilson_b(self, x):
+        """
+        Values of the internal coordinates at full geometry ``x`` and their
+        derivatives (Wilson B matrix) with respect to the optimized cartesians.
+        """
+        values, rows = [], []
+        for kind, atoms in self.internals:
+            value, derivatives = INTERNAL_COORDINATES[kind](x, *atoms)
+            row = [0.0] * (3 * self.natom)
+            for atom, d in derivatives.items():
+                row[3*atom:3*atom+3] = d
+            values.append(value)
+            rows.append(self.reduce(row))
+        return values, rows
+
+    def to_internal(self, atomic_numbers, x, gradient_a, gradient_b):
+        """
+        Transform the geometry and the (reduced) cartesian gradients to internal
+        coordinates, ``g_q = B (B^T B)^-1 g_x``. Dihedrals are kept continuous
+        with respect to the previous geometry.
+        """
+        if self.internals is None:
+            self.internals = generate_internal_coordinates(atomic_numbers, x)
+        q, b = self.wilson_b(x)
+        if self.x is not None:
+            q = [ref + _wrap_angle(v - ref) if kind == 'dihedral' else v
+                 for (v, ref, (kind, _)) in zip(q, self.x, self.internals)]
+        btb = _regularized_gram(b)
+        gradients = []
+        for g in (gradient_a, gradient_b):
+            y = _solve(btb, g)
+            gradients.append([_dot(row, y) for row in b])
+        return q, gradients[0], gradients[1]
+
+    def to_cartesian(self, q, x, maxiter=50, tolerance=1e-8):
+        """
+        Iterative back-transformation of internal coordinates ``q`` to cartesians,
+        starting from full geometry ``x``: ``dx = (B^T B)^-1 B^T dq``. If the
+        iterations diverge, the best geometry found is returned.
+        """
+        best, best_error = x, None
+        for _ in range(maxiter):
+            values, b = self.wilson_b(x)
+            dq = [_wrap_angle(t - v) if kind == 'dihedral' else t - v
+                  for (t, v, (kind, _)) in zip(q, values, self.internals)]
+            error = math.sqrt(_dot(dq, dq) / len(dq))
+            if best_error is None or error < best_error:
+                best, best_error = x, error
+            elif error > 10 * best_error:
+                break
+            if error < tolerance:
+                break
+            btdq = [sum(row[i] * d for (row, d) in zip(b, dq)) for i in range(self.nx)]
+            dx = _solve(_regularized_gram(b), btdq)
+            x = self.expand([a + d for (a, d) in zip(self.reduce(x), dx)], x)
+        return best
+
+    def gradient(self, energy_a, energy_b, gradient_a, gradient_b):
+        """
+        Gradient of the objective minimized by this algorithm. For Harvey's
+        method, this is the effective gradient itself.
+        """
+        return self.effective_gradient_components(energy_a, energy_b, gradient_a, gradient_b)[2]
+
+    def step(self, atomic_numbers, x, energy_a, energy_b, forces_a, forces_b):
+        """
+        Perform one optimization step.
+
+        Parameters
+        ----------
+        atomic_numbers : list of int
+        x : list of float
+            Flattened coordinates (Angstrom) of the current geometry
+        energy_a, energy_b : float
+            Potential energies (Hartree) for both states
+        forces_a, forces_b : list of float
+            Flattened forces (Hartree/Bohr), as printed by Gaussian
+
+        Returns
+        -------
+        new_x : list of float
+            Next geometry to compute
+        converged : bool
+            Whether the five convergence criteria are met at ``x``
+        report : str
+            Text block, formatted like the one MECP.x adds to ``ReportFile``
+        """
+        full_x = list(x)
+        x = self.reduce(full_x)
+        grad_a = [-f / BOHR for f in self.reduce(forces_a)]
+        grad_b = [-f / BOHR for f in self.reduce(forces_b)]
+        if self.surrogate:
+            self.samples = (self.samples + [[x, energy_a, energy_b, grad_a, grad_b]])[
+                -self.SURROGATE_HISTORY:]
+        if self.constraints:
+            rows = self.constraint_rows(full_x)
+            grad_a, grad_b = _project(rows, grad_a), _project(rows, grad_b)
+        # Convergence is always tested on Harvey's effective gradient, so all
+        # algorithms are comparable; the steps follow each algorithm's objective.
+        par, perp, g = self.effective_gradient_components(energy_a, energy_b, grad_a, grad_b)
+        cartesian_par, cartesian_perp, cartesian_g = par, perp, g
+        if self.internal:
+            x, grad_a, grad_b = self.to_internal(atomic_numbers, full_x, grad_a, grad_b)
+            par = self.effective_gradient_components(energy_a, energy_b, grad_a, grad_b)[0]
+        og = self.gradient(energy_a, energy_b, grad_a, grad_b)
+        first = self.x is None
+        self.rejected = False
+        self.ratio = None
+        if (first and self.inverse_hessian and
+                _inverse_hessian_size(self.inverse_hessian) == len(x)):
+            ihessian = self.inverse_hessian  # warm start
+        elif first and self.lbfgs_memory:
+            ihessian = {'diagonal': self.initial_inverse_hessian(), 'pairs': [],
+                        'memory': self.lbfgs_memory}
+        elif first:
+            ihessian = [[h if i == j else 0.0 for j in range(len(x))]
+                        for (i, h) in enumerate(self.initial_inverse_hessian())]
+        else:
+            ihessian = _bfgs_update(self.inverse_hessian, _sub(x, self.x),
+                                    _sub(og, self.effective_gradient))
+            if self.trust_radius:
+                self.update_trust_radius(x, energy_a, energy_b, grad_a, grad_b, par)
+
+        if self.rejected:
+            # Go back to the last accepted geometry; keep its data
+            base, base_g = self.x, self.effective_gradient
+        else:
+            base, base_g = x, og
+            self.x = list(x)
+            self.reference = full_x
+            self.energies = (energy_a, energy_b)
+            self.gradients = (grad_a, grad_b)
+            self.parallel_gradient = par
+            self.effective_gradient = og
+            self.history = (self.history + [(list(x), og)])[-max(self.gdiis_history, 1):]
+        self.inverse_hessian = ihessian
+
+        # Constraint derivatives are cartesian; internal steps rely on the
+        # projected gradients and the final correction only
+        self._rows = None
+        if self.constraints and not self.internal:
+            self._rows = self.constraint_rows(self.expand(base, full_x))
+        dx = None
+        self.gdiis_vectors = 0
+        self.surrogate_status = None
+        models = self.surrogate_models() if self.surrogate else None
+        if models and not self.rejected:
+            dx = self.surrogate_step(models, base, ihessian, full_x)
+        elif models:
+            self.surrogate_status = 'not used (step rejected)'
+        if (dx is None and self.gdiis_threshold and
+                max(abs(v) for v in base_g) < self.gdiis_threshold):
+            dx = self.gdiis_step(base, ihessian)
+        surrogate_step = dx is not None and not self.gdiis_vectors
+        dx = self.bounded_step(base_g, ihessian, dx=dx)
+        new_x = [b + d for (b, d) in zip(base, dx)]
+        if self.internal:
+            new_x = self.to_cartesian(new_x, self.reference)
+        else:
+            new_x = self.expand(new_x, full_x)
+        if self.constraints:
+            new_x = self.apply_constraints(new_x)
+        self.surrogate_prediction = None
+        if models:
+            # Predict the next geometry, whichever step led to it, to validate the
+            # models there; with a trust radius, they also give the predicted change
+            y = self.reduce(new_x)
+            (energy_a_y, gradient_a_y, sigma_a), (energy_b_y, gradient_b_y, sigma_b) = [
+                model.predict(y) for model in models]
+            self.surrogate_prediction = [y, energy_a_y, energy_b_y, max(sigma_a, sigma_b)]
+            if surrogate_step and self.trust_radius:
+                par_y = self.effective_gradient_components(energy_a_y, energy_b_y,
+                                                           gradient_a_y, gradient_b_y)[0]
+                self.predicted = self.actual_change(y, energy_a_y, energy_b_y, gradient_a_y,
+                                                    gradient_b_y, par_y)
+        converged, report = self.test_convergence(atomic_numbers, full_x, new_x,
+                                                  energy_a, energy_b,
+                                                  self.expand(cartesian_par),
+                                                  self.expand(cartesian_perp),
+                                                  self.expand(cartesian_g))
+        if not converged:
+            self.nstep += 1
+            report += self._report_geometry(atomic_numbers, new_x)
+        return new_x, converged, report
+
+    def surrogate_models(self):
+        """
+        Fit one ``GEKSurrogate`` per state to ``samples``.
+
+        Returns
+        -------
+        models : list of GEKSurrogate or None
+            None if there are not enough samples yet or the fit failed, with the
+            reason in ``surrogate_status``.
+        """
+        if len(self.samples) < 2:
+            self.surrogate_status = 'not used (needs two geometries)'
+            return None
+        x = [sample[0] for sample in self.samples]
+        try:
+            return [GEKSurrogate(x, [sample[1 + k] for sample in self.samples],
+                                 [sample[3 + k] for sample in self.samples]) for k in (0, 1)]
+        except ValueError as e:
+            self.surrogate_status = 'not used ({})'.format(e)
+            return None
+
+    def surrogate_step(self, models, x, ihessian, full_x):
+        """
+        Optimize the MECP of the surrogate ``models`` with MECP.x-like steps, from
+        ``x`` and the current inverse Hessian, until the effective gradient and the
+        energy difference of the models are well below the thresholds, the step
+        gets longer than ``SURROGATE_MAX_STEP`` or the predictions become more
+        uncertain than ``surrogate_tolerance``, and step to the geometry with the
+        smallest effective gradient found on the way. Standard deviations are scaled by
+        ``surrogate_scale``, the ratio between the actual error and the standard
+        deviation of the last prediction validated (if larger than one), because
+        the models only learn the curvature along the directions explored so far.
+
+        Returns
+        -------
+        dx : list of float or None
+            Step from ``x``, or None if the models did not predict the energies of
+            ``x`` within ``surrogate_tolerance`` or found nothing better than ``x``
+            (the reason is in ``surrogate_status``).
+        """
+        if self.surrogate_prediction is not None:
+            predicted_x, energy_a, energy_b, sigma = self.surrogate_prediction
+            if max(abs(a - b) for (a, b) in zip(predicted_x, x)) < 1e-5:
+                error = max(abs(energy_a - self.energies[0]), abs(energy_b - self.energies[1]))
+                self.surrogate_scale = max(1.0, error / max(sigma, 1e-10))
+                if error > self.surrogate_tolerance:
+                    self.surrogate_status = 'not used (off by {:.6f} at this geometry)'.format(
+                                            error)
+                    return None
+        y, previous, best = list(x), None, None
+        for iteration in range(self.SURROGATE_ITERATIONS):
+            (energy_a, gradient_a, sigma_a), (energy_b, gradient_b, sigma_b) = [
+                model.predict(y) for model in models]
+            if max(sigma_a, sigma_b) * self.surrogate_scale > self.surrogate_tolerance:
+                break
+            rows = self.constraint_rows(self.expand(y, full_x)) if self.constraints else None
+            if rows:
+                gradient_a, gradient_b = _project(rows, gradient_a), _project(rows, gradient_b)
+            g = self.effective_gradient_components(energy_a, energy_b, gradient_a, gradient_b)[2]
+            if best is None or _norm(g) < best[0]:
+                best = _norm(g), y, energy_a - energy_b, iteration
+            if (max(abs(v) for v in g) < 0.1 * self.TGMax and
+                    abs(energy_a - energy_b) < 0.1 * self.TDE):
+                break
+            if previous is not None:
+                ihessian = _bfgs_update(ihessian, _sub(y, previous[0]), _sub(g, previous[1]))
+            dy = [-v for v in _inverse_hessian_dot(ihessian, g)]
+            if rows:
+                dy = _project(rows, dy)
+            longest = max(abs(v) for v in dy)
+            if longest > self.STPMX:
+                dy = [v / longest * self.STPMX for v in dy]
+            new_y = [a + b for (a, b) in zip(y, dy)]
+            if _norm(_sub(new_y, x)) > self.SURROGATE_MAX_STEP:
+                break
+            previous, y = (y, g), new_y
+        if best is None or best[3] == 0:
+            self.surrogate_status = 'not used (no better geometry within the tolerance)'
+            return None
+        self.surrogate_status = 'predicted dE {:.6f} after {} iterations'.format(
+                                best[2], best[3])
+        return _sub(best[1], x)
+
+    def actual_change(self, x, energy_a, energy_b, gradient_a, gradient_b, parallel_gradient):
+        """
+        Change of the effective objective between the last accepted geometry and
+        ``x``: the squared energy difference term plus the parallel energy, which is
+        integrated with the trapezoidal rule.
+        """
+        de_old = self.energies[0] - self.energies[1]
+        de_new = energy_a - energy_b
+        dx = _sub(x, self.x)
+        mean_par = [0.5 * (a + b) for (a, b) in zip(self.parallel_gradient, parallel_gradient)]
+        return 0.5 * self.facPP * (de_new ** 2 - de_old ** 2) + self.facP * _dot(mean_par, dx)
+
+    def predicted_change(self, g, ihessian, dx, scale=None):
+        """
+        Change of the objective predicted by the quadratic model for step ``dx``.
+        ``scale`` is the factor applied to the quasi-Newton step, if ``dx`` is one.
+        """
+        if scale is None:
+            # Assume the step ends at the minimum of the model
+            return 0.5 * _dot(g, dx)
+        # Quadratic model along the Newton direction: g.p * (a - a^2/2)
+        return -_dot(g, _inverse_hessian_dot(ihessian, g)) * (scale - 0.5 * scale ** 2)
+
+    def update_trust_radius(self, x, energy_a, energy_b, gradient_a, gradient_b,
+                            parallel_gradient):
+        """
+        Compare the actual change of the objective with the one predicted by the
+        quadratic model of the last step and update the trust radius. If the
+        objective got worse, the step is flagged as rejected.
+        """
+        actual = self.actual_change(x, energy_a, energy_b, gradient_a, gradient_b,
+                                    parallel_gradient)
+        predicted = self.predicted
+        length = _norm(_sub(x, self.x))
+        if not predicted or abs(predicted) < 1e-10:
+            return
+        self.ratio = actual / predicted
+        if actual > 0 and predicted < 0:
+            self.rejected = True
+            self.trust_radius = max(self.TRUST_MIN, 0.25 * length)
+        elif self.ratio < 0.25:
+            self.trust_radius = max(self.TRUST_MIN, 0.5 * min(self.trust_radius, length))
+        elif self.ratio > 0.75 and length > 0.8 * self.trust_radius:
+            self.trust_radius = min(self.TRUST_MAX, 2 * self.trust_radius)
+
+    def search_direction(self, g, ihessian):
+        """
+        Unbounded quasi-Newton step ``-H^-1 g`` from the last accepted geometry.
+        """
+        return [-x for x in _inverse_hessian_dot(ihessian, g)]
+
+    def bounded_step(self, g, ihessian, dx=None):
+        """
+        Bound a step by the trust radius (if enabled) or by the fixed caps used
+        in MECP.x. If ``dx`` is not given, the ``search_direction`` is used.
+        """
+        newton = dx is None
+        if newton:
+            dx = self.search_direction(g, ihessian)
+        if self._rows:
+            dx = _project(self._rows, dx)
+        length = _norm(dx)
+        if self.trust_radius:
+            scale = min(1.0, self.trust_radius / length) if length else 1.0
+            dx = [d * scale for d in dx]
+            self.predicted = self.predicted_change(g, ihessian, dx, scale if newton else None)
+            return dx
+        stpmax = self.STPMX * self.nx
+        if length > stpmax:
+            dx = [d / length * stpmax for d in dx]
+        lgstst = max(abs(d) for d in dx)
+        if lgstst > self.STPMX:
+            dx = [d / lgstst * self.STPMX for d in dx]
+        return dx
+
+    def gdiis_step(self, x, ihessian):
+        """
+        GDIIS extrapolation over the stored geometries and effective gradients,
+        using the quasi-Newton steps as error vectors. Oldest vectors are dropped
+        until the extrapolation looks sane (bounded coefficients and downhill
+        direction).
+
+        Returns
+        -------
+        dx : list of float or None
+            Unbounded step from ``x``, or None if GDIIS could not be applied.
+        """
+        history = self.history[-self.gdiis_history:]
+        while len(history) >= 2:
+            n = len(history)
+            errors = [_inverse_hessian_dot(ihessian, g) for (_, g) in history]
+            a = [[_dot(ei, ej) for ej in errors] for ei in errors]
+            scale = max(a[i][i] for i in range(n)) or 1.0
+            a = [[v / scale for v in row] + [1.0] for row in a] + [[1.0] * n + [0.0]]
+            try:
+                coefficients = _solve(a, [0.0] * n + [1.0])[:n]
+            except ValueError:
+                coefficients = None
+            if coefficients is not None and max(abs(c) for c in coefficients) < 10:
+                dx = [-xi for xi in x]
+                for c, (xj, _), ej in zip(coefficients, history, errors):
+                    dx = [d + c * (xv - ev) for (d, xv, ev) in zip(dx, xj, ej)]
+                if _dot(dx, history[-1][1]) < 0:
+                    self.gdiis_vectors = n
+                    return dx
+            history = history[1:]
+        return None
+
+    def test_convergence(self, atomic_numbers, x, new_x, energy_a, energy_b, par, perp, g):
+        """
+        Same as ``TestConvergence`` in MECP.x: RMS criteria are taken over all
+        the 3N Cartesian coordinates, whatever the optimizer works on (active,
+        symmetry-unique or internal coordinates). Rejected steps never converge.
+
+        Returns
+        -------
+        converged : bool
+        report : str
+        """
+        n = len(g)  # 3N, frozen atoms included, as in MECP.x
+        delta = _sub(new_x, x)
+        de = abs(energy_a - energy_b)
+        dxmax = max(abs(d) for d in delta)
+        dxrms = math.sqrt(_dot(delta, delta) / n)
+        gmax = max(abs(v) for v in g)
+        grms = math.sqrt(_dot(g, g) / n)
+        ppgrms = math.sqrt(_dot(perp, perp) / n)
+        pgrms = math.sqrt(_dot(par, par) / n)
+        checks = [(gmax, self.TGMax), (grms, self.TGRMS), (dxmax, self.TDXMax),
+                  (dxrms, self.TDXRMS), (de, self.TDE)]
+        converged = all(value < threshold for (value, threshold) in checks) and not self.rejected
+
+        lines = []
+        if self.nstep == 0:
+            lines.extend(REPORT_HEADER)
+            lines.append('Initial Geometry:')
+            lines.extend(_format_atoms(atomic_numbers, x, '{:3d}' + '{:15.7f}' * 3))
+            lines.append('')
+        lines.append('Energy of First State:  {:18.10f}'.format(energy_a))
+        lines.append('Energy of Second State: {:18.10f}'.format(energy_b))
+        lines.append('')
+        lines.append('Convergence Check (Actual Value, then Threshold, then Status):')
+        labels = ('Max Gradient El.:', 'RMS Gradient El.:', 'Max Change of X: ',
+                  'RMS Change of X: ', 'Difference in E: ')
+        for label, (value, threshold) in zip(labels, checks):
+            lines.append('{}{:11.6f} ({:8.6f})  {}'.format(
+                         label, value, threshold, 'YES' if value < threshold else ' NO'))
+        if self.trust_radius:
+            lines.append('Trust Radius:     {:11.6f} (Ratio: {})'.format(
+                         self.trust_radius,
+                         'n/a' if self.ratio is None else '{:.6f}'.format(self.ratio)))
+            if self.rejected:
+                lines.append('Step rejected: restarting from previous geometry')
+        if self.gdiis_vectors:
+            lines.append('GDIIS Extrapolation: {} vectors'.format(self.gdiis_vectors))
+        if self.surrogate_status:
+            lines.append('Surrogate Step: {}'.format(self.surrogate_status))
+        if self.internal:
+            lines.append('Internal Coordinates: {}'.format(len(self.internals)))
+        if self.lbfgs_memory:
+            lines.append('L-BFGS Updates: {} (Memory: {})'.format(
+                         len(self.inverse_hessian['pairs']), self.lbfgs_memory))
+        for kind, atoms, target in self.constraints:
+            value = INTERNAL_COORDINATES[kind](x, *atoms)[0]
+            if kind != 'distance':
+                value, target = math.degrees(value), math.degrees(target)
+            lines.append('Constraint {} {}: {:11.6f} (Target: {:.6f})'.format(
+                         kind, '-'.join(str(a + 1) for a in atoms), value, target))
+        lines.append('')
+        lines.append('Overall Effective Gradient:')
+        lines.extend(_format_atoms(range(1, self.natom + 1), g, '{:3d}' + '{:16.8f}' * 3))
+        lines.append('')
+        lines.append('Difference Gradient: (RMS * DE:{:11.6f})'.format(ppgrms))
+        lines.extend(_format_atoms(range(1, self.natom + 1), perp, '{:3d}' + '{:16.8f}' * 3))
+        lines.append('')
+        lines.append('Parallel Gradient: (RMS:{:11.6f})'.format(pgrms))
+        lines.extend(_format_atoms(range(1, self.natom + 1), par, '{:3d}' + '{:16.8f}' * 3))
+        lines.append('')
+        if converged:
+            lines.append('The MECP Optimization has CONVERGED at that geometry !!!')
+            lines.append('Goodbye and fly with us again...')
+        return converged, '\n'.join(lines) + '\n'
+
+    def _report_geometry(self, atomic_numbers, x):
+        lines = ['Geometry at Step{:3d}'.format(self.nstep)]
+        lines.extend(_format_atoms(atomic_numbers, x, '{:3d}' + '{:15.7f}' * 3))
+        lines.append('')
+        return '\n'.join(lines) + '\n'
+
+    def write_geom(self, path, atomic_numbers, x):
+        """
+        Write the next geometry like ``WriteGeomFile`` in MECP.x.
+        """
+        with open(path, 'w') as f:
+            f.write('\n'.join(_format_atoms(atomic_numbers, x, '{:4d}' + '{:14.8f}' * 3)))
+            f.write('\n\n')
+
+    def write_progfile(self, path, atomic_numbers, new_x):
+        """
+        Write the optimizer status like ``WriteProgFile`` in MECP.x, so the
+        Fortran program can pick up from here if needed. Rows and columns of
+        frozen coordinates are written as zeros in the inverse Hessian, so
+        MECP.x will not move them either.
+
+        With internal coordinates or L-BFGS, the inverse Hessian cannot be used by
+        MECP.x, so an initial (incomplete) ProgFile for the next geometry is written
+        instead.
+        """
+        if self.internal or self.lbfgs_memory:
+            with open(path, 'w') as f:
+                f.write(PROGFILE.format(natom=self.natom, geometry='\n'.join(
+                    _format_atoms(atomic_numbers, new_x, '{:3d}' + '{:20.12f}' * 3))))
+            return
+        x = self.expand(self.x, new_x)
+        gradients = [self.expand(g) for g in self.gradients]
+        effective_gradient = self.expand(self.effective_gradient)
+        zeros = [0.0] * (3 * self.natom)
+        if self.basis:
+            # B^T H B, by columns (it is symmetric)
+            columns = [self.expand(row) for row in self.inverse_hessian]
+            ihessian = (self.expand([c[i] for c in columns]) for i in range(3 * self.natom))
+        elif self.frozen:
+            position = dict((i, k) for (k, i) in enumerate(self.active))
+            ihessian = (self.expand(self.inverse_hessian[position[i]]) if i in position else zeros
+                        for i in range(3 * self.natom))
+        else:
+            ihessian = self.inverse_hessian
+        lines = [' Progress File for MECP Optimization', ' Number of Atoms:',
+                 '{:12d}'.format(self.natom), ' Number of Steps already Run',
+                 '{:12d}'.format(self.nstep), ' Is this a full ProgFile ?',
+                 '{:12d}'.format(1), ' Next Geometry to Compute:']
+        lines.extend(_format_atoms(atomic_numbers, new_x, '{:3d}' + '{:20.12f}' * 3))
+        lines.append(' Previous Geometry:')
+        lines.extend(''.join('{:20.12f}'.format(v) for v in x[i:i+3])
+                     for i in range(0, len(x), 3))
+        lines.append(' Energies of First, Second State at that Geometry:')
+        lines.extend('{:20.12f}'.format(e) for e in self.energies)
+        lines.append(' Gradient of First State at that Geometry:')
+        lines.extend('{:20.12f}'.format(v) for v in gradients[0])
+        lines.append(' Gradient of Second State at that Geometry:')
+        lines.extend('{:20.12f}'.format(v) for v in gradients[1])
+        lines.append(' Effective Gradient at that Geometry:')
+        lines.extend('{:20.12f}'.format(v) for v in effective_gradient)
+        lines.append(' Approximate Inverse Hessian at that Geometry:')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines))
+            f.write('\n')
+            for row in ihessian:
+                f.write(''.join('{:20.12f}\n'.format(v) for v in row))
+
+
+class PenaltyOptimizer(MECPOptimizer):
+
+    """
+    Penalty function method (Levine, Coe & Martinez, J Phys Chem B 2008). BFGS
+    steps minimize the average energy of both states plus a smooth penalty on
+    their difference:
+
+        F = (Ea + Eb) / 2 + sigma * dE^2 / (|dE| + alpha)
+
+    If the penalized gradient is already converged but the energy difference
+    is not, ``sigma`` is increased to pull the minimum towards the seam.
+    """
+
+    name = 'penalty'
+    STATE = MECPOptimizer.STATE + ('sigma',)
+    SIGMA = 3.5
+    ALPHA = 0.02  # Hartree
+    SIGMA_FACTOR = 4.0
+
+    def __init__(self, *args, **kwargs):
+        super(PenaltyOptimizer, self).__init__(*args, **kwargs)
+        self.sigma = self.SIGMA
+
+    def objective(self, energy_a, energy_b):
+        de = abs(energy_a - energy_b)
+        return 0.5 * (energy_a + energy_b) + self.sigma * de ** 2 / (de + self.ALPHA)
+
+    def gradient(self, energy_a, energy_b, gradient_a, gradient_b):
+        de = energy_a - energy_b
+        sign = 1.0 if de >= 0 else -1.0
+        de = abs(de)
+        dpenalty = self.sigma * (de ** 2 + 2 * self.ALPHA * de) / (de + self.ALPHA) ** 2
+        return [0.5 * (a + b) + dpenalty * sign * (a - b)
+                for (a, b) in zip(gradient_a, gradient_b)]
+
+    def actual_change(self, x, energy_a, energy_b, gradient_a, gradient_b, parallel_gradient):
+        return self.objective(energy_a, energy_b) - self.objective(*self.energies)
+
+    def step(self, atomic_numbers, x, energy_a, energy_b, forces_a, forces_b):
+        grad_a = [-f / BOHR for f in self.reduce(forces_a)]
+        grad_b = [-f / BOHR for f in self.reduce(forces_b)]
+        g = self.gradient(energy_a, energy_b, grad_a, grad_b)
+        if (abs(energy_a - energy_b) > self.TDE and max(abs(v) for v in g) < self.TGMax):
+            # Minimum of the current penalty is not at the seam: tighten it
+            self.sigma *= self.SIGMA_FACTOR
+            self.predicted = None
+            if self.effective_gradient is not None:
+                self.effective_gradient = self.gradient(self.energies[0], self.energies[1],
+                                                        *self.gradients)
+        return super(PenaltyOptimizer, self).step(atomic_numbers, x, energy_a, energy_b,
+                                                  forces_a, forces_b)
+
+
+class LagrangeNewtonOptimizer(MECPOptimizer):
+
+    """
+    Lagrange-Newton / projected gradient method. The Lagrangian
+    ``L = Ea - lambda * (Ea - Eb)`` is minimized with BFGS steps restricted to
+    the space orthogonal to the difference gradient (with the optimal
+    multiplier, its gradient is Harvey's parallel gradient), while a Newton
+    step on the linearized constraint ``Ea - Eb = 0`` is taken along the
+    difference gradient.
+    """
+
+    name = 'lagrange_newton'
+
+    def gradient(self, energy_a, energy_b, gradient_a, gradient_b):
+        return self.effective_gradient_components(energy_a, energy_b, gradient_a, gradient_b)[0]
+
+    def _constraint(self):
+        """
+        Energy difference, difference gradient and its unit vector at the
+        last accepted geometry.
+        """
+        de = self.energies[0] - self.energies[1]
+        d = _sub(*self.gradients)
+        norm = _norm(d)
+        return de, d, [v / norm for v in d]
+
+    def search_direction(self, g, ihessian):
+        de, d, n = self._constraint()
+        p = super(LagrangeNewtonOptimizer, self).search_direction(g, ihessian)
+        pn = _dot(p, n)
+        normal = -de / _dot(d, d)
+        return [pi - pn * ni + normal * di for (pi, ni, di) in zip(p, n, d)]
+
+    def gdiis_step(self, x, ihessian):
+        dx = super(LagrangeNewtonOptimizer, self).gdiis_step(x, ihessian)
+        if dx is None:
+            return None
+        de, d, n = self._constraint()
+        dn = _dot(dx, n)
+        normal = -de / _dot(d, d)
+        return [v - dn * ni + normal * di for (v, ni, di) in zip(dx, n, d)]
+
+    def predicted_change(self, g, ihessian, dx, scale=None):
+        # Tangential part: quadratic model of L; normal part: linearized
+        # energy difference in the effective objective
+        de, d, _ = self._constraint()
+        return (0.5 * _dot(g, dx) +
+                0.5 * self.facPP * ((de + _dot(d, dx)) ** 2 - de ** 2))
+
+
+def effective_gradient_components(energy_a, energy_b, gradient_a, gradient_b,
+                                  facPP=MECPOptimizer.facPP, facP=MECPOptimizer.facP):
+    """
+    Parallel, perpendicular (difference) and effective gradients of Harvey's
+    algorithm, like ``Effective_Gradient`` in MECP.x. Gradients in Hartree/Angstrom.
+
+    Returns
+    -------
+    parallel, perpendicular, effective : list of float
+    """
+    perp = [a - b for (a, b) in zip(gradient_a, gradient_b)]
+    npg = _norm(perp)
+    pp = _dot(gradient_a, perp) / npg
+    par = [a - p / npg * pp for (a, p) in zip(gradient_a, perp)]
+    de = energy_a - energy_b
+    eff = [de * facPP * p + facP * q for (p, q) in zip(perp, par)]
+    return par, perp, eff
+
+
+def _bfgs_update(ihessian, dx, dg):
+    """
+    BFGS update of the inverse Hessian, as in ``UpdateX`` (MECP.x). The update
+    is skipped if the curvature condition does not hold.
+
+    L-BFGS inverse Hessians (dicts with the initial ``diagonal``, the update
+    ``pairs`` and their ``memory``) just keep the last pairs of ``dx`` and ``dg``.
+    """
+    if isinstance(ihessian, dict):
+        pairs = ihessian['pairs']
+        if _dot(dg, dx) > 1e-12:
+            pairs = (pairs + [[list(dx), list(dg)]])[-ihessian['memory']:]
+        return dict(ihessian, pairs=pairs)
+    hdg = _matvec(ihessian, dg)
+    fac = _dot(dg, dx)
+    fae = _dot(dg, hdg)
+    if fac <= 1e-12 or fae <= 1e-12:
+        return [list(row) for row in ihessian]
+    fac, fad = 1.0 / fac, 1.0 / fae
+    w = [fac * a - fad * b for (a, b) in zip(dx, hdg)]
+    return [[h + fac * dx[i] * dx[j] - fad * hdg[i] * hdg[j] + fae * w[i] * w[j]
+             for (j, h) in enumerate(row)] for (i, row) in enumerate(ihessian)]
+
+
+def _inverse_hessian_dot(ihessian, v):
+    """
+    Product of a dense or L-BFGS (see ``_bfgs_update``) inverse Hessian and ``v``,
+    the latter with the two-loop recursion.
+    """
+    if not isinstance(ihessian, dict):
+        return _matvec(ihessian, v)
+    q, alphas = list(v), []
+    for s, y in reversed(ihessian['pairs']):
+        rho = 1.0 / _dot(y, s)
+        alpha = rho * _dot(s, q)
+        q = [a - alpha * b for (a, b) in zip(q, y)]
+        alphas.append((rho, alpha))
+    r = [h * a for (h, a) in zip(ihessian['diagonal'], q)]
+    for (s, y), (rho, alpha) in zip(ihessian['pairs'], reversed(alphas)):
+        beta = rho * _dot(y, r)
+        r = [a + (alpha - beta) * b for (a, b) in zip(r, s)]
+    return r
+
+
+def _inverse_hessian_size(ihessian):
+    return len(ihessian['diagonal']) if isinstance(ihessian, dict) else len(ihessian)
+
+
+def write_inverse_hessian(ihessian, path):
+    """
+    Write a dense or L-BFGS (see ``_bfgs_update``) inverse Hessian to ``path`` as
+    raw little-endian doubles, like the columns of ``StepStore``, replacing it
+    atomically.
+
+    Returns
+    -------
+    meta : dict
+        Layout of the file, for ``read_inverse_hessian``
+    """
+    if isinstance(ihessian, dict):
+        n = len(ihessian['diagonal'])
+        meta = {'size': n, 'pairs': len(ihessian['pairs']), 'memory': ihessian['memory']}
+        values = array('d', ihessian['diagonal'])
+        for s, y in ihessian['pairs']:
+            values.extend(s)
+            values.extend(y)
+    else:
+        meta = {'size': len(ihessian)}
+        values = array('d')
+        for row in ihessian:
+            values.extend(row)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        values.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    getattr(os, 'replace', os.rename)(tmp, path)
+    return meta
+
+
+def read_inverse_hessian(path, meta):
+    """
+    Read an inverse Hessian written by ``write_inverse_hessian``, with its ``meta``.
+    """
+    n = meta['size']
+    values = array('d')
+    with open(path, 'rb') as f:
+        values.fromfile(f, n * (2 * meta['pairs'] + 1) if 'pairs' in meta else n * n)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    if 'pairs' not in meta:
+        return [values[i:i+n].tolist() for i in range(0, n * n, n)]
+    pairs = [[values[i:i+n].tolist(), values[i+n:i+2*n].tolist()]
+             for i in range(n, len(values), 2 * n)]
+    return {'diagonal': values[:n].tolist(), 'pairs': pairs, 'memory': meta['memory']}
+
+
+def _solve(a, b):
+    """
+    Solve the linear system ``a x = b`` with Gaussian elimination and partial
+    pivoting. Raises ValueError if the matrix is singular.
+    """
+    n = len(b)
+    m = [list(row) + [v] for (row, v) in zip(a, b)]
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda k: abs(m[k][i]))
+        if abs(m[pivot][i]) < 1e-14:
+            raise ValueError('Singular matrix')
+        m[i], m[pivot] = m[pivot], m[i]
+        for k in range(i + 1, n):
+            factor = m[k][i] / m[i][i]
+            if factor:
+                m[k] = [vk - factor * vi for (vk, vi) in zip(m[k], m[i])]
+    x = [0.0] * n
+    for i in reversed(range(n)):
+        x[i] = (m[i][n] - sum(m[i][j] * x[j] for j in range(i + 1, n))) / m[i][i]
+    return x
+
+
+def _project(rows, v):
+    """
+    Remove from ``v`` its components along the (not necessarily orthogonal)
+    vectors in ``rows``.
+    """
+    metric = [[_dot(ri, rj) for rj in rows] for ri in rows]
+    coefficients = _solve(metric, [_dot(r, v) for r in rows])
+    for c, row in zip(coefficients, rows):
+        v = [a - c * b for (a, b) in zip(v, row)]
+    return v
+
+
+def _bond(x, i, j):
+    """
+    Distance between atoms ``i`` and ``j`` (0-based) of flattened geometry ``x``
+    and its derivatives, as a dict of ``atom: [dx, dy, dz]``.
+    """
+    u = [x[3*i+k] - x[3*j+k] for k in range(3)]
+    r = _norm(u)
+    du = [v / r for v in u]
+    return r, {i: du, j: [-v for v in du]}
+
+
+def _angle(x, i, j, k):
+    """
+    Angle (radians) ``i-j-k`` of flattened geometry ``x`` and its derivatives.
+    """
+    u = [x[3*i+n] - x[3*j+n] for n in range(3)]
+    v = [x[3*k+n] - x[3*j+n] for n in range(3)]
+    lu, lv = _norm(u), _norm(v)
+    u, v = [a / lu for a in u], [a / lv for a in v]
+    cos = max(-1.0, min(1.0, _dot(u, v)))
+    sin = max(math.sqrt(1 - cos ** 2), 1e-8)
+    di = [(cos * a - b) / (lu * sin) for (a, b) in zip(u, v)]
+    dk = [(cos * b - a) / (lv * sin) for (a, b) in zip(u, v)]
+    return math.acos(cos), {i: di, k: dk, j: [-a - b for (a, b) in zip(di, dk)]}
+
+
+def _dihedral(x, i, j, k, l):
+    """
+    Dihedral angle (radians) ``i-j-k-l`` of flattened geometry ``x`` and its
+    derivatives (Blondel & Karplus, J Comput Chem 1996).
+    """
+    b1 = [x[3*j+n] - x[3*i+n] for n in range(3)]
+    b2 = [x[3*k+n] - x[3*j+n] for n in range(3)]
+    b3 = [x[3*l+n] - x[3*k+n] for n in range(3)]
+    n1, n2 = _cross(b1, b2), _cross(b2, b3)
+    lb2 = _norm(b2)
+    n1n1, n2n2 = max(_dot(n1, n1), 1e-16), max(_dot(n2, n2), 1e-16)
+    phi = math.atan2(lb2 * _dot(b1, n2), _dot(n1, n2))
+    di = [-lb2 / n1n1 * v for v in n1]
+    dl = [lb2 / n2n2 * v for v in n2]
+    f = _dot(b1, b2) / lb2 ** 2
+    h = _dot(b3, b2) / lb2 ** 2
+    dj = [h * b - (1 + f) * a for (a, b) in zip(di, dl)]
+    dk = [f * a - (1 + h) * b for (a, b) in zip(di, dl)]
+    return phi, {i: di, j: dj, k: dk, l: dl}
+
+
+def _cross(a, b):
+    return [a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]]
+
+
+def _wrap_angle(value):
+    return (value + math.pi) % (2 * math.pi) - math.pi
+
+
+def _regularized_gram(b, epsilon=1e-6):
+    """
+    ``B^T B + epsilon I``. The small shift removes the zero eigenvalues of overall
+    translations and rotations, which are absent from internal coordinates.
+    """
+    n = len(b[0])
+    gram = [[epsilon if i == j else 0.0 for j in range(n)] for i in range(n)]
+    for row in b:
+        nonzero = [(i, v) for (i, v) in enumerate(row) if v]
+        for i, vi in nonzero:
+            gram_i = gram[i]
+            for j, vj in nonzero:
+                gram_i[j] += vi * vj
+    return gram
+
+
+def generate_internal_coordinates(atomic_numbers, x, scale=1.3, linear=175.0):
+    """
+    Build a redundant set of internal coordinates for flattened geometry ``x``:
+    bonds between atoms closer than ``scale`` times the sum of their covalent radii
+    (disconnected fragments are joined by their closest pair), plus all the angles
+    and dihedrals defined by those bonds. Angles above ``linear`` degrees (and
+    dihedrals containing them) are skipped.
+
+    Returns
+    -------
+    internals : list of (str, tuple of int)
+    """
+    natom = len(atomic_numbers)
+    radii = [COVALENT_RADII.get(z, 1.5) for z in atomic_numbers]
+    distance = lambda i, j: _bond(x, i, j)[0]
+    bonds = set((i, j) for i in range(natom) for j in range(i + 1, natom)
+                if distance(i, j) < scale * (radii[i] + radii[j]))
+    # Join fragments
+    while True:
+        fragment, queue = set([0]), [0]
+        while queue:
+            i = queue.pop()
+            for a, b in bonds:
+                for m, n in ((a, b), (b, a)):
+                    if m == i and n not in fragment:
+                        fragment.add(n)
+                        queue.append(n)
+        if len(fragment) == natom:
+            break
+        bonds.add(tuple(sorted(min(((i, j) for i in fragment for j in range(natom)
+                                    if j not in fragment), key=lambda p: distance(*p)))))
+    neighbours = dict((i, sorted([b for (a, b) in bonds if a == i] +
+                                 [a for (a, b) in bonds if b == i])) for i in range(natom))
+    internals = [('distance', bond) for bond in sorted(bonds)]
+    straight = set()
+    for j in range(natom):
+        for n, i in enumerate(neighbours[j]):
+            for k in neighbours[j][n+1:]:
+                if math.degrees(_angle(x, i, j, k)[0]) < linear:
+                    internals.append(('angle', (i, j, k)))
+                else:
+                    straight.update([(i, j, k), (k, j, i)])
+    for j, k in sorted(bonds):
+        for i in neighbours[j]:
+            for l in neighbours[k]:
+                if len(set((i, j, k, l))) < 4 or (i, j, k) in straight or (j, k, l) in straight:
+                    continue
+                internals.append(('dihedral', (i, j, k, l)))
+    return internals
+
+
+def _dot(a, b):
+    return sum(x * y for (x, y) in zip(a, b))
+
+
+def _norm(a):
+    return math.sqrt(_dot(a, a))
+
+
+def _sub(a, b):
+    return [x - y for (x, y) in zip(a, b)]
+
+
+def _matvec(m, v):
+    return [_dot(row, v) for row in m]
+
+
+def _to_float(value):
+    if isinstance(value, str):
+        return float(value.lower().replace('d', 'e'))
+    return float(value)
+
+
+def _format_atoms(labels, x, fmt):
+    return [fmt.format(label, *x[3*i:3*i+3]) for (i, label) in enumerate(labels)]
+
+
+########################################################################################
+# Surrogate models
+########################################################################################
+
+class GEKSurrogate(object):
+
+    """
+    Gradient-enhanced kriging (Gaussian process regression on energies and
+    gradients) of one potential energy surface, with a squared exponential
+    kernel. The prior mean is the highest energy fitted, so the model goes
+    uphill away from the data. The length scale is the most likely of
+    ``LENGTH_SCALES``, with the variance of the process solved analytically.
+
+    Needs NumPy. The covariance matrix has ``n * (d + 1)`` rows for ``n`` points
+    in ``d`` dimensions, which is fine for the handful of geometries of an
+    optimization even with a few hundred atoms.
+
+    Parameters
+    ----------
+    x : list of list of float
+        Coordinates (Angstrom) of the points
+    energies : list of float
+        Energies (Hartree) at ``x``
+    gradients : list of list of float
+        Gradients (Hartree/Angstrom) at ``x``
+    length_scale : float, optional
+        Use this length scale (Angstrom) instead of choosing one.
+    """
+
+    LENGTH_SCALES = (0.25, 0.35, 0.5, 0.7, 1.0, 1.4, 2.0, 2.8, 4.0)
+    NUGGET = 1e-10  # relative, regularizes nearly repeated points
+
+    def __init__(self, x, energies, gradients, length_scale=None):
+        np = _numpy('Surrogate models')
+        self.x = np.asarray(x, dtype=float)
+        energies = np.asarray(energies, dtype=float)
+        self.mean = energies.max()
+        y = np.concatenate([energies - self.mean, np.asarray(gradients, dtype=float).ravel()])
+        best = None
+        for scale in ([length_scale] if length_scale else self.LENGTH_SCALES):
+            covariance = self._covariance(scale)
+            try:
+                cholesky = np.linalg.cholesky(covariance)
+            except np.linalg.LinAlgError:
+                continue
+            inverse = np.linalg.inv(cholesky)
+            alpha = inverse.T.dot(inverse.dot(y))
+            variance = max(y.dot(alpha) / len(y), 1e-30)
+            likelihood = -0.5 * len(y) * math.log(variance) - np.log(np.diag(cholesky)).sum()
+            if best is None or likelihood > best[0]:
+                best = likelihood, scale, variance, alpha, inverse
+        if best is None:
+            raise ValueError('covariance matrix is not positive definite')
+        _, self.length_scale, self.variance, self.alpha, self.inverse = best
+
+    def _covariance(self, scale):
+        """
+        Covariance matrix (over the variance of the process) of the energies and
+        gradients at the points, in that order.
+        """
+        np = _numpy('Surrogate models')
+        n, d = self.x.shape
+        diff = self.x[:, None, :] - self.x[None, :, :]
+        k = np.exp(-(diff ** 2).sum(axis=2) / (2 * scale ** 2))
+        energy_gradient = (k[:, :, None] * diff / scale ** 2).reshape(n, n * d)
+        gradient_gradient = k[:, :, None, None] * (
+            np.eye(d) / scale ** 2 - diff[:, :, :, None] * diff[:, :, None, :] / scale ** 4)
+        gradient_gradient = gradient_gradient.transpose(0, 2, 1, 3).reshape(n * d, n * d)
+        covariance = np.block([[k, energy_gradient], [energy_gradient.T, gradient_gradient]])
+        covariance[np.diag_indices_from(covariance)] *= 1 + self.NUGGET
+        return covariance
+
+    def predict(self, x):
+        """
+        Energy, gradient and standard deviation of the energy at ``x``.
+
+        Returns
+        -------
+        energy : float
+        gradient : list of float
+        sigma : float
+        """
+        np = _numpy('Surrogate models')
+        n, d = self.x.shape
+        scale = self.length_scale
+        diff = np.asarray(x, dtype=float)[None, :] - self.x
+        k = np.exp(-(diff ** 2).sum(axis=1) / (2 * scale ** 2))
+        alpha_e, alpha_g = self.alpha[:n], self.alpha[n:].reshape(n, d)
+        row = np.concatenate([k, (k[:, None] * diff / scale ** 2).ravel()])
+        energy = self.mean + row.dot(self.alpha)
+        projection = (diff * alpha_g).sum(axis=1)
+        gradient = (-(k * alpha_e).dot(diff) / scale ** 2 + k.dot(alpha_g) / scale ** 2 -
+                    (k * projection).dot(diff) / scale ** 4)
+        v = self.inverse.dot(row)
+        sigma = math.sqrt(max(0.0, self.variance * (1 - v.dot(v))))
+        return float(energy), [float(v) for v in gradient], sigma
+
+
+########################################################################################
+# Symmetry
+########################################################################################
+
+class PointGroup(object):
+
+    """
+    Symmetry operations of a molecule, usually found with ``PointGroup.detect``.
+    Each operation is an orthogonal matrix ``R`` and the permutation ``p`` of the
+    atoms it induces (``R r_i = r_p(i)``, positions relative to the center), so
+    gradients, steps and geometries can be projected onto the totally symmetric
+    representation and the optimization can be restricted to the
+    symmetry-unique coordinates.
+
+    Parameters
+    ----------
+    atomic_numbers : list of int
+    operations : list of (list of list of float, list of int)
+        Matrices and permutations, identity included.
+    linear : bool, optional
+        Whether the molecule is linear. Only a finite subgroup of its
+        operations is kept, which is enough for symmetrization.
+    """
+
+    def __init__(self, atomic_numbers, operations, linear=False):
+        self.atomic_numbers = list(atomic_numbers)
+        self.operations = operations
+        self.linear = linear
+        self.name = self.classify()
+
+    @classmethod
+    def detect(cls, atomic_numbers, x, tolerance=0.01, frozen=()):
+        """
+        Find the symmetry operations of flattened geometry ``x``: those that map
+        every atom onto an atom of the same element (and frozen state) within
+        ``tolerance`` Angstrom. Candidate axes are built from the atoms of the
+        smallest sets of equivalent atoms, and the operations found are closed
+        under multiplication.
+        """
+        natom = len(atomic_numbers)
+        frozen = set(frozen)
+        center = cls.center(atomic_numbers, x)
+        r = [_sub(x[3*i:3*i+3], center) for i in range(natom)]
+        # Atoms that an operation might exchange: same element, state and distance to center
+        classes, key = [], lambda i: (atomic_numbers[i], i in frozen, _norm(r[i]))
+        for i in sorted(range(natom), key=key):
+            if classes and key(classes[-1][-1])[:2] == key(i)[:2] and \
+                    key(i)[2] - key(classes[-1][-1])[2] < tolerance:
+                classes[-1].append(i)
+            else:
+                classes.append([i])
+        equivalent = dict((i, members) for members in classes for i in members)
+
+        def match(matrix):
+            permutation = []
+            for i in range(natom):
+                image = _matvec(matrix, r[i])
+                for j in equivalent[i]:
+                    if _norm(_sub(image, r[j])) < tolerance:
+                        permutation.append(j)
+                        break
+                else:
+                    return None
+            return permutation if len(set(permutation)) == natom else None
+
+        identity = [[float(i == j) for j in range(3)] for i in range(3)]
+        off_center = sorted([members for members in classes if _norm(r[members[0]]) > tolerance],
+                            key=len)
+        if not off_center:  # single atom
+            return cls(atomic_numbers, [(identity, list(range(natom)))])
+        linear = bool(off_center) and all(
+            _norm(_cross(r[off_center[0][0]], v)) < tolerance * _norm(r[off_center[0][0]])
+            for v in r)
+        axes = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+        for members in off_center[:2]:
+            points = [r[i] for i in members[:12]]
+            axes.extend(points)
+            for a, b in combinations(points, 2):
+                axes.extend([[u + v for (u, v) in zip(a, b)], _sub(a, b), _cross(a, b)])
+            for a, b, c in combinations(points, 3):
+                axes.append(_cross(_sub(b, a), _sub(c, a)))
+        if linear:  # perpendicular axes for the C2 and mirrors of D*h and C*v
+            z = r[off_center[0][0]]
+            y = _cross(z, [1.0, 0.0, 0.0] if abs(z[0]) < 0.9 * _norm(z) else [0.0, 1.0, 0.0])
+            axes.extend([y, _cross(y, z)])
+        unique_axes = []
+        for axis in axes:
+            length = _norm(axis)
+            if length < 1e-6:
+                continue
+            axis = [v / length for v in axis]
+            if all(abs(_dot(axis, other)) < 1 - 1e-6 for other in unique_axes):
+                unique_axes.append(axis)
+
+        candidates = [[[-v for v in row] for row in identity]]  # inversion
+        for axis in unique_axes:
+            for n in ((2, 4) if linear else (2, 3, 4, 5, 6)):
+                candidates.append(_rotation_matrix(axis, 2 * math.pi / n))
+            candidates.append(_reflection_matrix(axis))
+            for n in ((4,) if linear else (4, 6, 8)):
+                candidates.append(_matmul(_reflection_matrix(axis),
+                                          _rotation_matrix(axis, 2 * math.pi / n)))
+        operations = [(identity, list(range(natom)))]
+
+        def add(matrix, permutation):
+            if len(operations) >= 120 or any(permutation == p and max(abs(u - v) for (row, other) in zip(matrix, m)
+                                            for (u, v) in zip(row, other)) < 0.1
+                   for (m, p) in operations):
+                return False
+            operations.append((matrix, permutation))
+            return True
+
+        for matrix in candidates:
+            permutation = match(matrix)
+            if permutation is not None:
+                add(matrix, permutation)
+        # Close the set under multiplication (the largest point group has 120 operations)
+        grown = True
+        while grown:
+            grown = False
+            for (a, pa), (b, pb) in list(combinations(operations, 2)) + \
+                    [(o, o) for o in operations]:
+                for (m1, p1), (m2, p2) in (((a, pa), (b, pb)), ((b, pb), (a, pa))):
+                    grown |= add(_matmul(m1, m2), [p1[p2[i]] for i in range(natom)])
+        return cls(atomic_numbers, operations, linear=linear)
+
+    @staticmethod
+    def center(atomic_numbers, x):
+        """
+        Center of the atomic numbers, which all operations leave in place.
+        """
+        total = float(sum(atomic_numbers)) or 1.0
+        return [sum(z * x[3*i+k] for (i, z) in enumerate(atomic_numbers)) / total
+                for k in range(3)]
+
+    def classify(self):
+        """
+        Schoenflies symbol of the group (``C*v`` and ``D*h`` for linear molecules).
+        """
+        inversion = any(_trace(m) < -2.9 for (m, _) in self.operations)
+        if self.linear:
+            return 'D*h' if inversion else 'C*v'
+        rotations, mirrors, improper = [], [], []
+        for matrix, _ in self.operations:
+            if _determinant(matrix) > 0:
+                angle = math.acos(max(-1.0, min(1.0, (_trace(matrix) - 1) / 2)))
+                if angle > 0.1:
+                    rotations.append((int(round(2 * math.pi / angle)), _rotation_axis(matrix)))
+            elif abs(_trace(matrix) - 1) < 0.1:
+                mirrors.append(_rotation_axis([[-v for v in row] for row in matrix]))
+            elif _trace(matrix) > -2.9:
+                improper.append(_rotation_axis([[-v for v in row] for row in matrix]))
+        if not rotations:
+            return 'Cs' if mirrors else 'Ci' if inversion else 'C1'
+        high = []
+        for order, axis in rotations:
+            if order >= 3 and all(abs(_dot(axis, other)) < 0.99 for other in high):
+                high.append(axis)
+        if len(high) > 1:
+            orders = set(order for (order, _) in rotations)
+            if 5 in orders:
+                return 'Ih' if inversion else 'I'
+            if 4 in orders:
+                return 'Oh' if inversion else 'O'
+            return 'Th' if inversion else 'Td' if mirrors else 'T'
+        n = max(order for (order, _) in rotations)
+        # With several C2 axes (D2 groups), prefer the one that is also an S4 axis
+        principal = sorted((axis for (order, axis) in rotations if order == n),
+                           key=lambda a: not any(abs(_dot(a, b)) > 0.99 for b in improper))[0]
+        parallel = lambda a: abs(_dot(a, principal)) > 0.99
+        perpendicular = lambda a: abs(_dot(a, principal)) < 0.01
+        horizontal = any(parallel(normal) for normal in mirrors)
+        vertical = any(perpendicular(normal) for normal in mirrors)
+        c2_axes = []
+        for order, axis in rotations:
+            if order == 2 and perpendicular(axis) and \
+                    all(abs(_dot(axis, other)) < 0.99 for other in c2_axes):
+                c2_axes.append(axis)
+        if len(c2_axes) >= n:
+            return 'D{}{}'.format(n, 'h' if horizontal else 'd' if vertical else '')
+        if horizontal:
+            return 'C{}h'.format(n)
+        if vertical:
+            return 'C{}v'.format(n)
+        if any(parallel(axis) for axis in improper):
+            return 'S{}'.format(2 * n)
+        return 'C{}'.format(n)
+
+    def symmetrize(self, v):
+        """
+        Project a flattened vector field (gradients, steps) onto the totally symmetric
+        representation: ``v'_i = 1/|G| sum R^T v_p(i)``.
+        """
+        out = [0.0] * len(v)
+        for matrix, permutation in self.operations:
+            for i, j in enumerate(permutation):
+                w = v[3*j:3*j+3]
+                for k in range(3):
+                    out[3*i+k] += matrix[0][k] * w[0] + matrix[1][k] * w[1] + matrix[2][k] * w[2]
+        return [value / len(self.operations) for value in out]
+
+    def symmetrize_geometry(self, x):
+        """
+        Closest geometry to flattened ``x`` with the full symmetry of the group.
+        """
+        center = self.center(self.atomic_numbers, x)
+        relative = [v - center[i % 3] for (i, v) in enumerate(x)]
+        return [v + center[i % 3] for (i, v) in enumerate(self.symmetrize(relative))]
+
+    def basis(self, frozen=()):
+        """
+        Orthonormal basis of the totally symmetric displacements, built from the
+        first atom of each set of equivalent atoms. Displacements of ``frozen``
+        atoms are left out.
+
+        Returns
+        -------
+        basis : list of list of float
+            Flattened cartesian vectors
+        """
+        natom = len(self.atomic_numbers)
+        basis, seen = [], set(frozen)
+        for atom in range(natom):
+            if atom in seen:
+                continue
+            seen.update(p[atom] for (_, p) in self.operations)
+            vectors = []
+            for k in range(3):
+                unit = [0.0] * (3 * natom)
+                unit[3 * atom + k] = 1.0
+                vector = self.symmetrize(unit)
+                for other in vectors:
+                    overlap = _dot(vector, other)
+                    vector = [v - overlap * o for (v, o) in zip(vector, other)]
+                length = _norm(vector)
+                if length > 1e-6:
+                    vectors.append([v / length for v in vector])
+            basis.extend(vectors)
+        return basis
+
+
+def _rotation_matrix(axis, angle):
+    """
+    Rotation by ``angle`` (radians) around unit vector ``axis`` (Rodrigues formula).
+    """
+    c, s = math.cos(angle), math.sin(angle)
+    x, y, z = axis
+    return [[c + x * x * (1 - c), x * y * (1 - c) - z * s, x * z * (1 - c) + y * s],
+            [y * x * (1 - c) + z * s, c + y * y * (1 - c), y * z * (1 - c) - x * s],
+            [z * x * (1 - c) - y * s, z * y * (1 - c) + x * s, c + z * z * (1 - c)]]
+
+
+def _reflection_matrix(normal):
+    return [[float(i == j) - 2 * normal[i] * normal[j] for j in range(3)] for i in range(3)]
+
+
+def _rotation_axis(matrix):
+    """
+    Unit axis of a proper rotation matrix.
+    """
+    axis = [matrix[2][1] - matrix[1][2], matrix[0][2] - matrix[2][0], matrix[1][0] - matrix[0][1]]
+    if _norm(axis) < 1e-3:  # half turn: any nonzero column of R + I
+        axis = max(([matrix[i][j] + (i == j) for i in range(3)] for j in range(3)), key=_norm)
+    length = _norm(axis) or 1.0
+    return [v / length for v in axis]
+
+
+def _matmul(a, b):
+    return [[sum(a[i][k] * b[k][j] for k in range(3)) for j in range(3)] for i in range(3)]
+
+
+def _trace(m):
+    return m[0][0] + m[1][1] + m[2][2]
+
+
+def _determinant(m):
+    return _dot(m[0], _cross(m[1], m[2]))
+
+
+########################################################################################
+# Per-step data store
+########################################################################################
+
+class StepStore(object):
+
+    """
+    Compact columnar store of per-step data. Each column is a file of raw
+    little-endian doubles (``<name>.f8``) with one fixed-size row per step, and
+    ``meta.json`` lists the columns, their row sizes and the number of complete
+    rows. Appending a step only appends bytes to each column, and the row count
+    is updated last, so an interrupted append is simply ignored. Columns added
+    in newer versions are filled with NaN for the existing rows.
+
+    Columns can be read whole or from a given row (``read``), or memory-mapped
+    (``mmap``), which returns a ``numpy.memmap`` if NumPy is available. Small
+    run-level values (thresholds, status) are kept in ``attributes``.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store. Created if needed.
+    natom : int, optional
+        Number of atoms, needed to create a new store.
+    readonly : bool, optional
+        Never write to the store: columns missing in old stores are not added.
+    """
+
+    COLUMNS = (
+        ('step', 1),
+        ('coordinates', 3),  # per atom; Angstrom
+        ('energy_a', 1),  # Hartree
+        ('energy_b', 1),
+        ('forces_a', 3),  # per atom; Hartree/Bohr, as printed by Gaussian
+        ('forces_b', 3),
+        ('gradient', 3),  # per atom; effective gradient, Hartree/Angstrom
+        ('parallel_gradient', 3),
+        ('perpendicular_gradient', 3),
+        ('max_gradient', 1),  # convergence criteria, as reported
+        ('rms_gradient', 1),
+        ('max_displacement', 1),
+        ('rms_displacement', 1),
+        ('delta_e', 1),
+        ('time', 1),  # UNIX time when the step was recorded
+        ('step_seconds', 1),  # wall time of the step
+        ('gaussian_seconds_a', 1),  # wall time of the Gaussian job(s) of each state
+        ('gaussian_seconds_b', 1),
+    )
+
+    def __init__(self, path, natom=None, readonly=False):
+        self.path = path
+        meta = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta):
+            with open(meta) as f:
+                self.meta = json.load(f)
+            missing = [(name, size) for (name, size) in self.COLUMNS
+                       if name not in self.meta['columns'] and not readonly]
+            for name, size in missing:
+                size = size if size == 1 else size * self.natom
+                with open(self._column_path(name), 'wb') as f:
+                    array('d', [float('nan')] * size * len(self)).tofile(f)
+                self.meta['columns'][name] = size
+            if missing:
+                self._write_meta()
+        elif natom:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.meta = {'natom': natom, 'nsteps': 0,
+                         'columns': dict((name, size if size == 1 else size * natom)
+                                         for (name, size) in self.COLUMNS)}
+            self._write_meta()
+        else:
+            raise ValueError('{} is not a step store'.format(path))
+
+    def __len__(self):
+        return self.meta['nsteps']
+
+    @property
+    def natom(self):
+        return self.meta['natom']
+
+    @property
+    def columns(self):
+        return sorted(self.meta['columns'])
+
+    @property
+    def attributes(self):
+        return self.meta.get('attributes', {})
+
+    def set_attributes(self, **values):
+        """
+        Store run-level values (JSON-serializable) in ``meta.json``.
+        """
+        self.meta.setdefault('attributes', {}).update(values)
+        self._write_meta()
+
+    def append(self, **values):
+        """
+        Append a row. Missing columns are filled with NaN.
+        """
+        unknown = set(values) - set(self.meta['columns'])
+        if unknown:
+            raise ValueError('Unknown columns: {}'.format(', '.join(sorted(unknown))))
+        nsteps = self.meta['nsteps']
+        for name, size in self.meta['columns'].items():
+            value = values.get(name)
+            if value is None:
+                value = [float('nan')] * size
+            elif not isinstance(value, (list, tuple)):
+                value = [value]
+            if len(value) != size:
+                raise ValueError('Column {} needs {} values'.format(name, size))
+            row = array('d', [float(v) for v in value])
+            if sys.byteorder != 'little':
+                row.byteswap()
+            path = self._column_path(name)
+            with open(path, 'ab') as f:
+                f.truncate(8 * size * nsteps)  # drop leftovers of interrupted appends
+                row.tofile(f)
+        self.meta['nsteps'] = nsteps + 1
+        self._write_meta()
+
+    def truncate(self, nsteps):
+        """
+        Drop the rows from ``nsteps`` on, like those of a step computed again.
+        """
+        if nsteps < len(self):
+            self.meta['nsteps'] = nsteps
+            self._write_meta()
+
+    def read(self, name, start=0):
+        """
+        Read a column as a list of rows (lists of floats; plain floats for
+        single-valued columns), from row ``start`` on. Negative values count
+        from the end, so ``read(name, -1)`` only reads the last row.
+        """
+        size = self.meta['columns'][name]
+        start = max(0, len(self) + start) if start < 0 else min(start, len(self))
+        values = array('d')
+        with open(self._column_path(name), 'rb') as f:
+            f.seek(8 * size * start)
+            values.fromfile(f, size * (len(self) - start))
+        if sys.byteorder != 'little':
+            values.byteswap()
+        if size == 1:
+            return values.tolist()
+        return [values[i:i+size].tolist() for i in range(0, len(values), size)]
+
+    def mmap(self, name):
+        """
+        Memory-map a column, without reading it. Returns a read-only
+        ``numpy.memmap`` with shape ``(steps, size)`` if NumPy is available, or
+        a ``memoryview`` of doubles with the same shape otherwise (Python 3; an
+        empty one-dimensional view if there are no steps yet).
+        """
+        size = self.meta['columns'][name]
+        shape = (len(self), size)
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        if np is not None:
+            if not len(self):
+                return np.empty(shape)
+            return np.memmap(self._column_path(name), dtype='<f8', mode='r', shape=shape)
+        if sys.byteorder != 'little' or not hasattr(memoryview, 'cast'):
+            raise RuntimeError('Memory-mapped columns need NumPy or Python 3 on '
+                               'little-endian machines; use read() instead')
+        if not len(self):
+            return memoryview(b'').cast('d')  # zeros in the shape are not supported
+        with open(self._column_path(name), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 8 * size * len(self), access=mmap.ACCESS_READ)
+        return memoryview(data).cast('d', list(shape))
+
+    def _column_path(self, name):
+        return os.path.join(self.path, name + '.f8')
+
+    def _write_meta(self):
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f)
+        getattr(os, 'replace', os.rename)(tmp, os.path.join(self.path, 'meta.json'))
+
+
+def latest_step_store(directory, readonly=False):
+    """
+    Per-step store of the most recent ``JOBS*`` directory of the calculation
+    in ``directory``, or None if there is none.
+    """
+    stores = [os.path.join(directory, d, 'steps') for d in os.listdir(directory)
+              if d.startswith('JOBS') and os.path.isfile(os.path.join(directory, d, 'steps',
+                                                                      'meta.json'))]
+    if stores:
+        return StepStore(max(stores, key=os.path.getmtime), readonly=readonly)
+
+
+def parse_criteria(report):
+    """
+    Extract the convergence criteria values from a ReportFile step block.
+
+    Returns
+    -------
+    criteria : dict
+        ``max_gradient``, ``rms_gradient``, ``max_displacement``,
+        ``rms_displacement`` and ``delta_e``, if found.
+    """
+    labels = {'Max Gradient El.:': 'max_gradient', 'RMS Gradient El.:': 'rms_gradient',
+              'Max Change of X:': 'max_displacement', 'RMS Change of X:': 'rms_displacement',
+              'Difference in E:': 'delta_e'}
+    criteria = {}
+    for line in report.splitlines():
+        for label, key in labels.items():
+            if line.startswith(label):
+                try:
+                    criteria[key] = float(line[len(label):].split()[0])
+                except (IndexError, ValueError):  # Fortran prints ***** on overflow
+                    pass
+    return criteria
+
+
+def compress_file(path):
+    """
+    Gzip ``path`` into ``path.gz`` and remove the original.
+    """
+    with open(path, 'rb') as src:
+        with gzip.open(path + '.gz.tmp', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    getattr(os, 'replace', os.rename)(path + '.gz.tmp', path + '.gz')
+    os.remove(path)
+
+
+def open_log(path):
+    """
+    Open a text file for reading, or its gzipped version (``path.gz``) if the
+    original is not available.
+    """
+    if not os.path.isfile(path) and os.path.isfile(path + '.gz'):
+        path += '.gz'
+    if path.endswith('.gz'):
+        if sys.version_info[0] >= 3:
+            return gzip.open(path, 'rt')
+        return gzip.open(path, 'rb')
+    return open(path)
+
+
+########################################################################################
+# Analysis
+########################################################################################
+
+def _numpy(feature='Analysis tools'):
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('{} require NumPy. Install it with `pip install numpy`.'.format(
+                          feature))
+    return numpy
+
+
+def load_run(path):
+    """
+    Load a whole MECP run as NumPy arrays, from the per-step store of its
+    latest ``JOBS*`` directory or, if there is none, from its ``ReportFile``.
+
+    Parameters
+    ----------
+    path : str
+        Calculation directory or ``ReportFile``
+
+    Returns
+    -------
+    run : dict
+        ``name``, ``numbers`` (atomic numbers), ``coordinates`` (steps, atoms, 3),
+        ``energy_a``, ``energy_b``, ``delta_e``, ``max_gradient``, ``rms_gradient``,
+        ``max_displacement``, ``rms_displacement`` (one value per step; NaN if
+        unknown) and ``converged``.
+
+    Raises
+    ------
+    ValueError
+        If there is neither a per-step store nor a ``ReportFile``
+    """
+    np = _numpy()
+    directory, report = (path, os.path.join(path, 'ReportFile')) if os.path.isdir(path) \
+        else (os.path.dirname(path) or os.curdir, path)
+    store = latest_step_store(directory)
+    converged, text = False, None
+    if os.path.isfile(report):
+        with open_log(report) as f:
+            text = f.read()
+        converged = 'CONVERGED' in text
+    if os.path.isdir(path) and store is not None:
+        trajectory = os.path.join(os.path.dirname(store.path), 'trajectory.xyz')
+        with open(trajectory) as f:
+            lines = f.readlines()[2:2 + store.natom]
+        numbers = [ELEMENTS.get(line.split()[0], 0) for line in lines]
+        run = dict((key, np.asarray(store.mmap(key))[:, 0])
+                   for key in ('energy_a', 'energy_b', 'delta_e', 'max_gradient',
+                               'rms_gradient', 'max_displacement', 'rms_displacement'))
+        run['coordinates'] = np.asarray(store.mmap('coordinates')).reshape(len(store), -1, 3)
+    elif text is None:
+        raise ValueError('{} has neither a per-step store nor a ReportFile'.format(path))
+    else:
+        numbers, run = _parse_report(text)
+    run.update(name=path, numbers=numbers, converged=converged)
+    return run
+
+
+def _parse_report(text):
+    """
+    Per-step data of a ReportFile, for ``load_run``.
+    """
+    np = _numpy()
+    blocks = re.split(r'^(?=Initial Geometry:|Geometry at Step)', text, flags=re.MULTILINE)
+    numbers, frames, rows = [], [], []
+    for block in blocks[1:]:
+        lines = block.splitlines()
+        atoms = []
+        for line in lines[1:]:
+            fields = line.split()
+            if len(fields) != 4:
+                break
+            atoms.append([float(v) for v in fields[1:]])
+            if not frames:
+                numbers.append(int(fields[0]))
+        energies = re.findall(r'^Energy of (?:First|Second) State:\s+(\S+)', block,
+                              flags=re.MULTILINE)
+        if len(energies) < 2:  # last geometry was never computed
+            break
+        frames.append(atoms)
+        rows.append([float(energies[0]), float(energies[1])] + [
+            parse_criteria(block).get(key, float('nan'))
+            for key in ('delta_e', 'max_gradient', 'rms_gradient', 'max_displacement',
+                        'rms_displacement')])
+    rows = np.array(rows, dtype=float).reshape(-1, 7)
+    run = dict(zip(('energy_a', 'energy_b', 'delta_e', 'max_gradient', 'rms_gradient',
+                    'max_displacement', 'rms_displacement'), rows.T))
+    run['coordinates'] = np.array(frames, dtype=float).reshape(len(frames), len(numbers), 3)
+    return numbers, run
+
+
+def kabsch_rmsd(a, b):
+    """
+    RMSD after optimal superposition (Kabsch) of geometries ``a`` and ``b``,
+    arrays of shape (..., atoms, 3) that are broadcast against each other.
+    """
+    np = _numpy()
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    a = a - a.mean(axis=-2, keepdims=True)
+    b = b - b.mean(axis=-2, keepdims=True)
+    a, b = np.broadcast_arrays(a, b)
+    h = np.einsum('...ni,...nj->...ij', a, b)
+    u, sigma, vt = np.linalg.svd(h)
+    sign = np.sign(np.linalg.det(np.matmul(u, vt)))
+    sigma[..., -1] *= np.where(sign == 0, 1, sign)
+    squared = (np.square(a).sum(axis=(-2, -1)) + np.square(b).sum(axis=(-2, -1))
+               - 2 * sigma.sum(axis=-1)) / a.shape[-2]
+    return np.sqrt(np.clip(squared, 0, None))
+
+
+def rmsd_matrix(geometries):
+    """
+    Kabsch-aligned RMSD between every pair of geometries, shape (n, atoms, 3).
+    """
+    np = _numpy()
+    geometries = np.asarray(geometries, dtype=float)
+    return kabsch_rmsd(geometries[:, None], geometries[None, :])
+
+
+def internal_coordinate_table(geometries, internals):
+    """
+    Values of ``internals`` (as returned by ``generate_internal_coordinates``)
+    for many geometries at once, shape (n, atoms, 3). Distances in Angstrom,
+    angles and dihedrals in degrees.
+
+    Returns
+    -------
+    values : array, shape (n, len(internals))
+    """
+    np = _numpy()
+    x = np.asarray(geometries, dtype=float)
+    values = np.empty((x.shape[0], len(internals)))
+    for kind in ('distance', 'angle', 'dihedral'):
+        columns = [n for (n, (k, _)) in enumerate(internals) if k == kind]
+        if not columns:
+            continue
+        atoms = np.array([internals[n][1] for n in columns])
+        points = [x[:, atoms[:, i]] for i in range(atoms.shape[1])]
+        if kind == 'distance':
+            result = np.linalg.norm(points[0] - points[1], axis=-1)
+        elif kind == 'angle':
+            u, v = points[0] - points[1], points[2] - points[1]
+            cos = (u * v).sum(-1) / np.linalg.norm(u, axis=-1) / np.linalg.norm(v, axis=-1)
+            result = np.degrees(np.arccos(np.clip(cos, -1, 1)))
+        else:
+            b1, b2, b3 = (points[1] - points[0], points[2] - points[1],
+                          points[3] - points[2])
+            n1, n2 = np.cross(b1, b2), np.cross(b2, b3)
+            result = np.degrees(np.arctan2(np.linalg.norm(b2, axis=-1) * (b1 * n2).sum(-1),
+                                           (n1 * n2).sum(-1)))
+        values[:, columns] = result
+    return values
+
+
+def analyze(paths, internals=False, curves=False, output=None):
+    """
+    Load and compare many runs: summary, Kabsch-aligned RMSD matrix of their
+    final geometries and, optionally, internal coordinates of the final
+    geometries and convergence curves. Everything can be written to a JSON file.
+    """
+    np = _numpy()
+    runs = [load_run(path) for path in paths]
+    results = {'runs': []}
+    print('{:40s} {:>5s} {:>9s} {:>16s} {:>16s} {:>10s} {:>10s}'.format(
+          'Run', 'Steps', 'Converged', 'Energy A', 'Energy B', 'Delta E', 'Max Grad'))
+    for run in runs:
+        last = (lambda key: float(run[key][-1]) if len(run[key]) else float('nan'))
+        print('{:40s} {:5d} {:>9s} {:16.8f} {:16.8f} {:10.6f} {:10.6f}'.format(
+              run['name'][-40:], len(run['energy_a']), 'yes' if run['converged'] else 'no',
+              last('energy_a'), last('energy_b'), abs(last('energy_a') - last('energy_b')),
+              last('max_gradient')))
+        results['runs'].append({
+            'name': run['name'], 'converged': run['converged'],
+            'energy_a': run['energy_a'].tolist(), 'energy_b': run['energy_b'].tolist(),
+            'delta_e': np.abs(run['energy_a'] - run['energy_b']).tolist(),
+            'max_gradient': run['max_gradient'].tolist()})
+    finals = [run['coordinates'][-1] for run in runs if len(run['coordinates'])]
+    if len(finals) == len(runs) and len(set(f.shape for f in finals)) == 1:
+        matrix = rmsd_matrix(finals)
+        results['rmsd'] = matrix.tolist()
+        if len(runs) > 1 and (len(runs) <= 12 or output is None):
+            print()
+            print('RMSD of final geometries (Angstrom, Kabsch-aligned):')
+            for n, row in enumerate(matrix):
+                print('{:3d} '.format(n + 1) + ' '.join('{:7.4f}'.format(v) for v in row))
+        if internals:
+            coordinates = generate_internal_coordinates(runs[0]['numbers'],
+                                                        finals[0].ravel().tolist())
+            table = internal_coordinate_table(finals, coordinates)
+            labels = ['{}{}'.format(kind[0].upper(), '-'.join(str(a + 1) for a in atoms))
+                      for (kind, atoms) in coordinates]
+            results['internals'] = {'labels': labels, 'values': table.tolist()}
+            print()
+            print('Internal coordinates of final geometries (Angstrom, degrees):')
+            print('{:14s}'.format('') + ''.join('{:>10d}'.format(n + 1) for n in range(len(runs))))
+            for label, column in zip(labels, table.T):
+                print('{:14s}'.format(label) + ''.join('{:10.4f}'.format(v) for v in column))
+    elif len(runs) > 1:
+        print('! Runs have different number of atoms; RMSD matrix not computed.')
+    if curves:
+        for n, run in enumerate(runs):
+            print()
+            print('Convergence of run {} ({}):'.format(n + 1, run['name']))
+            print('{:>5s} {:>12s} {:>12s} {:>12s}'.format('Step', 'Delta E', 'Max Grad',
+                                                          'Max Change'))
+            delta = np.abs(run['energy_a'] - run['energy_b'])
+            for step, row in enumerate(zip(delta, run['max_gradient'], run['max_displacement'])):
+                print('{:5d} {:12.8f} {:12.6f} {:12.6f}'.format(step, *row))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f)
+    return results
+
+
+########################################################################################
+# Service
+########################################################################################
+class MECPService(object):
+
+    """
+    Queue of MECP calculations (single-file Gaussian inputs) run in worker
+    processes while their cores (``%nproc``) fit in the core budget. Workers
+    are forked from the service, so they start with everything already
+    imported, and compiled MECP.x binaries are shared through ``compile_cache``.
+
+    Every job gets its own directory under ``workdir`` and a list of events
+    (``queued``, ``started``, one ``step`` per optimization step, read from
+    the per-step store, and ``finished``, ``failed`` or ``cancelled``).
+
+    Jobs received over the network (``serve``) are checked with ``check_request``:
+    they can only set ``REQUEST_OPTIONS``, while executables and paths are
+    settings of the service (``options``).
 
-    def parse_free_energy_and_frequencies(self, logfile):
+    Parameters
+    ----------
+    workdir : str
+        Directory where jobs are run
+    cores : int, optional
+        Core budget. Defaults to the number of CPUs.
+    poll : float, optional
+        Seconds between checks of the running jobs
+    options : dict, optional
+        ``MECPCalculation`` options for every job, like ``gaussian_exe``. Those
+        given when submitting a job take precedence.
+    """
+
+    FINAL_STATES = ('finished', 'failed', 'cancelled')
+    # Numbers and choices among fixed values; nothing that is run or names a path
+    REQUEST_OPTIONS = ('max_steps', 'natom', 'TDE', 'TDXMax', 'TDXRMS', 'TGMax', 'TGRMS',
+                       'energy_parser', 'trust_radius', 'gdiis_threshold', 'gdiis_history',
+                       'algorithm', 'coordinates', 'freeze', 'constraints', 'with_freq',
+                       'serial_freq', 'numerical_gradients', 'numerical_step',
+                       'numerical_jobs', 'job_timeout', 'stall_timeout', 'pair',
+                       'serial_states', 'results_from', 'symmetry', 'symmetry_tolerance',
+                       'surrogate', 'surrogate_tolerance', 'lbfgs_memory', 'keep_logs',
+                       'archive')
+    STEP_COLUMNS = ('step', 'energy_a', 'energy_b', 'delta_e', 'max_gradient',
+                    'rms_gradient', 'max_displacement', 'rms_displacement')
+
+    def __init__(self, workdir='easymecp_jobs', cores=0, poll=1.0, options=None):
+        import multiprocessing
+        self.workdir = os.path.abspath(workdir)
+        self.options = dict(options or {})
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        self.cores = int(cores) or multiprocessing.cpu_count()
+        self.poll = float(poll)
+        self.cache = os.path.join(self.workdir, 'cache')
+        self.jobs = {}
+        self._order = []
+        self._events = {}
+        self._processes = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._monitor = threading.Thread(target=self._watch)
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    def submit(self, text, options=None, cores=0, name=''):
         """
-        Extract vibrational frequencies from a Gaussian output file
+        Queue a job.
 
         Parameters
         ----------
-        logfile : str
-            Path to the Gaussian output file
+        text : str
+            Contents of a single-file Gaussian input, as accepted by
+            ``MECPCalculation.from_gaussian_input_file``
+        options : dict, optional
+            Additional ``MECPCalculation`` options, over those of the service.
+            Strings are cast as in configuration files.
+        cores : int, optional
+            Cores used by the job. Defaults to ``%nproc`` in the input, or 1,
+            which is also the minimum.
+        name : str, optional
+            Label of the job. Defaults to its id.
 
         Returns
         -------
-        frequencies : list of float, or None
-            Vibration frequencies of system. None if they could
-            not be found.
+        job : dict
+            Status of the new job
+        """
+        defaults = _get_defaults()
+        options = dict(self.options, **dict(options or {}))
+        for key, value in options.items():
+            if key not in defaults or key in ('a_header', 'b_header', 'geom', 'footer'):
+                raise ValueError('Option `{}` not recognized'.format(key))
+            if not isinstance(value, (bool, int, float)):
+                options[key] = coerce_option(key, '{}'.format(value))
+        options.setdefault('compile_cache', self.cache)
+        cores = max(int(cores or 0), input_cores(text))
+        with self._condition:
+            n = len(self._order) + 1
+            while os.path.exists(os.path.join(self.workdir, '{:04d}'.format(n))):
+                n += 1
+            job_id = '{:04d}'.format(n)
+            directory = os.path.join(self.workdir, job_id)
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'input.gjf'), 'w') as f:
+                f.write(text)
+            self.jobs[job_id] = {'id': job_id, 'name': name or job_id, 'state': 'queued',
+                                 'cores': int(cores), 'options': options,
+                                 'directory': directory, 'steps': 0, 'result': None,
+                                 'converged_at': None, 'error': None,
+                                 'submitted': time.time(), 'started': None, 'finished': None}
+            self._order.append(job_id)
+            self._events[job_id] = []
+            self._emit(self.jobs[job_id], 'queued')
+            self._schedule()
+            return dict(self.jobs[job_id])
+
+    def check_request(self, text, options=None):
+        """
+        Check a job received over the network before submitting it. Its options,
+        given or in ``! easymecp:`` comments of ``text``, must be in
+        ``REQUEST_OPTIONS`` (``energy_parser``, one of the built-in ones), and the
+        input cannot make Gaussian run other programs (``%subst``), include files
+        (``@file``) or use files outside of the job directory (absolute paths or
+        ``..`` in Link0 commands like ``%chk`` or ``%rwf``).
+
+        Raises
+        ------
+        ValueError
+            If the job is not accepted
+        """
+        given = dict(options or {})
+        given.update(re.findall(r'^! easymecp:?\s+(\S+)\s*=(\S+)', text, flags=re.MULTILINE))
+        for key in given:
+            if key not in self.REQUEST_OPTIONS:
+                raise ValueError('Option `{}` cannot be set by jobs; it is a setting of the '
+                                 'service'.format(key))
+        if '{}'.format(given.get('energy_parser', 'dft')) not in AVAILABLE_ENERGY_PARSERS:
+            raise ValueError('energy_parser must be one of <{}>'.format(
+                             ', '.join(sorted(AVAILABLE_ENERGY_PARSERS))))
+        if re.search(r'^\s*%subst\b', text, flags=re.MULTILINE | re.IGNORECASE):
+            raise ValueError('%subst is not accepted by the service')
+        if re.search(r'^\s*@', text, flags=re.MULTILINE):
+            raise ValueError('@ includes are not accepted by the service')
+        for key, value in re.findall(r'^\s*%(\w+)\s*=(.*)$', text, flags=re.MULTILINE):
+            for path in value.split(','):  # %rwf=a,2GB,b,2GB
+                path = path.strip()
+                if (path.startswith(('/', '\\', '~')) or re.match(r'[A-Za-z]:', path)
+                        or '..' in re.split(r'[/\\]', path)):
+                    raise ValueError('%{} must name a file in the job directory, not '
+                                     '{}'.format(key, path))
+
+    def status(self, job_id):
+        """Status of a job. Raises KeyError if unknown."""
+        with self._condition:
+            return dict(self.jobs[job_id])
+
+    def list(self):
+        """Status of all the jobs, in submission order."""
+        with self._condition:
+            return [dict(self.jobs[job_id]) for job_id in self._order]
+
+    def events(self, job_id, since=0, timeout=None):
+        """
+        Events of a job from index ``since`` on. If there are none yet and the
+        job is not over, wait up to ``timeout`` seconds for new ones.
+        """
+        with self._condition:
+            events = self._events[job_id]
+            if len(events) <= since and self.jobs[job_id]['state'] not in self.FINAL_STATES:
+                self._condition.wait(timeout)
+            return events[since:]
 
-        Notes
-        -----
+    def cancel(self, job_id):
+        """
+        Remove a queued job or stop a running one (Gaussian jobs included).
+        """
+        with self._condition:
+            job = self.jobs[job_id]
+            if job['state'] in self.FINAL_STATES:
+                return dict(job)
+            process = self._processes.get(job_id)
+            if process is not None:
+                try:  # workers lead their own process group
+                    os.killpg(process.pid, signal.SIGTERM)
+                except OSError:
+                    process.terminate()
+            job['state'] = 'cancelled'
+            job['finished'] = time.time()
+            self._emit(job, 'cancelled')
+            self._schedule()
+            return dict(job)
+
+    def shutdown(self):
+        """Cancel every pending job and stop monitoring."""
+        for job_id in list(self._order):
+            self.cancel(job_id)
+        with self._condition:
+            self._stopped = True
+            processes = list(self._processes.values())
+        for process in processes:
+            process.join()
+
+    def _emit(self, job, event, **data):
+        data.update(event=event, job=job['id'], time=time.time())
+        self._events[job['id']].append(data)
+        self._condition.notify_all()
+
+    def _schedule(self):
+        import multiprocessing
+        if self._stopped:
+            return
+        used = sum(job['cores'] for job in self.jobs.values() if job['state'] == 'running')
+        for job_id in self._order:
+            job = self.jobs[job_id]
+            if job['state'] != 'queued':
+                continue
+            if used and used + job['cores'] > self.cores:
+                break  # first come, first served; jobs larger than the budget run alone
+            process = multiprocessing.Process(target=_run_service_job,
+                                              args=(job['directory'], job['options']))
+            process.start()
+            self._processes[job_id] = process
+            job['state'] = 'running'
+            job['started'] = time.time()
+            used += job['cores']
+            self._emit(job, 'started', pid=process.pid)
+
+    def _watch(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                for job_id, process in list(self._processes.items()):
+                    job = self.jobs[job_id]
+                    if job['state'] == 'running':
+                        self._report_steps(job)
+                    if not process.is_alive():
+                        process.join()
+                        del self._processes[job_id]
+                        if job['state'] == 'running':
+                            self._finish(job, process.exitcode)
+                self._schedule()
+            time.sleep(self.poll)
+
+    def _report_steps(self, job):
+        try:
+            store = StepStore(os.path.join(job['directory'], 'JOBS', 'steps'))
+        except (IOError, OSError, ValueError):
+            return
+        if len(store) <= job['steps']:
+            return
+        columns = dict((name, store.read(name)) for name in self.STEP_COLUMNS)
+        for n in range(job['steps'], len(store)):
+            values = dict((name, columns[name][n]) for name in self.STEP_COLUMNS)
+            # NaN (unknown values) is not valid JSON
+            self._emit(job, 'step', **dict((name, None if value != value else value)
+                                           for (name, value) in values.items()))
+        job['steps'] = len(store)
+
+    def _finish(self, job, exitcode):
+        try:
+            with open(os.path.join(job['directory'], 'result.json')) as f:
+                summary = json.load(f)
+        except (IOError, OSError, ValueError):
+            summary = {'error': 'Worker exited with code {}'.format(exitcode)}
+        self._report_steps(job)
+        job['result'] = summary.get('result')
+        job['converged_at'] = summary.get('converged_at')
+        job['error'] = summary.get('error')
+        job['state'] = ('finished' if job['result'] not in (None, MECPCalculation.ERROR)
+                        and not exitcode else 'failed')
+        job['finished'] = time.time()
+        self._emit(job, job['state'], result=job['result'],
+                   converged_at=job['converged_at'], error=job['error'])
+
+
+def input_cores(text):
+    """
+    Cores requested by a Gaussian input (``%nproc``), or 1.
+    """
+    nproc = re.search(r'^%nproc(?:shared)?=(\d+)', text, re.MULTILINE | re.IGNORECASE)
+    return int(nproc.group(1)) if nproc else 1
 
-        Partially inspired by ``cclib.parser.gaussianparser``.
+
+def _run_service_job(directory, options):
+    """
+    Body of the worker processes of ``MECPService``: run the calculation in
+    ``directory`` and write its outcome to ``result.json``.
+    """
+    os.setsid()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit('! Terminated'))
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    os.chdir(directory)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log = os.open('output.log', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    summary = {'result': None}
+    try:
+        calc = MECPCalculation.from_gaussian_input_file('input.gjf', **options)
+        summary['result'] = calc.run()
+        summary['converged_at'] = calc.converged_at
+    except BaseException as e:
+        summary['error'] = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        with open('result.json', 'w') as f:
+            json.dump(summary, f)
+
+
+def format_event(event):
+    """One-line summary of a ``MECPService`` event."""
+    if event['event'] == 'step':
+        return ('[{}] Step {}: E(A) = {energy_a}, E(B) = {energy_b}, Delta E = {delta_e}, '
+                'Max Gradient = {max_gradient}'.format(event['job'], int(event['step']),
+                                                       **event))
+    details = ', '.join('{}={}'.format(key, event[key])
+                        for key in ('pid', 'result', 'converged_at', 'error')
+                        if event.get(key) is not None)
+    return '[{}] {}{}'.format(event['job'], event['event'], ' ({})'.format(details)
+                              if details else '')
+
+
+def serve(host='127.0.0.1', port=None, workdir='easymecp_jobs', cores=0, poll=1.0,
+          options=None):
+    """
+    Run a ``MECPService`` (with the given ``options`` for every job) behind a small
+    JSON-over-HTTP API until interrupted. There is no authentication, so jobs can
+    only set ``MECPService.REQUEST_OPTIONS``:
+
+    - ``POST /jobs`` with ``{"input": <text>, "options": {...}, "cores": N, "name": ...}``
+    - ``GET /jobs`` and ``GET /jobs/<id>``: status
+    - ``GET /jobs/<id>/events?since=N``: events as JSON lines, streamed until the job ends
+    - ``GET /jobs/<id>/report``: current ReportFile
+    - ``DELETE /jobs/<id>``: cancel
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:  # Py27
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    if port is None:
+        port = SERVICE_PORT
+    service = MECPService(workdir=workdir, cores=cores, poll=poll, options=options)
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            parts, query = self._route()
+            try:
+                if parts == ['jobs']:
+                    return self._send(200, service.list())
+                if len(parts) == 2 and parts[0] == 'jobs':
+                    return self._send(200, service.status(parts[1]))
+                if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+                    return self._stream(parts[1], int(query.get('since', 0)))
+                if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'report':
+                    path = os.path.join(service.status(parts[1])['directory'], 'ReportFile')
+                    with open(path) as f:
+                        return self._send(200, {'report': f.read()})
+            except (KeyError, IOError, OSError):
+                return self._send(404, {'error': 'Not found'})
+            self._send(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            parts, _ = self._route()
+            if parts != ['jobs']:
+                return self._send(404, {'error': 'Not found'})
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                service.check_request(request['input'], request.get('options'))
+                job = service.submit(request['input'], options=request.get('options'),
+                                     cores=request.get('cores', 0),
+                                     name=request.get('name', ''))
+            except (KeyError, TypeError, ValueError) as e:
+                return self._send(400, {'error': '{}'.format(e)})
+            self._send(201, job)
+
+        def do_DELETE(self):
+            parts, _ = self._route()
+            try:
+                if len(parts) == 2 and parts[0] == 'jobs':
+                    return self._send(200, service.cancel(parts[1]))
+            except KeyError:
+                pass
+            self._send(404, {'error': 'Not found'})
+
+        def _route(self):
+            path, _, query = self.path.partition('?')
+            return ([part for part in path.split('/') if part],
+                    dict(item.split('=', 1) for item in query.split('&') if '=' in item))
+
+        def _send(self, code, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _stream(self, job_id, since):
+            service.status(job_id)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            while True:
+                events = service.events(job_id, since, timeout=service.poll)
+                for event in events:
+                    self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+                self.wfile.flush()
+                since += len(events)
+                if (not events and
+                        service.status(job_id)['state'] in service.FINAL_STATES):
+                    return
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server((host, port), Handler)
+    print('easyMECP service listening on http://{}:{}/ ({} cores, jobs in {})'.format(
+          host, server.server_address[1], service.cores, service.workdir))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('Stopping easyMECP service...')
+        server.server_close()
+        service.shutdown()
+
+
+def parse_scan_values(text):
+    """
+    Parse scan values like ``1.8,2.0,2.2`` or ``1.8:2.6:0.2`` (start:stop:step,
+    both ends included). Both forms can be mixed.
+    """
+    values = []
+    for item in text.replace(' ', '').split(','):
+        fields = item.split(':')
+        try:
+            if len(fields) == 3:
+                start, stop, step = [float(v) for v in fields]
+                if not step or (stop - start) / step < 0:
+                    raise ValueError
+                values.extend(round(start + i * step, 10)
+                              for i in range(int(round((stop - start) / step)) + 1))
+            elif len(fields) == 1 and item:
+                values.append(float(item))
+            elif item:
+                raise ValueError
+        except ValueError:
+            raise ValueError('Scan values `{}` are not valid. Use v1,v2,... '
+                             'or start:stop:step'.format(item))
+    return values
+
+
+def seam_scan(text, coordinate, values, cores=0, options=None, workdir='easymecp_scan',
+              poll=1.0):
+    """
+    Relaxed scan along the crossing seam: one MECP search per value of
+    ``coordinate``, constrained to it, all run by a ``MECPService`` within
+    a shared core budget.
+
+    A point whose neighbour has converged starts from it (``warm_start``:
+    geometry, chk files and inverse Hessian). Free cores go to such points
+    first. Otherwise, a point is started from the input geometry, choosing
+    the one farthest from those already started (the first one is the
+    closest to the input geometry), so that several fronts advance at the
+    same time. Points next to a running one wait for it.
+
+    Parameters
+    ----------
+    text : str
+        Contents of a single-file Gaussian input
+    coordinate : str
+        Scanned coordinate as ``kind:atoms``, like in ``constraints``
+    values : list of float
+        Values of the coordinate (Angstrom or degrees), in scan order
+    cores : int, optional
+        Core budget. Defaults to the number of CPUs.
+    options : dict, optional
+        Additional ``MECPCalculation`` options for every point
+    workdir : str, optional
+        Directory where every point gets its own subdirectory
+
+    Returns
+    -------
+    points : list of dict
+        ``value``, ``status`` (of its job, see ``MECPService``), ``warm_start``
+        (index of the point it started from, or None) and ``energy_a`` and
+        ``energy_b`` at its last step.
+    """
+    scanned = parse_constraints(coordinate)
+    if len(scanned) != 1 or scanned[0][2] is not None:
+        raise ValueError('Scan coordinate must be a single kind:atoms, without target')
+    kind, atoms, _ = scanned[0]
+    if not values:
+        raise ValueError('No values to scan')
+    options = dict(options or {})
+    extra = options.pop('constraints', '')
+    numbers, x = parse_geometry(re.split(r'\n[ \t]*\n', text)[2].splitlines(True)[1:])
+    initial = INTERNAL_COORDINATES[kind](x, *atoms)[0]
+    if kind != 'distance':
+        initial = math.degrees(initial)
+    per_point = input_cores(text)
+    service = MECPService(workdir=workdir, cores=cores, poll=poll)
+    points = [{'value': value, 'job': None, 'warm_start': None, 'status': None}
+              for value in values]
+    n = len(points)
+
+    def state(i):
+        return points[i]['status']['state'] if points[i]['status'] else None
+
+    def usable(i):
+        return 0 <= i < n and state(i) == 'finished' and points[i]['status']['result'] == 'OK'
+
+    def active(i):
+        return 0 <= i < n and state(i) in ('queued', 'running')
+
+    def describe(i):
+        return 'Point {} ({} = {})'.format(i + 1, coordinate, points[i]['value'])
+
+    try:
+        while True:
+            for i, point in enumerate(points):
+                if point['job'] is None:
+                    continue
+                previous, point['status'] = state(i), service.status(point['job'])
+                if state(i) != previous and state(i) in service.FINAL_STATES:
+                    print('  {}: {} ({}, {} steps)'.format(describe(i), state(i),
+                          point['status']['result'] or point['status']['error'],
+                          point['status']['steps']))
+            if all(state(i) in service.FINAL_STATES for i in range(n)):
+                break
+            while True:
+                used = sum(point['status']['cores'] for (i, point) in enumerate(points)
+                           if active(i))
+                if used and used + per_point > service.cores:
+                    break
+                pending = [i for i in range(n) if points[i]['job'] is None]
+                warm = [(i, j) for i in pending for j in (i - 1, i + 1) if usable(j)]
+                cold = [i for i in pending if not active(i - 1) and not active(i + 1)]
+                started = [i for i in range(n) if points[i]['job'] is not None]
+                if warm:
+                    i, source = warm[0]
+                elif cold:
+                    source = None
+                    if started:
+                        i = max(cold, key=lambda i: min(abs(i - j) for j in started))
+                    else:
+                        i = min(cold, key=lambda i: abs(values[i] - initial))
+                else:
+                    break
+                constraint = '{}:{}:{}'.format(kind, ','.join(str(a + 1) for a in atoms),
+                                               values[i])
+                point_options = dict(options, constraints=';'.join(c for c in (extra, constraint)
+                                                                   if c))
+                if source is not None:
+                    point_options['warm_start'] = points[source]['status']['directory']
+                job = service.submit(text, options=point_options, cores=per_point,
+                                     name='{}={}'.format(coordinate, values[i]))
+                points[i].update(job=job['id'], status=job, warm_start=source)
+                print('  {}: started {}'.format(describe(i), 'from the input geometry'
+                      if source is None else 'from point {}'.format(source + 1)))
+            time.sleep(poll)
+    finally:
+        service.shutdown()
+    for point in points:
+        point['energy_a'] = point['energy_b'] = None
+        store = latest_step_store(point['status']['directory'])
+        if store is not None and len(store):
+            point['energy_a'] = store.read('energy_a')[-1]
+            point['energy_b'] = store.read('energy_b')[-1]
+    with open(os.path.join(service.workdir, 'scan.json'), 'w') as f:
+        json.dump({'coordinate': coordinate, 'points': points}, f, indent=1)
+    return points
+
+
+########################################################################################
+# Status
+########################################################################################
+
+CRITERIA = ('delta_e', 'max_gradient', 'rms_gradient', 'max_displacement', 'rms_displacement')
+
+
+def run_status(directory, window=5):
+    """
+    Progress of the calculation in ``directory``, read from its per-step store
+    only (``meta.json`` and the last ``window`` rows of a few columns), so it
+    stays cheap for hundreds of runs.
+
+    Returns
+    -------
+    status : dict or None
+        ``directory``, ``state`` (running, stopped, unknown or the result of the
+        run), ``step`` (last finished one), ``delta_e`` (Hartree), ``criteria`` and
+        ``thresholds`` (by criterion), ``gaussian_seconds`` (per state, last step),
+        ``step_seconds`` (mean of the last steps), ``elapsed`` (in the running step),
+        ``remaining_steps`` and ``eta`` (seconds). None if there is no store.
+    """
+    store = latest_step_store(directory, readonly=True)
+    if store is None:
+        return None
+    attributes = store.attributes
+    rows = {}
+    for name in ('step', 'time', 'step_seconds', 'energy_a', 'energy_b',
+                 'gaussian_seconds_a', 'gaussian_seconds_b') + CRITERIA:
+        values = store.read(name, -window) if name in store.meta['columns'] else []
+        rows[name] = [None if v != v else v for v in values]  # NaN -> None
+    last = lambda name: rows[name][-1] if rows[name] else None
+
+    state = attributes.get('result')
+    if state is None and 'pid' not in attributes:
+        state = 'unknown'  # written by an older version
+    elif state is None:
+        state = 'running'
+        if attributes.get('host') == (os.uname()[1] if hasattr(os, 'uname') else ''):
+            try:
+                os.kill(attributes['pid'], 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    state = 'stopped'
+    thresholds = attributes.get('thresholds', {})
+    step = last('step')
+    durations = [v for v in rows['step_seconds'] if v is not None]
+    step_seconds = sum(durations) / len(durations) if durations else None
+    elapsed = None
+    if state == 'running':
+        elapsed = time.time() - max(last('time') or 0, attributes.get('started', 0))
+    remaining = eta = None
+    if thresholds and state in ('running', 'stopped'):
+        steps = [v for v in rows['step'] if v is not None]
+        remaining = estimate_remaining_steps(steps, dict((name, rows[name]) for name in CRITERIA),
+                                             thresholds)
+        if remaining is not None and 'max_steps' in attributes:
+            done = 0 if step is None else int(step) + 1
+            remaining = min(remaining, attributes['max_steps'] - done)
+        if remaining is not None and step_seconds is not None:
+            eta = max(0.0, remaining * step_seconds - (elapsed or 0.0))
+    return {'directory': directory, 'state': state,
+            'step': None if step is None else int(step),
+            'delta_e': (None if None in (last('energy_a'), last('energy_b'))
+                        else last('energy_a') - last('energy_b')),
+            'criteria': dict((name, last(name)) for name in CRITERIA),
+            'thresholds': thresholds,
+            'gaussian_seconds': (last('gaussian_seconds_a'), last('gaussian_seconds_b')),
+            'step_seconds': step_seconds, 'elapsed': elapsed,
+            'remaining_steps': remaining, 'eta': eta}
+
+
+def estimate_remaining_steps(steps, criteria, thresholds):
+    """
+    Number of steps until every criterion meets its threshold, extrapolating the
+    trend of its logarithm over ``steps`` (least squares). None if a criterion
+    that is not met yet is not decreasing.
+    """
+    remaining = 0.0
+    for name, threshold in thresholds.items():
+        points = [(s, math.log(v)) for (s, v) in zip(steps, criteria.get(name, ()))
+                  if v is not None and v > 0]
+        if not points:
+            return None
+        target = math.log(threshold)
+        if points[-1][1] <= target:
+            continue
+        if len(points) < 2:
+            return None
+        mean_s = sum(s for (s, _) in points) / len(points)
+        mean_v = sum(v for (_, v) in points) / len(points)
+        slope = (sum((s - mean_s) * (v - mean_v) for (s, v) in points) /
+                 (sum((s - mean_s) ** 2 for (s, _) in points) or 1.0))
+        if slope >= 0:
+            return None
+        remaining = max(remaining, (points[-1][1] - target) / -slope)
+    return int(math.ceil(remaining))
+
+
+def format_status(statuses):
+    """
+    Table with one line per ``run_status`` result. Criteria are shown as multiples
+    of their thresholds, so values up to 1 are met.
+    """
+    def number(value, fmt):
+        return '-' if value is None else fmt.format(value)
+
+    def duration(seconds):
+        if seconds is None:
+            return '-'
+        minutes, seconds = divmod(int(round(seconds)), 60)
+        hours, minutes = divmod(minutes, 60)
+        return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+    width = max([len(s['directory']) for s in statuses] + [3])
+    lines = ['{:<{w}} {:>22} {:>5} {:>10} {:>6} {:>6} {:>6} {:>6} {:>6} {:>17} {:>8} {:>8}'.format(
+             'Run', 'State', 'Step', 'Delta E', 'dE', 'MaxG', 'RmsG', 'MaxX', 'RmsX',
+             'Gaussian A / B', 'Step', 'ETA', w=width)]
+    for status in statuses:
+        ratios = [None if status['criteria'][name] is None or name not in status['thresholds']
+                  else status['criteria'][name] / status['thresholds'][name] for name in CRITERIA]
+        state = status['state']
+        if status['elapsed'] is not None:
+            state += ' ({})'.format(duration(status['elapsed']))
+        lines.append('{:<{w}} {:>22} {:>5} {:>10} {:>6} {:>6} {:>6} {:>6} {:>6} {:>17} {:>8} {:>8}'.format(
+                     status['directory'], state, number(status['step'], '{:d}'),
+                     number(status['delta_e'], '{:.2e}'),
+                     *[number(r, '{:.2g}') for r in ratios] +
+                     ['{} / {}'.format(*[duration(t) for t in status['gaussian_seconds']]),
+                      duration(status['step_seconds']), duration(status['eta'])], w=width))
+    lines.append('Criteria as multiples of their thresholds (<= 1 is met). Step: mean wall '
+                 'time of the last steps.')
+    return '\n'.join(lines)
+
+
+def find_runs(paths):
+    """
+    Calculation directories in ``paths``: those with a per-step store or, for
+    directories without one (like the work directories of ``easymecp serve``
+    and ``easymecp scan``), their subdirectories that have one.
+    """
+    runs = []
+    for path in paths:
+        if latest_step_store(path, readonly=True) is not None:
+            runs.append(path)
+            continue
+        for name in sorted(os.listdir(path)):
+            subdirectory = os.path.join(path, name)
+            if os.path.isdir(subdirectory) and \
+                    latest_step_store(subdirectory, readonly=True) is not None:
+                runs.append(subdirectory)
+    return runs
+
+
+########################################################################################
+# Run index
+########################################################################################
+
+class RunIndex(object):
+
+    """
+    SQLite index of MECP runs, so thousands of them can be queried without
+    reading their directories: one row per run (``runs``) and one per step
+    (``steps``, linked by ``run_id``). The rows of a run are built by
+    ``index_record`` from its per-step store and replaced whenever the run is
+    indexed again.
+
+    Calculations with the ``index`` option update their rows after every step,
+    and ``easymecp index`` backfills existing run directories.
+
+    Parameters
+    ----------
+    path : str
+        SQLite database file. Created if needed.
+
+    Examples
+    --------
+
+    B3LYP runs that ended with a energy difference below 1e-5 in under 30 steps:
+
+    >>> RunIndex('runs.sqlite').find(level='b3lyp/6-31g*', delta_e_below=1e-5, steps_below=30)
+    """
+
+    RUN_COLUMNS = (
+        ('directory', 'TEXT UNIQUE NOT NULL'),  # absolute path
+        ('inputs_hash', 'TEXT'),  # SHA-1 of the Gaussian inputs of the first step
+        ('route', 'TEXT'),  # route of the first state
+        ('level', 'TEXT'),  # method/basis in the route, lowercase
+        ('natom', 'INTEGER'),
+        ('status', 'TEXT'),  # result of the run, or running, stopped, unknown
+        ('steps', 'INTEGER'),
+        ('converged_at', 'INTEGER'),
+        ('max_steps', 'INTEGER'),
+        ('energy_a', 'REAL'),  # last step, Hartree
+        ('energy_b', 'REAL'),
+    ) + tuple((name, 'REAL') for name in CRITERIA) + tuple(
+        ('threshold_' + name, 'REAL') for name in CRITERIA) + (
+        ('started', 'REAL'),  # UNIX times
+        ('updated', 'REAL'),
+        ('wall_seconds', 'REAL'),  # sum of the wall times of the steps
+        ('gaussian_seconds', 'REAL'),  # sum of the wall times of all Gaussian jobs
+        ('host', 'TEXT'),
+    )
+    STEP_COLUMNS = (
+        ('step', 'INTEGER'),
+        ('time', 'REAL'),
+        ('step_seconds', 'REAL'),
+        ('gaussian_seconds_a', 'REAL'),
+        ('gaussian_seconds_b', 'REAL'),
+        ('energy_a', 'REAL'),
+        ('energy_b', 'REAL'),
+    ) + tuple((name, 'REAL') for name in CRITERIA)
+    TIMEOUT = 60.0  # seconds to wait for other writers
+
+    def __init__(self, path):
+        self.path = path
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, {})'
+                                   .format(', '.join(' '.join(c) for c in self.RUN_COLUMNS)))
+                connection.execute('CREATE TABLE IF NOT EXISTS steps (run_id INTEGER NOT NULL '
+                                   'REFERENCES runs(id), {})'.format(
+                                   ', '.join(' '.join(c) for c in self.STEP_COLUMNS)))
+                connection.execute('CREATE INDEX IF NOT EXISTS steps_run ON steps (run_id)')
+        finally:
+            connection.close()
+
+    def _connect(self, readonly=False):
+        import sqlite3
+        if readonly:
+            try:
+                from urllib.request import pathname2url
+            except ImportError:  # Py27
+                from urllib import pathname2url
+            try:
+                connection = sqlite3.connect('file:{}?mode=ro'.format(
+                    pathname2url(os.path.abspath(self.path))), timeout=self.TIMEOUT, uri=True)
+            except TypeError:  # Py27: no URIs
+                connection = sqlite3.connect(self.path, timeout=self.TIMEOUT)
+                connection.execute('PRAGMA query_only = ON')
+            # ATTACH would create (and write) other databases
+            connection.set_authorizer(
+                lambda action, *args: sqlite3.SQLITE_DENY if action in
+                (sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH) else sqlite3.SQLITE_OK)
+        else:
+            connection = sqlite3.connect(self.path, timeout=self.TIMEOUT)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def add(self, records):
         """
-        energy, frequencies = None, None
-        with open(logfile) as f:
-            for line in f:
-                if line[1:14] == "Harmonic freq":  # enter the frequency block
-                    frequencies = []
-                    while line.strip():
-                        if line[1:15] == "Frequencies --":
-                            frequencies.extend([float(x) for x in line[15:].split()])
-                        line = next(f)
-                elif line[1:44] == "Sum of electronic and thermal Free Energies":
-                    energy = float(line.split()[-1])
-        return energy, frequencies
+        Insert ``index_record`` results, replacing the previous rows of their runs,
+        in a single transaction.
 
-    def report(self, *msg):
+        Returns
+        -------
+        count : int
+            Number of runs added
         """
-        Print wrapper to write into `ReportFile`.
+        run_columns = [name for (name, _) in self.RUN_COLUMNS]
+        step_columns = ['run_id'] + [name for (name, _) in self.STEP_COLUMNS]
+        count = 0
+        connection = self._connect()
+        try:
+            with connection:
+                for run, steps in records:
+                    self._delete(connection, run['directory'])
+                    cursor = connection.execute(
+                        'INSERT INTO runs ({}) VALUES ({})'.format(
+                            ', '.join(run_columns), ', '.join('?' * len(run_columns))),
+                        [run.get(name) for name in run_columns])
+                    connection.executemany(
+                        'INSERT INTO steps ({}) VALUES ({})'.format(
+                            ', '.join(step_columns), ', '.join('?' * len(step_columns))),
+                        [[cursor.lastrowid] + [step.get(name) for name in step_columns[1:]]
+                         for step in steps])
+                    count += 1
+        finally:
+            connection.close()
+        return count
+
+    def add_run(self, directory, store=None):
         """
-        with open('ReportFile', 'a') as r:
-            print(*msg, file=r)
+        Index the run in ``directory`` (see ``index_record``). Returns whether it
+        had anything to index.
+        """
+        record = index_record(directory, store=store)
+        return bool(record and self.add([record]))
 
-    def add_trajectory_step(self, geometry='geom', step=0):
+    def remove(self, directory):
         """
-        Add a new step to the current trajectory file, in xyz format.
+        Remove the rows of the run in ``directory``.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                self._delete(connection, os.path.abspath(directory))
+        finally:
+            connection.close()
 
-        Parameters
-        ----------
-        geometry : str
-            Path to XYZ file containing new geometry
-        step : int
-            Optimization step
+    def _delete(self, connection, directory):
+        connection.execute('DELETE FROM steps WHERE run_id IN '
+                           '(SELECT id FROM runs WHERE directory = ?)', (directory,))
+        connection.execute('DELETE FROM runs WHERE directory = ?', (directory,))
+
+    def query(self, sql, parameters=()):
         """
-        with open(self.jobsdir + '/trajectory.xyz', 'a') as f:
-            print(self.natom, file=f)
-            print('Step', step, file=f)
-            with open(geometry) as g:
-                print(element_number_to_symbol(g, drop_blank=True), file=f)
+        Run a SQL query on the index and return its rows as dicts. The database
+        is opened read-only, so statements that would change it fail.
+        """
+        connection = self._connect(readonly=True)
+        try:
+            return [dict(zip(row.keys(), row)) for row in connection.execute(sql, parameters)]
+        finally:
+            connection.close()
+
+    def find(self, level=None, route=None, status=None, natom=None, inputs_hash=None,
+             delta_e_below=None, steps_below=None, directory=None):
+        """
+        Runs (``runs`` rows, as dicts) that match all the given conditions, sorted
+        by directory. ``level`` (case-insensitive), ``route`` and ``directory`` are
+        matched as substrings; ``delta_e_below`` applies to the last energy
+        difference and ``steps_below`` to the number of steps.
+        """
+        conditions, parameters = [], []
+        for column, value in (('level', level), ('route', route), ('directory', directory)):
+            if value is not None:
+                conditions.append('instr(lower({}), ?) > 0'.format(column))
+                parameters.append(value.lower())
+        for column, value in (('status', status), ('natom', natom),
+                              ('inputs_hash', inputs_hash)):
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                parameters.append(value)
+        if delta_e_below is not None:
+            conditions.append('delta_e < ?')
+            parameters.append(float(delta_e_below))
+        if steps_below is not None:
+            conditions.append('steps < ?')
+            parameters.append(int(steps_below))
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return self.query('SELECT * FROM runs{} ORDER BY directory'.format(where), parameters)
+
+    def steps(self, directory):
+        """
+        ``steps`` rows (as dicts) of the run in ``directory``, in order.
+        """
+        return self.query('SELECT steps.* FROM steps JOIN runs ON runs.id = steps.run_id '
+                          'WHERE runs.directory = ? ORDER BY steps.rowid',
+                          (os.path.abspath(directory),))
+
+
+def index_record(directory, store=None):
+    """
+    Rows of the run in ``directory`` for ``RunIndex``, read from its per-step
+    store (``store``, or the latest one) and the Gaussian inputs of its first
+    step, which give the inputs hash and the route.
+
+    Returns
+    -------
+    record : tuple or None
+        ``runs`` row and list of ``steps`` rows, as dicts. None if the run has
+        no per-step store.
+    """
+    directory = os.path.abspath(directory)
+    if store is None:
+        store = latest_step_store(directory, readonly=True)
+    else:
+        store = StepStore(store, readonly=True)
+    if store is None:
+        return None
+    columns = [name for (name, _) in RunIndex.STEP_COLUMNS]
+    data = {}
+    for name in columns:
+        values = store.read(name) if name in store.meta['columns'] else [None] * len(store)
+        data[name] = [None if v is None or v != v else v for v in values]  # NaN -> None
+    steps = [dict((name, data[name][i]) for name in columns) for i in range(len(store))]
+    last = steps[-1] if steps else {}
+
+    jobsdir = os.path.dirname(store.path)
+    inputs = sorted(name for name in os.listdir(jobsdir) if re.match(r'^Job0_[A-Z]+\.gjf$', name))
+    digest, route = hashlib.sha1(), None
+    for name in inputs:
+        with open(os.path.join(jobsdir, name)) as f:
+            text = f.read()
+        digest.update(text.encode('utf-8'))
+        if route is None:
+            route = ' '.join(re.findall(r'^#.*$', text, flags=re.MULTILINE)) or None
+
+    attributes = store.attributes
+    state = (run_status(directory, window=1) or {}).get('state', 'unknown')
+    thresholds = attributes.get('thresholds', {})
+    delta_e = last.get('delta_e')
+    if delta_e is None and None not in (last.get('energy_a'), last.get('energy_b')):
+        delta_e = abs(last['energy_a'] - last['energy_b'])
+    run = {'directory': directory, 'inputs_hash': digest.hexdigest() if inputs else None,
+           'route': route, 'level': route_level(route), 'natom': store.natom,
+           'status': state, 'steps': len(steps),
+           'converged_at': (int(last['step']) if state == MECPCalculation.OK and
+                            last.get('step') is not None else None),
+           'max_steps': attributes.get('max_steps'), 'energy_a': last.get('energy_a'),
+           'energy_b': last.get('energy_b'), 'started': attributes.get('started'),
+           'updated': last.get('time'),
+           'wall_seconds': sum(step['step_seconds'] or 0.0 for step in steps),
+           'gaussian_seconds': sum((step['gaussian_seconds_a'] or 0.0) +
+                                   (step['gaussian_seconds_b'] or 0.0) for step in steps),
+           'host': attributes.get('host')}
+    run.update((name, last.get(name)) for name in CRITERIA)
+    run['delta_e'] = delta_e
+    run.update(('threshold_' + name, thresholds.get(name)) for name in CRITERIA)
+    return run, steps
+
+
+def route_level(route):
+    """
+    Level of theory in a Gaussian route (the first ``method/basis`` keyword,
+    like ``b3lyp/6-31g*`` or ``oniom(b3lyp/6-31g*:amber)``), in lowercase.
+    None if there is none.
+    """
+    for keyword in (route or '').split()[1:]:
+        if '/' in keyword and '=' not in keyword.split('/')[0]:
+            return keyword.lower()
+    return None
+
+
+def index_runs(paths, database, jobs=0):
+    """
+    Backfill the index in ``database`` with the runs found in ``paths`` (see
+    ``find_runs``), reading them in ``jobs`` parallel processes (default: all CPUs).
+
+    Returns
+    -------
+    count : int
+        Number of runs indexed
+    """
+    import multiprocessing
+    index = RunIndex(database)
+    runs = find_runs(paths)
+    jobs = min(int(jobs) or multiprocessing.cpu_count(), len(runs))
+    if jobs <= 1:
+        return index.add(r for r in map(index_record, runs) if r)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return index.add(r for r in pool.imap_unordered(index_record, runs, chunksize=8) if r)
+    finally:
+        pool.close()
+        pool.join()
 
 
 ########################################################################################
@@ -941,6 +5267,37 @@ def _parse_energy_td(f, line, fields, default=None):
     return default
 
 
+def _parse_energy_oniom(f, line, fields, default=None):
+    if len(fields) > 4 and fields[0] == 'ONIOM:' and fields[1] == 'extrapolated':
+        return float(fields[4])
+    return default
+
+
+def read_fchk(path, keys):
+    """
+    Read the fields named in ``keys`` from a Gaussian formatted checkpoint file
+    (or its gzipped version) in a single pass. Scalars are returned as numbers and
+    arrays as lists; missing fields are left out.
+    """
+    with open_log(path) as f:
+        text = f.read()
+    fields = {}
+    for key in keys:
+        match = re.search(r'^' + re.escape(key) + r'\s+([IR])\s+(?:N=\s*(\d+)|(\S+))[ \t]*$',
+                          text, flags=re.MULTILINE)
+        if not match:
+            continue
+        cast = int if match.group(1) == 'I' else float
+        if match.group(2) is None:
+            fields[key] = cast(match.group(3))
+            continue
+        size = int(match.group(2))
+        rows = -(-size // (6 if cast is int else 5))
+        lines = text[match.end():].split('\n', rows + 1)[1:rows + 1]
+        fields[key] = [cast(v) for v in ' '.join(lines).split()]
+    return fields
+
+
 ########################################################################################
 # Validators
 ########################################################################################
@@ -954,6 +5311,38 @@ def fortran_double(value, key=None):
         return value
 
 
+def coerce_option(key, value):
+    """
+    Cast a string value (from config files or ``! easymecp:`` comments)
+    to the type expected by ``MECPCalculation`` for ``key``.
+    """
+    if key in ('TDE', 'TDXMax', 'TDXRMS', 'TGMax', 'TGRMS'):
+        return fortran_double(value, key)
+    default = _get_defaults().get(key)
+    if isinstance(default, bool):
+        return value.lower() in ('true', 'yes', 'y', '1')
+    if isinstance(default, (int, float)):
+        try:
+            return type(default)(value)
+        except ValueError:
+            raise ValueError('Value {} for {} must be a valid {}'.format(
+                             value, key, type(default).__name__))
+    return value
+
+
+def which(name):
+    """
+    Full path to executable ``name`` if found in ``$PATH``, else None.
+    """
+    try:
+        return shutil.which(name)
+    except AttributeError:  # Py27
+        for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+
+
 def extant_file(path, name=None, allow_errors=False):
     """ Verify file exists or report error """
     if os.path.isfile(path):
@@ -972,6 +5361,91 @@ def extant_file(path, name=None, allow_errors=False):
 ########################################################################################
 # Helpers
 ########################################################################################
+def _split_gaussian_input(lines):
+    """
+    Split the lines of a single-file Gaussian input (see
+    ``MECPCalculation.from_gaussian_input_file``) into the options given in
+    ``! easymecp:`` comments (over the defaults), the header lines of each state,
+    the geometry lines and the footer lines.
+    """
+    def _process_header_line(line):
+        groups = re.findall(r'{([^{}]*,[^{}]*)}', line)
+        if not groups:
+            return [line]
+        values = [group.split(',') for group in groups]
+        if len(set(len(v) for v in values)) > 1:
+            raise ValueError('All {{...}} groups must have the same number of '
+                             'values: {}'.format(line.strip()))
+        lines = []
+        for i in range(len(values[0])):
+            new_line = line
+            for group, v in zip(groups, values):
+                new_line = new_line.replace('{' + group + '}', v[i].strip(), 1)
+            lines.append(new_line)
+        return lines
+
+    def _add_header_line(line):
+        variants = _process_header_line(line)
+        if len(variants) > 1:
+            if len(headers) == 1:
+                headers.extend([list(headers[0]) for _ in variants[1:]])
+            elif len(variants) != len(headers):
+                raise ValueError('Found {} states in line {!r}, but {} in previous '
+                                 'lines'.format(len(variants), line.strip(), len(headers)))
+        for i, header in enumerate(headers):
+            header.append(variants[i] if len(variants) > 1 else line)
+
+    d = _get_defaults()
+    section = 0
+    headers, geom, footer, route, given = [[]], None, [], [], set()
+    # Parse Gaussian input files into header(s), geometry and footer
+    for line in lines:
+        # Detect sections
+        if not line.strip():
+            section += 1
+
+        # Assign lines to sections
+        # <HEADER>
+        if section <= 1:
+            _add_header_line(line)
+            if section == 0 and not line.startswith(('%', '!')):
+                route.append(line)
+        elif section == 2:
+            if not line.strip():
+                _add_header_line(line)
+            elif geom is None:
+                _add_header_line(line)
+                geom = []
+        # </HEADER>
+        # <GEOM>
+            else:
+                # Everything above is part of the header
+                geom.append(line)
+        # </GEOM>
+        # <FOOTER>
+        elif section >= 3:
+            footer.append(line)
+        #</FOOTER>
+
+        # Detect special comments
+        if line.startswith('!'):
+            match = re.search(r'^! easymecp:?\s+(\S+)\s*=(\S+)', line)
+            if match:
+                key = match.group(1)
+                value = match.group(2)
+                if key in d and key not in ('a_header', 'b_header', 'states',
+                                            'geom', 'footer'):
+                    d[key] = coerce_option(key, value)
+                    given.add(key)
+    if ('energy_parser' not in given and
+            re.search(r'\boniom\s*\(', ''.join(route), flags=re.IGNORECASE)):
+        d['energy_parser'] = 'oniom'
+
+    if len(headers) == 1:
+        headers.append(list(headers[0]))
+    return d, headers, geom, footer
+
+
 def _get_defaults():
     _defaults = MECPCalculation.__init__.__defaults__
     _ndef = len(_defaults)
@@ -994,17 +5468,164 @@ def temporary_directory(enter=True, remove=True, **kwargs):
         shutil.rmtree(temp_dir)
 
 
+def read_geometry(path):
+    """
+    Read a Gaussian-formatted geometry file.
+
+    Returns
+    -------
+    numbers : list of int
+        Atomic numbers
+    coordinates : list of float
+        Flattened cartesian coordinates
+    """
+    with open(path) as f:
+        return parse_geometry(f)
+
+
+def parse_geometry(lines):
+    """
+    Like ``read_geometry``, for an iterable of lines.
+    """
+    numbers, coordinates = [], []
+    for line in element_symbol_to_number(lines).splitlines():
+        fields = line.split()
+        if len(fields) >= 4 and not line.startswith('!'):
+            numbers.append(int(fields[0]))
+            coordinates.extend(float(v) for v in fields[-3:])
+    return numbers, coordinates
+
+
+def parse_frozen_atoms(lines):
+    """
+    Return the 0-based indices of atoms marked as frozen (``-1`` flag after the
+    element, Gaussian style) in the lines of a geometry file.
+    """
+    frozen = []
+    atoms = [line.split() for line in lines if len(line.split()) >= 4 and not line.startswith('!')]
+    for i, fields in enumerate(atoms):
+        if _coordinates_index(fields) == 2 and fields[1] == '-1':
+            frozen.append(i)
+    return frozen
+
+
+def parse_oniom_atoms(lines):
+    """
+    Atom specifications in the lines of an ONIOM geometry file, so they can be
+    written back with new coordinates: for each atom, the fields before the
+    coordinates (``element-type-charge`` and freeze flag) and after them (layer
+    and link atom). None if the file has no ONIOM specifications.
+    """
+    atoms = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 4 and not line.startswith('!'):
+            i = _coordinates_index(fields)
+            atoms.append((fields[:i], fields[i + 3:]))
+    if not any(suffix or '-' in prefix[0] for (prefix, suffix) in atoms):
+        return None
+    return atoms
+
+
+def _coordinates_index(fields):
+    """
+    Position of the first coordinate in the fields of a geometry line: after the
+    atom (element, or ONIOM's ``element-type-charge``) and the optional freeze flag.
+    """
+    if len(fields) >= 5 and fields[1] in ('0', '-1'):
+        try:
+            float(fields[4])
+            return 2
+        except ValueError:
+            pass
+    return 1
+
+
+def _format_atom_line(prefix, xyz, suffix=()):
+    """
+    Geometry line with the atom fields in ``prefix``, coordinates ``xyz`` and
+    ONIOM fields in ``suffix``.
+    """
+    return '{} {:14.8f}{:14.8f}{:14.8f} {}'.format(' '.join(prefix), xyz[0], xyz[1], xyz[2],
+                                                   ' '.join(suffix)).rstrip()
+
+
+def _element_symbol(spec):
+    """
+    Element of an atom specification, like ``C-CT--0.12(PDBName=CA)`` (ONIOM).
+    """
+    return re.split(r'[-(]', spec)[0]
+
+
+def parse_atom_list(text):
+    """
+    Parse 1-based atom indices and ranges, like ``1,2,5-8``, into a list of
+    0-based indices.
+    """
+    atoms = []
+    for item in text.replace(' ', '').split(','):
+        if not item:
+            continue
+        try:
+            if '-' in item:
+                first, last = item.split('-')
+                atoms.extend(range(int(first) - 1, int(last)))
+            else:
+                atoms.append(int(item) - 1)
+        except ValueError:
+            raise ValueError('Atom list `{}` is not valid (use 1-based indices '
+                             'and ranges, like 1,2,5-8)'.format(text))
+    return atoms
+
+
+def parse_constraints(text):
+    """
+    Parse geometric constraints like ``distance:1,2:1.5;angle:1,2,3``.
+
+    Each constraint is ``kind:atoms[:target]``, with 1-based atom indices.
+    Distances are given in Angstrom, angles and dihedrals in degrees. If the target is
+    omitted, the value in the starting geometry is kept.
+
+    Returns
+    -------
+    constraints : list of (str, tuple of int, float or None)
+        Kind, 0-based atom indices and target (Angstrom or radians)
+    """
+    constraints = []
+    for item in text.replace(' ', '').split(';'):
+        if not item:
+            continue
+        fields = item.split(':')
+        kind = fields[0].lower()
+        if kind not in INTERNAL_COORDINATES or len(fields) not in (2, 3):
+            raise ValueError('Constraint `{}` is not valid. Use kind:atoms[:target], with kind '
+                             'one of <{}>'.format(item, ', '.join(sorted(INTERNAL_COORDINATES))))
+        atoms = tuple(int(a) - 1 for a in fields[1].split(','))
+        if len(atoms) != INTERNAL_COORDINATE_SIZES[kind]:
+            raise ValueError('Constraint `{}` needs {} atoms'.format(
+                             item, INTERNAL_COORDINATE_SIZES[kind]))
+        target = float(fields[2]) if len(fields) == 3 else None
+        if target is not None and kind != 'distance':
+            target = math.radians(target)
+        constraints.append((kind, atoms, target))
+    return constraints
+
+
 def element_symbol_to_number(fh, drop_blank=True):
     elements = ELEMENTS
     lines = []
     for line in fh:
         if drop_blank and not line.strip():
             continue
+        fields = _drop_atom_extras(line)
+        if fields is not None:
+            line = '{} {} {} {}\n'.format(*fields)
         fields = line.split()
         if len(fields) > 3:
             if not fields[0].isdigit():
-                number = elements.get(fields[0].title(), -1)
-                line = line.replace(fields[0], str(number))
+                symbol = _element_symbol(fields[0])
+                number = symbol if symbol.isdigit() else elements.get(symbol.title(), -1)
+                line = line.replace(fields[0], str(number), 1)
         lines.append(line)
     return ''.join(lines)
 
@@ -1015,15 +5636,34 @@ def element_number_to_symbol(fh, drop_blank=False):
     for line in fh:
         if drop_blank and not line.strip():
             continue
+        fields = _drop_atom_extras(line)
+        if fields is not None:
+            line = '{} {} {} {}\n'.format(*fields)
         fields = line.split()
         if len(fields) > 3:
             if fields[0].isdigit():
                 symbol = elements.get(int(fields[0]), 'LP')
-                line = line.replace(fields[0], symbol, 1)
+            else:
+                symbol = _element_symbol(fields[0])
+            line = line.replace(fields[0], symbol, 1)
         lines.append(line)
     return ''.join(lines)
 
 
+def _drop_atom_extras(line):
+    """
+    Atom and coordinates of a geometry line with Gaussian freeze flags or ONIOM
+    layers, or None if there is nothing to drop.
+    """
+    fields = line.split()
+    if len(fields) < 4 or line.startswith('!'):
+        return None
+    i = _coordinates_index(fields)
+    if i == 1 and len(fields) == 4:
+        return None
+    return [fields[0]] + fields[i:i + 3]
+
+
 ########################################################################################
 # App
 ########################################################################################
@@ -1047,13 +5687,214 @@ def _parse_cli():
             kwargs = {'action': 'store_true'}
         else:
             kwargs = {'action': 'store', 'metavar': 'VALUE', 'type': type(v)}
-        p.add_argument('--'+k, default=v, help='{} (default={!r})'.format(USAGE[k], v),
-                       **kwargs)
+        help = '{} (default={!r})'.format(USAGE[k], v).replace('%', '%%')
+        p.add_argument('--'+k, default=v, help=help, **kwargs)
     args = p.parse_args()
     return args
 
 
+def _analyze_main(argv):
+    p = argparse.ArgumentParser(prog='easymecp analyze',
+                                description='Analyze and compare finished or running MECP '
+                                            'calculations. Requires NumPy.')
+    p.add_argument('runs', nargs='+', metavar='RUN',
+                   help='Calculation directories or ReportFiles')
+    p.add_argument('--internals', action='store_true',
+                   help='Print bonds, angles and dihedrals of the final geometries')
+    p.add_argument('--curves', action='store_true',
+                   help='Print Delta E, max gradient and max change for every step')
+    p.add_argument('--json', metavar='PATH', help='Write all the results to a JSON file')
+    args = p.parse_args(argv)
+    analyze(args.runs, internals=args.internals, curves=args.curves, output=args.json)
+
+
+def _status_main(argv):
+    p = argparse.ArgumentParser(prog='easymecp status',
+                                description='Progress of running or finished calculations: '
+                                            'current step, convergence criteria, timings and '
+                                            'estimated time to convergence.')
+    p.add_argument('runs', nargs='*', default=[os.curdir], metavar='DIR',
+                   help='Calculation directories, or directories that contain them '
+                        '(default: current directory)')
+    p.add_argument('--watch', type=float, default=0, metavar='SECONDS',
+                   help='Refresh the view every SECONDS until no calculation is running')
+    p.add_argument('--json', action='store_true', help='Print JSON instead of a table')
+    args = p.parse_args(argv)
+    try:
+        while True:
+            statuses = [s for s in (run_status(run) for run in find_runs(args.runs)) if s]
+            if args.json:
+                print(json.dumps(statuses, indent=1))
+            else:
+                if args.watch:
+                    sys.stdout.write('\033[H\033[2J')  # clear terminal
+                    print('easymecp status -', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                print(format_status(statuses))
+            sys.stdout.flush()
+            if not args.watch or not any(s['state'] == 'running' for s in statuses):
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+
+
+def _index_main(argv):
+    p = argparse.ArgumentParser(prog='easymecp index',
+                                description='Add runs to a SQLite index (one row per run and '
+                                            'per step) and query it.')
+    p.add_argument('runs', nargs='*', metavar='DIR',
+                   help='Calculation directories, or directories that contain them, to '
+                        'add to the index before querying it')
+    p.add_argument('--db', default=os.environ.get('EASYMECP_INDEX') or 'easymecp_index.sqlite',
+                   help='Index database (default: $EASYMECP_INDEX or %(default)s)')
+    p.add_argument('--jobs', type=int, default=0,
+                   help='Processes reading the runs (default: all CPUs)')
+    p.add_argument('--level', help='Runs whose level of theory contains this text')
+    p.add_argument('--route', help='Runs whose route contains this text')
+    p.add_argument('--status', help='Runs in this state, like OK or running')
+    p.add_argument('--delta-e-below', type=float, metavar='HARTREE',
+                   help='Runs that ended with a smaller energy difference')
+    p.add_argument('--steps-below', type=int, metavar='N', help='Runs with fewer steps')
+    p.add_argument('--sql', help='Run this read-only query instead (tables: runs, steps)')
+    p.add_argument('--json', action='store_true', help='Print JSON instead of a table')
+    args = p.parse_args(argv)
+    if args.runs:
+        print('Indexed {} runs in {}'.format(index_runs(args.runs, args.db, jobs=args.jobs),
+                                             args.db), file=sys.stderr)
+    index = RunIndex(args.db)
+    if args.sql:
+        rows = index.query(args.sql)
+    else:
+        rows = index.find(level=args.level, route=args.route, status=args.status,
+                          delta_e_below=args.delta_e_below, steps_below=args.steps_below)
+    if args.json:
+        print(json.dumps(rows, indent=1))
+    elif args.sql:
+        for row in rows:
+            print('\t'.join(str(v) for v in row.values()))
+    else:
+        number = lambda value, fmt: '-' if value is None else fmt.format(value)
+        width = max([len(row['directory']) for row in rows] + [3])
+        print('{:<{w}} {:>22} {:>5} {:>10} {:>8} {:>9}  {}'.format(
+              'Run', 'Status', 'Steps', 'Delta E', 'Atoms', 'Gaussian', 'Level', w=width))
+        for row in rows:
+            print('{:<{w}} {:>22} {:>5} {:>10} {:>8} {:>9}  {}'.format(
+                  row['directory'], row['status'], row['steps'],
+                  number(row['delta_e'], '{:.2e}'), row['natom'],
+                  number(row['gaussian_seconds'], '{:.0f} s'), row['level'] or '-', w=width))
+
+
+def _serve_main(argv):
+    p = argparse.ArgumentParser(prog='easymecp serve',
+                                description='Run a local service that queues and runs MECP '
+                                            'jobs (single-file inputs) within a core budget. '
+                                            'Submit jobs with `easymecp submit`.')
+    p.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    p.add_argument('--port', type=int, default=SERVICE_PORT, help='Port to listen on')
+    p.add_argument('--cores', type=int, default=0,
+                   help='Core budget shared by the running jobs (default: all CPUs)')
+    p.add_argument('--workdir', default='easymecp_jobs',
+                   help='Directory where each job gets its own subdirectory')
+    p.add_argument('--poll', type=float, default=1.0,
+                   help='Seconds between checks of the running jobs')
+    p.add_argument('-o', '--option', action='append', default=[], metavar='KEY=VALUE',
+                   help='easyMECP option for every job, like gaussian_exe=g16. Executables '
+                        'and paths can only be set here. Can be repeated.')
+    args = p.parse_args(argv)
+    try:
+        options = dict(option.split('=', 1) for option in args.option)
+    except ValueError:
+        p.error('options must be given as KEY=VALUE')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit('! Terminated'))
+    serve(host=args.host, port=args.port, workdir=args.workdir, cores=args.cores,
+          poll=args.poll, options=options)
+
+
+def _submit_main(argv):
+    try:
+        from urllib.request import Request, urlopen
+    except ImportError:  # Py27
+        from urllib2 import Request, urlopen
+    p = argparse.ArgumentParser(prog='easymecp submit',
+                                description='Submit a single-file MECP job to `easymecp serve`.')
+    p.add_argument('inputfile', type=extant_file, help='Gaussian input file, as in -f')
+    p.add_argument('--url', default='http://127.0.0.1:{}'.format(SERVICE_PORT),
+                   help='Address of the service')
+    p.add_argument('--cores', type=int, default=0,
+                   help='Cores used by the job (default: %%nproc in the input)')
+    p.add_argument('--name', default='', help='Label of the job')
+    p.add_argument('-o', '--option', action='append', default=[], metavar='KEY=VALUE',
+                   help='Additional easyMECP option. Can be repeated.')
+    p.add_argument('--follow', action='store_true',
+                   help='Print progress events until the job ends')
+    args = p.parse_args(argv)
+    try:
+        options = dict(option.split('=', 1) for option in args.option)
+    except ValueError:
+        p.error('options must be given as KEY=VALUE')
+    with open(args.inputfile) as f:
+        request = {'input': f.read(), 'options': options, 'cores': args.cores,
+                   'name': args.name or os.path.basename(args.inputfile)}
+    url = args.url.rstrip('/')
+    response = urlopen(Request(url + '/jobs', data=json.dumps(request).encode('utf-8'),
+                               headers={'Content-Type': 'application/json'}))
+    job = json.loads(response.read().decode('utf-8'))
+    print('Submitted job', job['id'], 'to', url)
+    if args.follow:
+        for line in urlopen(url + '/jobs/{}/events'.format(job['id'])):
+            print(format_event(json.loads(line.decode('utf-8'))))
+
+
+def _scan_main(argv):
+    p = argparse.ArgumentParser(prog='easymecp scan',
+                                description='Relaxed scan along the crossing seam: constrained '
+                                            'MECP searches for several values of a coordinate, '
+                                            'run concurrently within a core budget.')
+    p.add_argument('inputfile', type=extant_file, help='Gaussian input file, as in -f')
+    p.add_argument('--coordinate', required=True, metavar='KIND:ATOMS',
+                   help='Scanned coordinate, like distance:1,2 or dihedral:1,2,3,4')
+    p.add_argument('--values', required=True, metavar='VALUES',
+                   help='Values (Angstrom or degrees) as v1,v2,... or start:stop:step')
+    p.add_argument('--cores', type=int, default=0,
+                   help='Core budget shared by all the points (default: all CPUs). '
+                        'Each point uses %%nproc cores')
+    p.add_argument('--workdir', default='easymecp_scan',
+                   help='Directory where each point gets its own subdirectory')
+    p.add_argument('-o', '--option', action='append', default=[], metavar='KEY=VALUE',
+                   help='Additional easyMECP option for every point. Can be repeated.')
+    p.add_argument('--poll', type=float, default=1.0,
+                   help='Seconds between checks of the running points')
+    args = p.parse_args(argv)
+    try:
+        options = dict(option.split('=', 1) for option in args.option)
+        values = parse_scan_values(args.values)
+    except ValueError as e:
+        p.error(e)
+    with open(args.inputfile) as f:
+        text = f.read()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit('! Terminated'))
+    points = seam_scan(text, args.coordinate, values, cores=args.cores, options=options,
+                       workdir=args.workdir, poll=args.poll)
+    print()
+    print('{:>5} {:>12} {:>6} {:>24} {:>6} {:>5} {:>16} {:>16}'.format(
+          'Point', 'Value', 'Job', 'Result', 'Steps', 'From', 'Energy A', 'Energy B'))
+    for i, point in enumerate(points, 1):
+        status = point['status']
+        print('{:5d} {:12.4f} {:>6} {:>24} {:6d} {:>5} {:>16} {:>16}'.format(
+              i, point['value'], status['id'], status['result'] or status['state'],
+              status['steps'],
+              '-' if point['warm_start'] is None else point['warm_start'] + 1,
+              '-' if point['energy_a'] is None else '{:.8f}'.format(point['energy_a']),
+              '-' if point['energy_b'] is None else '{:.8f}'.format(point['energy_b'])))
+
+
+SUBCOMMANDS = {'analyze': _analyze_main, 'serve': _serve_main, 'submit': _submit_main,
+               'scan': _scan_main, 'status': _status_main, 'index': _index_main}
+
+
 def main():
+    if sys.argv[1:2] and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
     args = _parse_cli()
     argv_keys = [a.lstrip('-') for a in sys.argv[1:] if a.lstrip('-') in vars(args)]
     user_args = {k:v for (k,v) in vars(args).items()
@@ -1072,11 +5913,13 @@ def main():
         print('! ERROR:', e)
         print('         Run easymecp -h (or python easymecp.py -h) for help.')
         sys.exit()
+    # Let queue systems stop us cleanly (scratch removal) with SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit('! Terminated'))
     result = calc.run()
     if result == MECPCalculation.OK:
         print('Success! Check ReportFile for results.')
-        os.remove('ab_initio')
-        os.remove('ProgFile')
+        os.remove(calc.path('ab_initio'))
+        os.remove(calc.path('ProgFile'))
     elif result == MECPCalculation.ERROR:
         print('Something failed... Check Gaussian outputs and/or ReportFile.')
     elif result == MECPCalculation.MAX_ITERATIONS_REACHED:
@@ -1086,11 +5929,37 @@ def main():
 ########################################################################################
 # Constants
 ########################################################################################
-DEFAULTS = _get_defaults()
-
 AVAILABLE_ENERGY_PARSERS = set([key[14:] for key in globals().copy()
                                 if key.startswith('_parse_energy_')])
 
+INTERNAL_COORDINATES = {'distance': _bond, 'angle': _angle, 'dihedral': _dihedral}
+INTERNAL_COORDINATE_SIZES = {'distance': 2, 'angle': 3, 'dihedral': 4}
+
+OPTIMIZERS = dict((cls.name, cls) for cls in
+                  (MECPOptimizer, PenaltyOptimizer, LagrangeNewtonOptimizer))
+
+SERVICE_PORT = 8765  # default port of `easymecp serve`
+
+BOHR = 0.529177  # Angstrom, same value used in MECP.x
+
+REPORT_HEADER = [
+    '       Geometry Optimization of an MECP',
+    '       Program: J. N. Harvey, March 1999',
+    '         version 2, November 2003',
+    '       easyMECP: J. RG. Pedregal, May 2018',
+    '',
+]
+
+# Covalent radii (Angstrom) from Cordero et al, Dalton Trans 2008. Other elements use 1.5
+COVALENT_RADII = {
+    1: 0.31, 2: 0.28, 3: 1.28, 4: 0.96, 5: 0.84, 6: 0.76, 7: 0.71, 8: 0.66, 9: 0.57,
+    10: 0.58, 11: 1.66, 12: 1.41, 13: 1.21, 14: 1.11, 15: 1.07, 16: 1.05, 17: 1.02,
+    18: 1.06, 19: 2.03, 20: 1.76, 21: 1.70, 22: 1.60, 23: 1.53, 24: 1.39, 25: 1.39,
+    26: 1.32, 27: 1.26, 28: 1.24, 29: 1.32, 30: 1.22, 31: 1.22, 32: 1.20, 33: 1.19,
+    34: 1.20, 35: 1.20, 36: 1.16, 44: 1.46, 45: 1.42, 46: 1.39, 47: 1.45, 53: 1.39,
+    76: 1.44, 77: 1.41, 78: 1.36, 79: 1.36,
+}
+
 PROGFILE = """
 Title
 Number of Atoms
@@ -1149,10 +6018,18 @@ USAGE = {
     'footer':
         'File containing the bottom part of system configuration',
     'energy_parser':
-        'Which energy should be parsed: dft, mp2, cis, td. It can also be a '
+        'Which energy should be parsed: dft, mp2, cis, td, oniom (extrapolated '
+        'energy; the default for ONIOM single-file inputs). It can also be a '
         'path to a Python file containing a `parse_energy` function.',
+    'compile_cache':
+        'Directory where compiled MECP.x binaries are kept and reused by calculations '
+        'with the same number of atoms, thresholds and compiler settings',
+    'warm_start':
+        'Directory of a previous calculation of the same system. Start from its last '
+        'geometry, chk files and, with the Python optimizers, inverse Hessian',
     'gaussian_exe':
-        'Path to gaussian executable. Compatible versions: g09, g16',
+        'Path to gaussian executable. Compatible versions: g09, g16. '
+        'If empty, g16 if found in $PATH, g09 otherwise',
     'TDE':
         'Convergence threshold for difference in E. Must be a valid Fortran double!',
     'TDXMax':
@@ -1166,7 +6043,105 @@ USAGE = {
     'FC':
         'Fortran compiler (can also be set with $FC environment variable)',
     'FFLAGS':
-        'Fortran compiler flags (can also be set with $FFLAGS environment variable)'
+        'Fortran compiler flags (can also be set with $FFLAGS environment variable)',
+    'trust_radius':
+        'Initial trust radius (Angstrom) for adaptive step control. The step bound grows '
+        'or shrinks with the ratio of actual to predicted change of the effective '
+        'objective, and steps that make it worse are rejected. If 0, the fixed '
+        'step caps of MECP.x are used',
+    'gdiis_threshold':
+        'Switch to GDIIS extrapolation once the max effective gradient element falls '
+        'below this value (Hartree/Angstrom). If 0, GDIIS is disabled',
+    'gdiis_history':
+        'Number of previous geometries and effective gradients used by GDIIS',
+    'algorithm':
+        'MECP optimization algorithm: harvey (effective gradient, MECP.x), penalty '
+        '(penalty function) or lagrange_newton (Lagrange-Newton / projected gradient)',
+    'freeze':
+        'Atoms that must not move, as 1-based indices and ranges (1,2,5-8). Atoms '
+        'flagged with -1 in the geometry (Gaussian style) are frozen too',
+    'numerical_gradients':
+        'Compute gradients by finite differences of the energy (central or forward), '
+        'for methods without analytic forces. The header does not need `force`',
+    'numerical_step':
+        'Displacement (Angstrom) used for numerical gradients',
+    'numerical_jobs':
+        'Number of displaced single points run at the same time for numerical '
+        'gradients. %nproc and %mem are split between them',
+    'resume':
+        'Resume an interrupted calculation from its journal ({}), reusing the '
+        'Gaussian jobs and optimizer state of finished steps'.format(MECPCalculation.JOURNAL),
+    'job_timeout':
+        'Kill Gaussian jobs running for longer than this (seconds). If 0, no limit',
+    'stall_timeout':
+        'Kill Gaussian jobs whose output has not grown for this long (seconds). If 0, '
+        'no limit',
+    'retry_ladder':
+        'Route changes applied, one more per attempt, when a Gaussian job fails or is '
+        'killed, separated by semicolons. keyword[=options] adds or replaces a keyword '
+        'and -keyword removes it. Example: scf=xqc;-guess;scf=qc',
+    'scratch_dir':
+        'Run the Gaussian jobs of each state in its own temporary directory under this '
+        'path (e.g. node-local disk or /dev/shm), also used as GAUSS_SCRDIR. chk files '
+        'stay there between steps; only outputs are copied back. Removed on exit',
+    'archive':
+        'Compress the Gaussian outputs of finished steps in the background (gzip). '
+        'Their data is always kept in JOBS/steps',
+    'keep_logs':
+        'With archive, keep only the Gaussian outputs of the last N steps. If 0, keep all',
+    'serial_freq':
+        'Run the frequency jobs one after the other. By default, both states run at the '
+        'same time, splitting %nproc and %mem, if their chk files are different',
+    'states':
+        'Header files of all the states considered, separated by commas (labelled A, B, '
+        'C...). All of them are computed at every step and the crossing given by pair '
+        'is optimized. If empty, a_header and b_header',
+    'pair':
+        'With states, the crossing to optimize: two labels (A,C) or lowest, which '
+        'follows the two lowest-lying states at every step',
+    'symmetry':
+        'Detect the point group of the starting geometry and keep it: keep symmetrizes '
+        'the geometry, gradients and steps of every iteration; unique also optimizes '
+        'only the symmetry-unique coordinates (with the Python optimizers)',
+    'symmetry_tolerance':
+        'Maximum distance (Angstrom) between an atom and the image of an equivalent '
+        'one for an operation to belong to the point group',
+    'surrogate':
+        'Fit gek (gradient-enhanced kriging) models to the energies and gradients '
+        'computed so far and step to their MECP, as far as they can be trusted, '
+        'instead of following the quasi-Newton direction; falls back to the usual '
+        'steps when they mispredict the last geometry. Harvey algorithm in cartesian '
+        'coordinates only. Needs NumPy',
+    'surrogate_tolerance':
+        'Energy error (Hartree) accepted from the surrogate models, both in their '
+        'prediction of the last geometry and as uncertainty along the step',
+    'workdir':
+        'Directory where the calculation reads its input files from (when given '
+        'as relative paths) and writes all the others, and where Gaussian and MECP.x '
+        'run. Defaults to the current working directory',
+    'index':
+        'SQLite database (relative to workdir) where the run and each of its steps are '
+        'recorded as they finish, to be queried with easymecp index. Can also be set '
+        'with $EASYMECP_INDEX',
+    'lbfgs_memory':
+        'Keep only the last N BFGS updates instead of a dense inverse Hessian '
+        '(L-BFGS, Python optimizer), so memory and time grow linearly with the '
+        'number of atoms. Used with 20 updates above 2000 atoms',
+    'results_from':
+        'Where energies and gradients are read from: log (Gaussian output, with the '
+        'energy_parser) or fchk (formatted checkpoint written with formchk after each '
+        'job: full precision and any method; needs %chk and adds nosymm)',
+    'serial_states':
+        'With states, run the Gaussian jobs one after the other. By default, they run at '
+        'the same time, splitting %nproc and %mem, if their chk files are different',
+    'constraints':
+        'Geometric constraints, separated by semicolons: kind:atoms[:target], with '
+        'kind distance (Angstrom), angle or dihedral (degrees) and 1-based atoms. Example: '
+        'distance:1,2:1.5;angle:1,2,3. Without target, the initial value is kept',
+    'coordinates':
+        'Coordinates used for the optimization steps: cartesian or internal (redundant '
+        'bonds, angles and dihedrals built from the initial geometry). Convergence is '
+        'always tested in cartesians',
 }
 
 MECP_FORTRAN = """
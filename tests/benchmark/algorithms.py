@@ -0,0 +1,45 @@
+"""
+Run every MECP algorithm on the bundled systems and report the number
+of steps needed to converge. Gaussian must be available in $PATH.
+
+Usage: algorithms.py [system ...]
+"""
+from __future__ import print_function
+import os
+import shutil
+import sys
+
+here = os.path.abspath(os.path.dirname(__file__))
+root = os.path.join(here, os.pardir, os.pardir)
+sys.path.insert(0, root)
+from easymecp.easymecp import MECPCalculation, OPTIMIZERS, temporary_directory  # noqa: E402
+
+data = os.path.join(here, os.pardir, 'data')
+
+
+def benchmark(directory, algorithm, **kwargs):
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(os.path.join(data, directory), new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', algorithm=algorithm,
+                               **kwargs)
+        result = calc.run()
+    return result, calc.converged_at
+
+
+if __name__ == '__main__':
+    systems = sys.argv[1:] or sorted(d for d in next(os.walk(data))[1]
+                                     if os.path.isfile(os.path.join(data, d, 'geom_init')))
+    algorithms = sorted(OPTIMIZERS)
+    results = {}
+    for system in systems:
+        for algorithm in algorithms:
+            results[system, algorithm] = benchmark(system, algorithm)
+    print('{:24}'.format('SYSTEM') + ''.join('{:>18}'.format(a) for a in algorithms))
+    for system in systems:
+        row = []
+        for algorithm in algorithms:
+            result, steps = results[system, algorithm]
+            row.append('{:>18}'.format(steps if result == MECPCalculation.OK else result))
+        print('{:24}'.format(system) + ''.join(row))
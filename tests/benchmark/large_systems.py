@@ -0,0 +1,113 @@
+"""
+Run a few optimization steps on a large ONIOM-style system (10k atoms by default)
+with a stand-in for Gaussian, and compare the time easymecp spends per step,
+Gaussian excluded, against a budget. Parsing, writing, the optimizer and the
+bookkeeping must all scale linearly with the number of atoms.
+
+Usage: large_systems.py [natom] [steps]
+"""
+from __future__ import print_function
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+here = os.path.abspath(os.path.dirname(__file__))
+root = os.path.join(here, os.pardir, os.pardir)
+sys.path.insert(0, root)
+from easymecp.easymecp import MECPCalculation, latest_step_store  # noqa: E402
+
+# Seconds per step and per 1000 atoms, Gaussian excluded
+BUDGET = {'step': 0.25}
+
+# Two harmonic wells, shifted from the grid; forces in Hartree/Bohr, like Gaussian prints them
+FAKE_GAUSSIAN = '''#!{python}
+import os, sys
+path = sys.argv[1]
+with open(path) as f:
+    lines = [line for line in f.read().splitlines() if not line.startswith('!')]
+i = lines.index('') + 3
+multiplicity = int(lines[i].split()[1])
+coordinates = [[float(v) for v in line.split()[2:5]] for line in lines[i + 1:] if line.strip()]
+shift = 0.01 if multiplicity == 1 else -0.01
+k = 0.05 if multiplicity == 1 else 0.08
+energy, forces = -1000.0 + (0.0 if multiplicity == 1 else 0.02), []
+for n, xyz in enumerate(coordinates):
+    minimum = (1.5 * (n % 20), 1.5 * (n // 20 % 20), 1.5 * (n // 400))  # grid_point(n)
+    d = [xyz[0] - minimum[0] - shift, xyz[1] - minimum[1], xyz[2] - minimum[2]]
+    energy += 0.5 * k * sum(v * v for v in d)
+    forces.append([-k * v * 0.529177 for v in d])
+with open(os.path.splitext(path)[0] + '.log', 'w') as out:
+    out.write(' Entering Gaussian System\\n')
+    out.write(' ONIOM: extrapolated energy =   %.9f\\n' % energy)
+    out.write(' -------------------------------------------------------------------\\n')
+    out.write(' Center     Atomic                   Forces (Hartrees/Bohr)\\n')
+    out.write(' Number     Number              X              Y              Z\\n')
+    out.write(' -------------------------------------------------------------------\\n')
+    out.write(''.join('%7d%11d%19.9f%15.9f%15.9f\\n' % ((n + 1, 6) + tuple(f))
+                      for n, f in enumerate(forces)))
+    out.write(' -------------------------------------------------------------------\\n')
+    out.write(' Normal termination of Gaussian\\n')
+'''
+
+
+def grid_point(n):
+    """Position of atom ``n`` in the initial geometry, a grid 1.5 Angstrom apart."""
+    return (1.5 * (n % 20), 1.5 * (n // 20 % 20), 1.5 * (n // 400))
+
+
+def write_inputs(directory, natom):
+    """Headers, ONIOM geometry and footer for ``natom`` atoms in ``directory``."""
+    executable = os.path.join(directory, 'fake_gaussian')
+    with open(executable, 'w') as f:
+        f.write(FAKE_GAUSSIAN.format(python=sys.executable))
+    os.chmod(executable, os.stat(executable).st_mode | stat.S_IEXEC)
+    for name, multiplicity in (('Input_Header_A', 1), ('Input_Header_B', 3)):
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write('%chk=' + name[-1] + '\n# oniom(b3lyp/6-31g*:amber) force\n\n'
+                    'benchmark\n\n0 {0} 0 {0} 0 {0}\n'.format(multiplicity))
+    with open(os.path.join(directory, 'geom'), 'w') as f:
+        for n in range(natom):
+            xyz = grid_point(n)
+            f.write('C-CT--0.1 0 {:12.6f}{:12.6f}{:12.6f} {}\n'.format(
+                xyz[0], xyz[1], xyz[2], 'H' if n < 30 else 'L'))
+    with open(os.path.join(directory, 'footer'), 'w') as f:
+        f.write('\n')
+    return executable
+
+
+def benchmark(natom=10000, steps=3):
+    """
+    Mean seconds per step spent outside Gaussian, per 1000 atoms, for ``steps``
+    steps on ``natom`` atoms.
+    """
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(directory)
+        executable = write_inputs(directory, natom)
+        calc = MECPCalculation(max_steps=steps, energy_parser='oniom', gaussian_exe=executable)
+        calc.run()
+        store = latest_step_store(directory, readonly=True)
+        # The first row is the initial geometry, without a step of its own
+        overhead = [total - max(a, b) for (total, a, b) in
+                    zip(*[store.read(name, 1) for name in
+                          ('step_seconds', 'gaussian_seconds_a', 'gaussian_seconds_b')])]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+    return sum(overhead) / len(overhead) * 1000.0 / natom
+
+
+if __name__ == '__main__':
+    natom = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    start = time.time()
+    seconds = benchmark(natom, steps)
+    status = 'OK' if seconds <= BUDGET['step'] else 'OVER BUDGET'
+    print('{} atoms, {} steps in {:.1f} s'.format(natom, steps, time.time() - start))
+    print('{:8} {:8.3f} s per 1000 atoms (budget {:.3f} s) {}'.format(
+        'step', seconds, BUDGET['step'], status))
+    sys.exit(0 if seconds <= BUDGET['step'] else 1)
@@ -1,45 +1,40 @@
-import numpy as np
-
-def parse_xyz(path):
-    atoms = None
-    with open(path) as f:
-        for line in f:
-            if line.startswith('Geometry at'):
-                atoms = []
-                line = next(f)
-                while line.strip():
-                    fields = line.split()
-                    if len(fields) == 4:
-                        atoms.append((fields[0], [float(i) for i in fields[1:]]))
-                    line = next(f)
-    return atoms
+"""
+Compare the final energies and geometries of two runs (ReportFiles or
+calculation directories).
 
-def rmsd(file_a, file_b):
-    mol_a = parse_xyz(file_a)
-    mol_b = parse_xyz(file_b)
+RMSD is per atom (divided by the number of atoms) after the optimal
+superposition (Kabsch) of both final geometries. Versions before
+`easymecp analyze` reported the unaligned RMS of the coordinates (divided by
+3N), which is sqrt(3) times smaller for the same unaligned geometries.
+
+Usage: results.py RUN_A RUN_B
+"""
+from __future__ import print_function
+import os
+import sys
 
-    xyz_a = np.array([atom[1] for atom in mol_a])
-    xyz_b = np.array([atom[1] for atom in mol_b])
+here = os.path.abspath(os.path.dirname(__file__))
+root = os.path.join(here, os.pardir, os.pardir)
+sys.path.insert(0, root)
+from easymecp.easymecp import load_run, kabsch_rmsd  # noqa: E402
 
-    return np.sqrt(np.mean(np.square(xyz_a-xyz_b)))
+
+def rmsd(file_a, file_b):
+    """Kabsch-aligned RMSD per atom between the final geometries, in Angstrom."""
+    return float(kabsch_rmsd(load_run(file_a)['coordinates'][-1],
+                             load_run(file_b)['coordinates'][-1]))
 
 
 def energy(path):
-    energy = None
-    with open(path) as f:
-        for line in f:
-            if 'Energy of First State' in line:
-                energy = float(line.split()[-1])
-    return energy
+    return float(load_run(path)['energy_a'][-1])
 
 
 if __name__ == '__main__':
-    import sys
     if len(sys.argv) != 3:
-        print('Usage: results.py ReportFileA ReportFileB')
+        print(__doc__.strip())
+        print('For more than two runs, use `easymecp analyze`.')
         sys.exit()
     print('ENERGY A ({}) ='.format(sys.argv[1]), energy(sys.argv[1]))
     print('ENERGY B ({}) ='.format(sys.argv[2]), energy(sys.argv[2]))
     print('ENERGY A-B =', abs(energy(sys.argv[1]) - energy(sys.argv[2])))
-    print('RMSD =', rmsd(sys.argv[1], sys.argv[2]), 'A')
-
+    print('RMSD (Kabsch-aligned, per atom) =', rmsd(sys.argv[1], sys.argv[2]), 'A')
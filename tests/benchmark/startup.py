@@ -0,0 +1,51 @@
+"""
+Measure how long `import easymecp.easymecp` and `easymecp -h` take, in
+fresh interpreters, and compare them against a time budget. Nothing
+expensive (PATH scans, distutils, ...) must happen at import time.
+
+Usage: startup.py [repetitions]
+"""
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import time
+
+here = os.path.abspath(os.path.dirname(__file__))
+root = os.path.join(here, os.pardir, os.pardir)
+
+# Seconds on top of a bare interpreter start, best of the repetitions
+BUDGET = {'import': 0.25, 'help': 0.5}
+COMMANDS = {'import': ['-c', 'import easymecp.easymecp'],
+            'help': ['-c', 'import sys; sys.argv[1:] = ["-h"]; '
+                           'from easymecp.easymecp import main; main()']}
+
+
+def measure(command, repetitions=5):
+    """Best wall time of running ``python <command>``, in seconds."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [root] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    best = float('inf')
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repetitions):
+            start = time.time()
+            subprocess.check_call([sys.executable] + command, stdout=devnull, env=env)
+            best = min(best, time.time() - start)
+    return best
+
+
+def startup(repetitions=5):
+    """Startup overhead of each command in ``COMMANDS``, bare interpreter excluded."""
+    bare = measure(['-c', 'pass'], repetitions)
+    return dict((name, measure(command, repetitions) - bare)
+                for (name, command) in COMMANDS.items())
+
+
+if __name__ == '__main__':
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    over = False
+    for name, seconds in sorted(startup(repetitions).items()):
+        status = 'OK' if seconds <= BUDGET[name] else 'OVER BUDGET'
+        over = over or seconds > BUDGET[name]
+        print('{:8} {:8.3f} s (budget {:.3f} s) {}'.format(name, seconds, BUDGET[name], status))
+    sys.exit(1 if over else 0)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Stand-in for Gaussian in tests that only need the workflow around it (like the
+service): reads a Gaussian input and writes a log with the energy (``dft``
+parser) and forces of harmonic bonds whose length and offset depend on the
+multiplicity, so both states cross.
+
+With FAKE_GAUSSIAN_HANG=<file> in the environment, it starts a link that
+never ends instead, in its process group, and appends the PID of the link to
+<file> (for the tests of the watchdog).
+
+Usage: fake_gaussian.py input.gjf
+"""
+from __future__ import print_function
+import math
+import os
+import subprocess
+import sys
+
+BOHR = 0.529177
+NUMBERS = {'H': 1, 'C': 6, 'N': 7, 'O': 8}
+
+
+def read_input(path):
+    with open(path) as f:
+        lines = [line for line in f.read().splitlines() if not line.startswith(('!', '%'))]
+    i = lines.index('')  # end of the route section
+    i = lines.index('', i + 1)  # end of the title
+    multiplicity = int(lines[i + 1].split()[1])
+    atoms = []
+    for line in lines[i + 2:]:
+        if not line.strip():
+            break
+        fields = line.split()
+        number = int(fields[0]) if fields[0].isdigit() else NUMBERS.get(fields[0].split('-')[0], 0)
+        atoms.append((number, [float(v) for v in fields[-3:]]))
+    return multiplicity, atoms
+
+
+def energy_and_forces(multiplicity, atoms, k=0.3):
+    length = 1.30 + 0.05 * (multiplicity - 1)
+    energy = -231.0 + 0.01 * (multiplicity - 1)
+    forces = [[0.0, 0.0, 0.0] for _ in atoms]
+    for i in range(len(atoms)):
+        for j in range(i):
+            d = [a - b for (a, b) in zip(atoms[i][1], atoms[j][1])]
+            r = math.sqrt(sum(v * v for v in d))
+            if r > 1.8:
+                continue
+            energy += 0.5 * k * (r - length) ** 2
+            for n in range(3):
+                f = -k * (r - length) * d[n] / r * BOHR  # Hartree/Bohr
+                forces[i][n] += f
+                forces[j][n] -= f
+    return energy, forces
+
+
+def hang(pidfile):
+    link = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(3600)'])
+    with open(pidfile, 'a') as f:
+        print(link.pid, file=f)
+    link.wait()
+
+
+def main(path):
+    if os.environ.get('FAKE_GAUSSIAN_HANG'):
+        return hang(os.environ['FAKE_GAUSSIAN_HANG'])
+    multiplicity, atoms = read_input(path)
+    energy, forces = energy_and_forces(multiplicity, atoms)
+    with open(os.path.splitext(path)[0] + '.log', 'w') as out:
+        out.write(' Entering Gaussian System\n')
+        out.write(' SCF Done:  E(UB3LYP) =  {:.9f}     A.U. after   10 cycles\n'.format(energy))
+        out.write(' -------------------------------------------------------------------\n')
+        out.write(' Center     Atomic                   Forces (Hartrees/Bohr)\n')
+        out.write(' Number     Number              X              Y              Z\n')
+        out.write(' -------------------------------------------------------------------\n')
+        for n, ((number, _), f) in enumerate(zip(atoms, forces)):
+            out.write('{:7d}{:11d}{:19.9f}{:15.9f}{:15.9f}\n'.format(n + 1, number, *f))
+        out.write(' -------------------------------------------------------------------\n')
+        out.write(' Normal termination of Gaussian\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
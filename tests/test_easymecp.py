@@ -2,17 +2,30 @@
 
 from __future__ import print_function
 import io
+import json
 import os
 import shutil
 import sys
 import re
 import math
+import threading
+import time
 from subprocess import check_output
 import pytest
 import numpy as np
-from easymecp.easymecp import MECPCalculation, temporary_directory
+from easymecp.easymecp import (MECPCalculation, MECPOptimizer, OPTIMIZERS, temporary_directory,
+                               read_geometry, parse_atom_list, parse_constraints,
+                               generate_internal_coordinates, StepStore, load_run, kabsch_rmsd,
+                               rmsd_matrix, internal_coordinate_table, MECPService,
+                               seam_scan, parse_scan_values, latest_step_store, read_fchk,
+                               PointGroup, run_status, estimate_remaining_steps, find_runs,
+                               GEKSurrogate, parse_oniom_atoms, RunIndex, index_runs,
+                               route_level, PenaltyOptimizer, write_inverse_hessian,
+                               read_inverse_hessian)
 here = os.path.abspath(os.path.dirname(__file__))
 data = os.path.join(here, 'data')
+# Stand-in for Gaussian, for tests of the workflow around it
+fake_gaussian = os.path.join(here, 'fake_gaussian.py')
 
 
 AVAILABLE_MEMORY_GB = float(check_output(['free']).splitlines()[1].split()[1]) / 1048576
@@ -116,6 +129,36 @@ def test_singlefile():
             print('! Warning: calculation ended OK but took a different number of steps')
 
 
+def test_n_states():
+    directory = 'C6H5+_singlefile'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        with open('input.gjf') as f:
+            text = f.read()
+        with open('input.gjf', 'w') as f:
+            f.write(text.replace('{singlet,triplet}', '{singlet,triplet,quintet}')
+                        .replace('{First,Second}', '{First,Second,Third}')
+                        .replace('{1,3}', '{1,3,5}'))
+        calc = MECPCalculation.from_gaussian_input_file('input.gjf', max_steps=2)
+        assert calc.states == ['_header_a', '_header_b', '_header_c']
+        with open('_header_c') as f:
+            header = f.read()
+        assert '%chk=quintet.chk' in header and '\n1 5\n' in header
+        # The lowest pair is kept until another state is clearly below it
+        assert calc.select_pair({'A': -1.0, 'B': -0.99, 'C': -0.99 + 1e-6}) == ('A', 'B')
+        assert calc.select_pair({'A': -1.0, 'B': -0.99, 'C': -0.995}) == ('A', 'C')
+        calc.run()
+        with open('ReportFile') as f:
+            energies = [line for line in f if line.startswith('Energies of all states')]
+        assert len(energies) == 2
+        assert os.path.isfile(os.path.join('JOBS', 'Job0_C.log'))
+        with pytest.raises(ValueError):
+            MECPCalculation.from_gaussian_input_file('input.gjf', pair='A,D')
+
+
 @pytest.mark.parametrize("directory, freq_a, freq_b, energy_a, energy_b, energy_avg", [
     ('C6H5+_freq', -552.2857, 317.7488, -231.188991, -231.186626, -231.1878085),
 ])
@@ -158,6 +201,732 @@ def test_freq(directory, freq_a, freq_b, energy_a, energy_b, energy_avg):
                     assert abs(energy_avg - value) < 1e-2
 
 
+def test_numerical_gradients():
+    directory = 'CH2'
+    cwd = os.getcwd()
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail',
+                               numerical_gradients='central')
+        result = calc.run()
+        if result != calc.OK:
+            try:
+                os.makedirs(os.path.join(cwd, 'failed'))
+            except:
+                pass
+            shutil.copytree(new_data, os.path.join(cwd, 'failed', directory))
+        assert result == calc.OK
+        assert os.path.isfile(os.path.join(calc.jobsdir, 'Job0_A_d1p.log'))
+        with open(os.path.join(calc.jobsdir, 'Job0_A.log')) as f:
+            assert 'Numerical gradients (central' in f.read()
+
+
+def test_scratch_dir():
+    directory = 'CH2'
+    cwd = os.getcwd()
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        scratch = os.path.join(tmp, 'scratch')
+        os.makedirs(scratch)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', scratch_dir=scratch)
+        result = calc.run()
+        if result != calc.OK:
+            try:
+                os.makedirs(os.path.join(cwd, 'failed'))
+            except:
+                pass
+            shutil.copytree(new_data, os.path.join(cwd, 'failed', directory))
+        assert result == calc.OK
+        assert os.path.isfile(os.path.join(calc.jobsdir, 'Job0_A.log'))
+        assert not [f for f in os.listdir('.') if f.endswith('.chk') or f.startswith('Gau-')]
+        assert not os.listdir(scratch)
+
+
+def test_archive():
+    directory = 'CH2'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', archive='gzip', keep_logs=1)
+        assert calc.run() == calc.OK
+        with open('ReportFile') as f:
+            assert f.read().count('CONVERGED') == 1
+        logs = sorted(f for f in os.listdir(calc.jobsdir) if '.log' in f)
+        last = calc.converged_at
+        assert logs == ['Job{}_A.log.gz'.format(last), 'Job{}_B.log.gz'.format(last)]
+        store = StepStore(os.path.join(calc.jobsdir, 'steps'))
+        assert len(store) == last + 1
+        assert store.read('step') == list(range(last + 1))
+        energy, gradients = calc.parse_energy_and_gradients(
+            os.path.join(calc.jobsdir, 'Job{}_A.log'.format(last)))
+        assert abs(energy - store.read('energy_a')[-1]) < 1e-8
+        assert store.read('delta_e')[-1] < 5e-5
+        assert len(store.read('forces_a')[-1]) == 3 * calc.natom
+
+
+def test_step_store():
+    with temporary_directory() as tmp:
+        store = StepStore(os.path.join(tmp, 'steps'), natom=2)
+        store.append(step=0, coordinates=[0, 0, 0, 0, 0, 1.1], energy_a=-1.0, delta_e=0.5)
+        store.append(step=1, coordinates=[0, 0, 0, 0, 0, 1.2], energy_a=-1.5)
+        store = StepStore(os.path.join(tmp, 'steps'))
+        assert len(store) == 2 and store.natom == 2
+        assert store.read('energy_a') == [-1.0, -1.5]
+        assert math.isnan(store.read('delta_e')[1])
+        coordinates = np.asarray(store.mmap('coordinates'))
+        assert coordinates.shape == (2, 6)
+        assert coordinates[1, 5] == 1.2
+        with pytest.raises(ValueError):
+            store.append(step=2, coordinates=[0, 0, 0])
+
+
+def test_status():
+    assert estimate_remaining_steps([0, 1, 2], {'rms_force': [1e-2, 1e-3, 1e-4]},
+                                    {'rms_force': 2e-6}) == 2
+    assert estimate_remaining_steps([0, 1, 2], {'rms_force': [1e-4, 1e-3, 1e-2]},
+                                    {'rms_force': 1e-6}) is None
+    assert estimate_remaining_steps([0, 1], {'rms_force': [1e-2, 1e-7]},
+                                    {'rms_force': 1e-6}) == 0
+    directory = 'CH2'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        assert run_status('.') is None
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', max_steps=2)
+        assert calc.run() == calc.MAX_ITERATIONS_REACHED
+        status = run_status('.')
+        assert status['state'] == 'MAX_ITERATIONS_REACHED' and status['step'] == 1
+        assert status['thresholds'] == calc.thresholds
+        assert None not in status['gaussian_seconds'] and status['step_seconds'] > 0
+        assert status['eta'] is None
+        assert find_runs([tmp]) == [new_data]
+
+
+def test_background_setup():
+    directory = 'CH2'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        os.remove('ab_initio')  # shipped with the data
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', max_steps=2,
+                               FC='no-such-fortran-compiler')
+        assert calc.mecp_exe is None and not os.path.exists('MECP.x')
+        # The compiler error ends the run before the first optimizer call, once the
+        # Gaussian jobs of the first step, which ran meanwhile, are done
+        assert calc.run() == calc.ERROR
+        assert os.path.isfile(os.path.join(calc.jobsdir, 'Job0_A.gjf'))
+        assert os.path.isfile(os.path.join(calc.jobsdir, 'Job0_B.gjf'))
+        assert os.path.isfile('ProgFile') and not os.path.exists('ab_initio')
+        with open('ReportFile') as f:
+            assert f.read().rstrip().endswith('ERROR')
+        store = StepStore(os.path.join(calc.jobsdir, 'steps'), readonly=True)
+        assert store.meta['attributes']['result'] == calc.ERROR
+
+
+def test_run_index():
+    assert route_level('# b3lyp/6-31g* force') == 'b3lyp/6-31g*'
+    assert route_level('#p oniom(B3LYP/6-31G*:amber) opt') == 'oniom(b3lyp/6-31g*:amber)'
+    assert route_level('# am1 force') is None
+    directory = 'CH2'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', max_steps=2,
+                               index=os.path.join(tmp, 'live.sqlite'))
+        assert calc.run() == calc.MAX_ITERATIONS_REACHED
+        live = RunIndex(os.path.join(tmp, 'live.sqlite'))
+        run, = live.find()
+        assert run['directory'] == new_data and run['status'] == calc.MAX_ITERATIONS_REACHED
+        assert run['steps'] == 2 and run['natom'] == calc.natom and run['converged_at'] is None
+        assert run['threshold_delta_e'] == calc.thresholds['delta_e']
+        assert run['route'].startswith('#') and len(run['inputs_hash']) == 40
+        steps = live.steps(new_data)
+        assert [s['step'] for s in steps] == [0, 1]
+        assert steps[-1]['energy_a'] == run['energy_a']
+        assert index_runs([tmp], os.path.join(tmp, 'backfill.sqlite'), jobs=2) == 1
+        backfill = RunIndex(os.path.join(tmp, 'backfill.sqlite'))
+        assert backfill.find() == live.find()
+        assert backfill.find(status='OK') == []
+        assert backfill.find(delta_e_below=run['delta_e'] * 2, steps_below=3) == [run]
+        assert backfill.query('SELECT COUNT(*) AS n FROM steps') == [{'n': 2}]
+        for sql in ('DROP TABLE runs', "ATTACH DATABASE 'other.sqlite' AS other"):
+            with pytest.raises(Exception):
+                backfill.query(sql)
+        assert not os.path.exists('other.sqlite')
+        assert len(backfill.find()) == 1
+
+
+def test_analyze():
+    runs = [load_run(os.path.join(here, 'data', d, 'ReportFile'))
+            for d in ('C6H5+', 'C6H5+_B1-3A2')]
+    assert runs[0]['coordinates'].shape == (14, 11, 3)
+    assert runs[0]['converged'] and runs[0]['numbers'][:6] == [6] * 6
+    assert abs(runs[0]['energy_a'][-1] - -231.241410534) < 1e-8
+    final = runs[0]['coordinates'][-1]
+    theta = 0.7
+    rotation = np.array([[np.cos(theta), -np.sin(theta), 0],
+                         [np.sin(theta), np.cos(theta), 0], [0, 0, 1]])
+    assert kabsch_rmsd(final, final.dot(rotation.T) + 3.0) < 1e-6
+    matrix = rmsd_matrix([final, runs[1]['coordinates'][-1]])
+    assert matrix.shape == (2, 2) and matrix[0, 0] < 1e-6
+    assert abs(matrix[0, 1] - matrix[1, 0]) < 1e-10
+    internals = generate_internal_coordinates(runs[0]['numbers'], final.ravel().tolist())
+    table = internal_coordinate_table(runs[0]['coordinates'], internals)
+    assert table.shape == (14, len(internals))
+    bond = internals.index(('distance', (0, 1)))
+    assert abs(table[-1, bond] - np.linalg.norm(final[0] - final[1])) < 1e-10
+    with temporary_directory() as tmp:
+        with pytest.raises(ValueError):
+            load_run(tmp)
+
+
+def test_startup():
+    sys.path.insert(0, os.path.join(here, 'benchmark'))
+    try:
+        from startup import startup, BUDGET
+    finally:
+        sys.path.pop(0)
+    code = ('import sys, shutil; shutil.which = None; import easymecp.easymecp; '
+            'print("distutils" in sys.modules)')
+    env = dict(os.environ, PYTHONPATH=os.path.join(here, os.pardir))
+    assert check_output([sys.executable, '-c', code], env=env).strip() == b'False'
+    times = startup(repetitions=3)
+    assert times['import'] < BUDGET['import'], times
+
+
+def test_service():
+    with open(os.path.join(here, 'data', 'C6H5+_singlefile', 'input.gjf')) as f:
+        text = f.read()
+    with temporary_directory() as tmp:
+        service = MECPService(workdir=tmp, cores=4, poll=0.2,
+                              options={'gaussian_exe': fake_gaussian})
+        try:
+            first = service.submit(text, options={'max_steps': '2'})
+            second = service.submit(text, options={'max_steps': 2}, cores=1, name='second')
+            assert first['cores'] == 4 and second['name'] == 'second'
+            assert second['cores'] == 4  # not less than %nproc
+            assert service.status(second['id'])['state'] == 'queued'  # over the budget
+            events = []
+            while not events or events[-1]['event'] not in service.FINAL_STATES:
+                events.extend(service.events(second['id'], len(events), timeout=1))
+        finally:
+            service.shutdown()
+        jobs = service.list()
+        assert [job['state'] for job in jobs] == ['finished', 'finished']
+        assert [job['result'] for job in jobs] == [MECPCalculation.MAX_ITERATIONS_REACHED] * 2
+        assert jobs[1]['started'] >= jobs[0]['finished']
+        assert [e['event'] for e in events][:2] == ['queued', 'started']
+        assert jobs[1]['steps'] == 2
+        assert [e['step'] for e in events if e['event'] == 'step'] == [0, 1]
+        assert len(os.listdir(service.cache)) == 1  # MECP.x compiled once
+        with pytest.raises(ValueError):
+            service.submit(text, options={'not_an_option': 1})
+        service.check_request(text, {'max_steps': 2, 'algorithm': 'penalty'})
+        for options in ({'gaussian_exe': '/bin/sh'}, {'FC': 'sh'}, {'energy_parser': 'x.py'}):
+            with pytest.raises(ValueError):
+                service.check_request(text, options)
+        for line in ('! easymecp: workdir=/tmp', '%subst l502 /tmp', '%chk=/home/a.chk',
+                     '%oldchk=../other/a.chk', '%rwf=a.rwf,2GB,/tmp/b.rwf,2GB', '@/etc/basis'):
+            with pytest.raises(ValueError):
+                service.check_request(line + '\n' + text)
+
+
+def _running(pid):
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+@pytest.mark.parametrize('interrupt', [False, True])
+def test_watchdog_kills_gaussian(interrupt):
+    with temporary_directory() as tmp:
+        shutil.copy(os.path.join(here, 'data', 'C6H5+_singlefile', 'input.gjf'), tmp)
+        pidfile = os.path.join(tmp, 'links')
+        calc = MECPCalculation.from_gaussian_input_file('input.gjf', gaussian_exe=fake_gaussian,
+                                                        job_timeout=2 if interrupt else 0.5)
+        calc.WATCHDOG_INTERVAL = 0.1
+        if interrupt:
+
+            def interrupted(inputfiles, processes):
+                while not os.path.isfile(pidfile):
+                    time.sleep(0.1)
+                time.sleep(0.5)
+                raise KeyboardInterrupt
+
+            calc._watch_gaussian = interrupted
+        os.environ['FAKE_GAUSSIAN_HANG'] = pidfile
+        try:
+            start = time.time()
+            if interrupt:
+                with pytest.raises(KeyboardInterrupt):
+                    calc.run()
+            else:
+                assert calc.run() == calc.ERROR
+        finally:
+            del os.environ['FAKE_GAUSSIAN_HANG']
+        assert time.time() - start < 30
+        with open(pidfile) as f:
+            links = [int(line) for line in f]
+        assert len(links) == (1 if interrupt else 2)
+        time.sleep(0.5)
+        assert not any(_running(pid) for pid in links)
+
+
+def test_concurrent_workdirs():
+    original_data = os.path.join(here, 'data', 'CH2')
+    contents = []
+    for name in ('Input_Header_A', 'Input_Header_B', 'geom_init'):
+        with open(os.path.join(original_data, name)) as f:
+            contents.append(f.read())
+    cwd = os.getcwd()
+    with temporary_directory(enter=False) as tmp:
+        calcs = [MECPCalculation.from_strings(contents[:2], contents[2], max_steps=2,
+                                              workdir=os.path.join(tmp, str(i)))
+                 for i in range(2)]
+        results = [None, None]
+
+        def run(i):
+            results[i] = calcs[i].run()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert os.getcwd() == cwd
+        assert results[0] == results[1] != calcs[0].ERROR
+        assert sorted(os.listdir(tmp)) == ['0', '1']
+        reports = []
+        for calc in calcs:
+            assert not [name for name in os.listdir(calc.workdir) if name.startswith('_header')]
+            with open(calc.path('ReportFile')) as f:
+                reports.append(f.read().split('\n', 1)[1])  # without the date
+        assert reports[0] == reports[1]
+
+
+def test_seam_scan():
+    assert parse_scan_values('1.8:2.0:0.1,2.5') == [1.8, 1.9, 2.0, 2.5]
+    with pytest.raises(ValueError):
+        parse_scan_values('2.0:1.8:0.1')
+    with open(os.path.join(here, 'data', 'C6H5+_singlefile', 'input.gjf')) as f:
+        text = f.read()
+    with temporary_directory() as tmp:
+        # One point at a time: the one closest to the input geometry (1.403) first
+        points = seam_scan(text, 'distance:1,2', [1.375, 1.4, 1.425], cores=4,
+                           workdir=tmp, poll=0.2)
+        assert [point['status']['result'] for point in points] == ['OK'] * 3
+        assert [point['warm_start'] for point in points] == [1, None, 1]
+        for point in points:
+            x = latest_step_store(point['status']['directory']).read('coordinates')[-1]
+            assert abs(np_distance(x[0:3], x[3:6]) - point['value']) < 1e-6
+        assert os.path.isfile(os.path.join(tmp, 'scan.json'))
+
+
+def test_results_from_fchk():
+    directory = 'CH2'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        with open('test.fchk', 'w') as f:
+            f.write('Title\n'
+                    'Atomic numbers                             I   N=           3\n'
+                    '           6           1           1\n'
+                    'Total Energy                               R     -3.901234567890123E+01\n'
+                    'Cartesian Gradient                         R   N=           9\n'
+                    '  1.00000000E-05 -2.12345678E-04  0.00000000E+00  3.00000000E-01  1.00000000E+00\n'
+                    ' -1.00000000E-05  2.12345678E-04  0.00000000E+00 -3.00000000E-01\n')
+        fields = read_fchk('test.fchk', ('Total Energy', 'Cartesian Gradient', 'Missing'))
+        assert fields['Total Energy'] == -39.01234567890123
+        assert len(fields['Cartesian Gradient']) == 9 and 'Missing' not in fields
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', results_from='fchk')
+        energy, gradients = calc.parse_fchk_energy_and_gradients('test.fchk')
+        assert gradients[0] == ['6', '-1e-05', '0.000212345678', '-0.0']
+        assert calc.run() == calc.OK
+        assert os.path.isfile(os.path.join('JOBS', 'Job0_A.fchk'))
+        with pytest.raises(ValueError):
+            MECPCalculation(results_from='fchk', numerical_gradients='central')
+
+
+@pytest.mark.parametrize("numbers, x, name", [
+    ([6, 1, 1, 1, 1], [0, 0, 0, .63, .63, .63, -.63, -.63, .63, -.63, .63, -.63, .63, -.63, -.63], 'Td'),
+    ([8, 1, 1], [0, 0, 0.1, 0, 0.76, -0.47, 0, -0.76, -0.471], 'C2v'),
+    ([8, 1, 1], [0, 0, 0.1, 0, 0.76, -0.47, 0, -0.70, -0.50], 'Cs'),
+    ([6, 8, 8], [1, 1, 1, 2.16, 1, 1, -0.16, 1, 1], 'D*h'),
+    ([6, 6, 6, 1, 1, 1, 1], [0, 0, 0, 0, 0, 1.3, 0, 0, -1.3, 0.93, 0, 1.86, -0.93, 0, 1.86,
+                             0, 0.93, -1.86, 0, -0.93, -1.86], 'D2d'),
+])
+def test_point_group(numbers, x, name):
+    group = PointGroup.detect(numbers, x)
+    assert group.name == name
+    gradient = [math.sin(i) for i in range(len(x))]
+    symmetric = group.symmetrize(gradient)
+    assert max(abs(a - b) for (a, b) in zip(symmetric, group.symmetrize(symmetric))) < 1e-12
+    for u in group.basis():
+        assert max(abs(a - b) for (a, b) in zip(u, group.symmetrize(u))) < 1e-12
+
+
+@pytest.mark.parametrize("symmetry", ['keep', 'unique'])
+def test_symmetry(symmetry):
+    directory = 'C6H5+_singlefile'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation.from_gaussian_input_file('input.gjf', symmetry=symmetry)
+        assert calc.point_group.name == 'C2v'
+        assert calc.run() == calc.OK
+        for coordinates in StepStore(os.path.join('JOBS', 'steps')).read('coordinates'):
+            assert PointGroup.detect(read_geometry('_initial_geom')[0], list(coordinates),
+                                     tolerance=1e-6).name == 'C2v'
+
+
+def test_gek_surrogate():
+    def surface(x):
+        x = np.asarray(x)
+        return 0.5 * x.dot(x) + np.sin(x[0]), x + np.cos(x[0]) * np.eye(len(x))[0]
+
+    points = [[0.1, 0.0, 0.2], [0.2, -0.1, 0.1], [0.0, 0.1, 0.0]]
+    energies, gradients = zip(*[surface(x) for x in points])
+    model = GEKSurrogate(points, energies, [list(g) for g in gradients])
+    energy, gradient, sigma = model.predict(points[1])
+    assert abs(energy - energies[1]) < 1e-6 and sigma < 1e-4
+    assert np.allclose(gradient, gradients[1], atol=1e-5)
+    x, h = np.array([0.1, 0.05, 0.1]), 1e-5
+    energy, gradient, sigma = model.predict(x)
+    assert abs(energy - surface(x)[0]) < 1e-3 and sigma > 0
+    numerical = [(model.predict(x + h * u)[0] - model.predict(x - h * u)[0]) / (2 * h)
+                 for u in np.eye(3)]
+    assert np.allclose(gradient, numerical, atol=1e-6)
+
+
+def test_surrogate():
+    directory = 'CH2'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        with pytest.raises(ValueError):
+            MECPCalculation(geom='geom_init', footer='Input_Tail', surrogate='gek',
+                            algorithm='penalty')
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', surrogate='gek')
+        assert calc.run() == calc.OK
+        with open('ReportFile') as f:
+            report = f.read()
+        assert 'Surrogate Step: not used (needs two geometries)' in report
+        assert 'Surrogate Step: predicted dE' in report
+
+
+def test_retry_ladder():
+    directory = 'CH2'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', algorithm='penalty',
+                               retry_ladder='scf=xqc; -guess;scf=qc')
+        assert calc.retry_ladder == ['scf=xqc', '-guess', 'scf=qc']
+        name = calc.prepare_gaussian(calc.a_header, calc.geom, calc.footer, label='A_retry3',
+                                     step=1, retry=calc.retry_ladder)
+        with open(name) as f:
+            route = [line for line in f if line.startswith('#')][0]
+        assert 'scf=qc' in route and 'xqc' not in route
+        assert 'guess' not in route and 'force' in route
+
+
+@pytest.mark.parametrize("kwargs", [{}, {'trust_radius': 0.3}])
+def test_resume(kwargs):
+    directory = 'CH2'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', max_steps=2, **kwargs)
+        assert calc.run() == calc.MAX_ITERATIONS_REACHED
+        with open('ReportFile') as f:
+            report = f.read()
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', resume=True, **kwargs)
+        assert calc.jobsdir == 'JOBS'
+        assert calc.run() == calc.OK
+        assert calc.converged_at >= 2
+        with open('ReportFile') as f:
+            assert f.read().startswith(report)
+        assert not os.path.exists('JOBS1')
+
+
+def test_resume_after_optimizer_crash():
+    directory = 'CH2'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        reference = os.path.join(tmp, 'reference')
+        shutil.copytree(original_data, reference)
+        os.chdir(reference)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', max_steps=3, trust_radius=0.3)
+        assert calc.run() == calc.MAX_ITERATIONS_REACHED
+        with open('ReportFile') as f:
+            report = f.read().split('\n', 1)[1]  # without the date
+        with open(os.path.join('JOBS', 'trajectory.xyz')) as f:
+            trajectory = f.read()
+        nsteps = len(StepStore(os.path.join('JOBS', 'steps'), readonly=True))
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', max_steps=3, trust_radius=0.3)
+        journal = calc.journal
+
+        def crash(step, geom, phase, *args):
+            # killed after the optimizer wrote its step, before it was journaled
+            if step == 1 and phase == 'optimizer':
+                raise KeyboardInterrupt
+            return journal(step, geom, phase, *args)
+
+        calc.journal = crash
+        with pytest.raises(KeyboardInterrupt):
+            calc.run()
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', max_steps=3, trust_radius=0.3,
+                               resume=True)
+        assert calc.run() == calc.MAX_ITERATIONS_REACHED
+        with open('ReportFile') as f:
+            assert f.read().split('\n', 1)[1] == report
+        with open(os.path.join('JOBS', 'trajectory.xyz')) as f:
+            assert f.read() == trajectory
+        assert len(StepStore(os.path.join('JOBS', 'steps'), readonly=True)) == nsteps
+
+
+def test_journal_optimizer_state():
+    dense = [[1.0, 0.5], [0.5, 2.0]]
+    lbfgs = {'diagonal': [0.7, 0.7], 'pairs': [[[0.1, 0.2], [0.3, 0.4]]], 'memory': 20}
+    with temporary_directory():
+        for ihessian in (dense, lbfgs):
+            meta = write_inverse_hessian(ihessian, 'hessian')
+            assert os.path.getsize('hessian') == 8 * (4 if ihessian is dense else 6)
+            assert read_inverse_hessian('hessian', json.loads(json.dumps(meta))) == ihessian
+    optimizer = PenaltyOptimizer(2, trust_radius=0.3)
+    optimizer.nstep, optimizer.sigma, optimizer.trust_radius = 3, 14.0, 0.1
+    optimizer.inverse_hessian = dense
+    state = json.loads(json.dumps(optimizer.get_state()))
+    assert 'inverse_hessian' not in state and 'TDE' not in state
+    resumed = PenaltyOptimizer(2, TDE=1e-6)
+    resumed.set_state(state)
+    assert (resumed.nstep, resumed.sigma, resumed.TDE) == (3, 14.0, 1e-6)
+    assert resumed.trust_radius == 0.0  # not used now
+
+
+def test_freq_input_from_checkpoint():
+    directory = 'CH2'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', algorithm='penalty')
+        assert calc._independent_checkpoints()
+        with open('singlet.chk', 'w'):
+            pass
+        name = calc.prepare_gaussian(calc.a_header, calc.geom, calc.footer, label='A',
+                                     step='_freq', share=2)
+        with open(name) as f:
+            contents = f.read()
+        assert '%mem=3GB' in contents and '%nproc=2' in contents
+        assert 'freq=projected' in contents and 'geom=check' in contents
+        assert contents.rstrip().endswith('0 1')
+        name = calc.prepare_gaussian(calc.b_header, calc.geom, calc.footer, label='B',
+                                     step='_freq', share=2)
+        with open(name) as f:
+            assert 'geom=check' not in f.read()
+
+
+@pytest.mark.parametrize("kwargs, report_line", [
+    ({'trust_radius': 0.3}, 'Trust Radius:'),
+    ({'gdiis_threshold': 0.05}, 'GDIIS Extrapolation:'),
+    ({'coordinates': 'internal'}, 'Internal Coordinates:'),
+])
+def test_python_optimizer(kwargs, report_line):
+    directory = 'CH2'
+    cwd = os.getcwd()
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', **kwargs)
+        result = calc.run()
+        if result != calc.OK:
+            try:
+                os.makedirs(os.path.join(cwd, 'failed'))
+            except:
+                pass
+            shutil.copytree(new_data, os.path.join(cwd, 'failed', directory))
+        assert result == calc.OK
+        with open('ReportFile') as f:
+            assert report_line in f.read()
+
+
+@pytest.mark.parametrize("algorithm", sorted(OPTIMIZERS))
+def test_algorithm(algorithm):
+    directory = 'CH2'
+    cwd = os.getcwd()
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init', footer='Input_Tail', algorithm=algorithm,
+                               max_steps=100)
+        result = calc.run()
+        if result != calc.OK:
+            try:
+                os.makedirs(os.path.join(cwd, 'failed'))
+            except:
+                pass
+            shutil.copytree(new_data, os.path.join(cwd, 'failed', directory + '_' + algorithm))
+        assert result == calc.OK
+
+
+def test_rms_criteria_over_all_coordinates():
+    # RMS criteria divide by all the 3N coordinates, like MECP.x, even with frozen atoms
+    # or when only the symmetry-unique coordinates are optimized
+    x = [0.0, 0.0, 0.0, 1.0, 0.0, 0.0]
+    new_x = [0.0, 0.0, 0.0, 1.003, 0.0, 0.0]
+    g = [0.0, 0.0, 0.0, 0.00065, 0.00065, 0.0]
+    basis = [[0.0, 0.0, 0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0, 1.0, 0.0]]
+    reports = []
+    for frozen, vectors in (((), None), ((0,), None), ((), basis)):
+        optimizer = MECPOptimizer(2, frozen=frozen, basis=vectors)
+        converged, report = optimizer.test_convergence([1, 1], x, new_x, -1.0, -1.0, g,
+                                                       [0.0] * 6, g)
+        assert converged  # RMS gradient over 3 coordinates would be 5.3e-4
+        reports.append(report)
+    assert reports[0] == reports[1]
+
+
+def test_frozen_atoms_and_constraints():
+    directory = 'C6H5+'
+    cwd = os.getcwd()
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        with open('geom_init') as f:
+            lines = f.readlines()
+        with open('geom_frozen', 'w') as f:  # freeze first atom with Gaussian syntax
+            fields = lines[0].split()
+            f.write(' '.join([fields[0], '-1'] + fields[1:]) + '\n')
+            f.writelines(lines[1:])
+        calc = MECPCalculation(geom='geom_frozen', freeze='7-8', max_steps=100,
+                               constraints='distance:3,4:1.40;angle:4,5,6')
+        assert calc.frozen == [0, 6, 7]
+        result = calc.run()
+        if result != calc.OK:
+            try:
+                os.makedirs(os.path.join(cwd, 'failed'))
+            except:
+                pass
+            shutil.copytree(new_data, os.path.join(cwd, 'failed', directory))
+        assert result == calc.OK
+        initial, final = parse_xyz('geom_init'), parse_xyz('geom')
+        for i in (0, 6, 7):
+            assert np.allclose(initial[i][1], final[i][1])
+        assert abs(np_distance(final[2][1], final[3][1]) - 1.40) < 1e-5
+        assert abs(angle(initial[3][1], initial[4][1], initial[5][1]) -
+                   angle(final[3][1], final[4][1], final[5][1])) < 1e-3
+
+
+def test_parse_freeze_and_constraints():
+    assert parse_atom_list('1,2, 5-7') == [0, 1, 4, 5, 6]
+    assert parse_constraints('distance:1,2:1.5;angle:1,2,3') == [
+        ('distance', (0, 1), 1.5), ('angle', (0, 1, 2), None)]
+    with pytest.raises(ValueError):
+        parse_constraints('angle:1,2')
+    assert parse_constraints('dihedral:1,2,3,4:180') == [
+        ('dihedral', (0, 1, 2, 3), math.pi)]
+
+
+def test_oniom_geometry():
+    with temporary_directory():
+        with open('geom', 'w') as f:
+            f.write('C-CT--0.12(PDBName=CA) -1 0.0 0.0 0.0 L\n'
+                    'N-N3-0.5 0 1.0 0.0 0.0 H\n'
+                    'H-HC-0.1 0 0.0 1.0 0.0 L H-HC-0.1 2\n')
+        numbers, x = read_geometry('geom')
+        assert numbers == [6, 7, 1]
+        assert x[3:6] == [1.0, 0.0, 0.0]
+        with open('geom') as f:
+            atoms = parse_oniom_atoms(f)
+        assert atoms[0] == (['C-CT--0.12(PDBName=CA)', '-1'], ['L'])
+        assert atoms[2][1] == ['L', 'H-HC-0.1', '2']
+
+
+def test_lbfgs_optimizer():
+    numbers, x = read_geometry(os.path.join(here, 'data', 'C6H5+', 'geom_init'))
+    dense, limited = MECPOptimizer(len(numbers)), MECPOptimizer(len(numbers), lbfgs_memory=5)
+    for optimizer in (dense, limited):
+        y = list(x)
+        for _ in range(3):
+            # Two displaced harmonic wells
+            forces_a = [-0.1 * (v - 0.05) for v in y]
+            forces_b = [-0.2 * (v + 0.05) for v in y]
+            energy_a = sum(0.05 * (v - 0.05) ** 2 for v in y)
+            energy_b = sum(0.1 * (v + 0.05) ** 2 for v in y) + 0.01
+            y = optimizer.step(numbers, y, energy_a, energy_b, forces_a, forces_b)[0]
+        optimizer.result = y
+    assert isinstance(limited.inverse_hessian, dict)
+    assert np.allclose(dense.result, limited.result, atol=1e-6)
+
+
+def test_generate_internal_coordinates():
+    numbers, x = read_geometry(os.path.join(here, 'data', 'C6H5+', 'geom_init'))
+    internals = generate_internal_coordinates(numbers, x)
+    kinds = [kind for (kind, _) in internals]
+    assert kinds.count('distance') == 11
+    assert kinds.count('angle') == 16
+    assert kinds.count('dihedral') == 20
+
+
+def test_python_optimizer_matches_fortran():
+    directory = 'C6H5+'
+    original_data = os.path.join(here, 'data', directory)
+    with temporary_directory() as tmp:
+        new_data = os.path.join(tmp, directory)
+        shutil.copytree(original_data, new_data)
+        os.chdir(new_data)
+        calc = MECPCalculation(geom='geom_init')
+        calc.prepare_workspace()
+        check_output([calc.compile_fortran()])
+        with open('AddtoReportFile') as f:
+            fortran_report = f.read()
+
+        numbers, x = read_geometry('geom_init')
+        energy_a, forces_a, energy_b, forces_b = parse_ab_initio('ab_initio')
+        optimizer = MECPOptimizer(calc.natom)
+        _, converged, python_report = optimizer.step(numbers, x, energy_a, energy_b,
+                                                     forces_a, forces_b)
+        assert converged == ('CONVERGED' in fortran_report)
+        assert python_report == fortran_report
+
+
 def test_geometry():
     directory = 'C6H5+'
     # directory = 'C6H5+_singlefile'
@@ -225,6 +994,19 @@ def parse_xyz(path):
     return atoms
 
 
+def parse_ab_initio(path):
+    energies, forces = [], []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if line.startswith('Energy'):
+                energies.append(float(next(f)))
+                forces.append([])
+            elif len(fields) == 4:
+                forces[-1].extend(float(v) for v in fields[1:])
+    return energies[0], forces[0], energies[1], forces[1]
+
+
 def distance(a, b):
     return math.hypot(a[0] - b[0], a[1] - b[1])
 